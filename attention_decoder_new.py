@@ -73,7 +73,9 @@ def attention_decoder(decoder_inputs,
   print('encoder_states.shape', encoder_states.shape)
   print('decoder_inputs[0].shape', decoder_inputs[0].shape)
   with variable_scope.variable_scope("attention_decoder") as scope:
-    batch_size = encoder_states.get_shape()[0].value # if this line fails, it's because the batch size isn't defined
+    batch_size = encoder_states.get_shape()[0].value
+    if batch_size is None: # the batch size varies from batch to batch with token-budget batching (see --batch_tokens)
+      batch_size = array_ops.shape(encoder_states)[0]
     enc_output_size = encoder_states.get_shape()[2].value # encoder state size, if this line fails, it's because the attention length isn't defined
 
     hier = True if encoder_section_states is not None else False
@@ -15,14 +15,21 @@
 # limitations under the License.
 # ==============================================================================
 from itertools import chain
+import collections
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
 import sys
 """This file contains code to process data into batches"""
 
 from six.moves import queue as Queue
 from six.moves import xrange
 import six
+import random
 from random import shuffle
-from threading import Thread
+from threading import Event, Lock, Thread
 import time
 import numpy as np
 import tensorflow as tf
@@ -37,6 +44,20 @@ SECTION_SEPARATOR = ' <SCTN/> '
 # to represent separator as string, end of item (ei)
 LIST_SEPARATOR = ' <EI/> '
 
+# Suffix of the token id cache directory of a datafile (see write_id_cache)
+ID_CACHE_SUFFIX = '.ids'
+
+# hyperparameters that change the token ids of an Example or which documents
+# are kept, and therefore key the token id cache
+ID_CACHE_HPARAMS = ['hier', 'pointer_gen', 'max_enc_steps', 'max_section_len', 'num_sections',
+                    'max_intro_len', 'max_conclusion_len', 'max_intro_sents', 'max_conclusion_sents',
+                    'max_section_sents', 'split_intro',
+                    'max_article_sents', 'max_abstract_len', 'min_abstract_len']
+
+# version of the layout of the token id cache, changed when the stored ids change
+# for the same hyperparameters (e.g. sections are no longer padded to max_section_len)
+ID_CACHE_VERSION = 3
+
 
 def _string_to_list(s, dtype='str'):
     """ converts string to list
@@ -61,45 +82,29 @@ def _string_to_nested_list(s):
 #   return sum([len(e.split(' ')) for e in s])
   
 
-def _section_to_ids(section, vocab, max_len, pad_id):
-  """ Converts words in a section (list of strings) to ids and pad if necessary """
-  section_text = ' '.join(section)
-  section_words = section_text.split()
-  sec_len = len(section_words)
-  if sec_len > max_len:
-    section_words = section_words[:max_len]
-  word_ids = [vocab.word2id(w) for w in section_words]
-  
-  
 def _flatten(lst):
   """ flatten a nested list (list of lists) """
   return list(chain.from_iterable(lst))
 
-def _get_section_words(sec, max_len=None, pad_id=data.PAD_TOKEN, pad=True):
-  """ given a section (list of sentences), returns a single list of words in that section """
-  words = ' '.join(sec).split()
-  if max_len is None:
-    max_len = len(words)
-  if pad:
-    while len(words) < max_len:
-      words += [pad_id]
-  return words[:max_len]
+def _get_section_words(sec, max_len=None):
+  """ given a section (list of sentences), returns a single list of words in that section, up to max_len words """
+  return ' '.join(sec).split()[:max_len]
 
-def _pad_words(words, max_len=None, pad_id=data.PAD_TOKEN):
-  """ given a section (list of sentences), returns a single list of words in that section """
-  if max_len is None:
-    max_len = len(words)
-  while len(words) < max_len:
-    words += [pad_id]
-  return words[:max_len]
-    
 
+class Example(object):
+    """Class representing a train/val/test example for text summarization.
 
+    The token id sequences are int32 arrays. The original strings are only kept in decode mode, where they are written out with the decoded summaries."""
 
-class Example(object):
-    """Class representing a train/val/test example for text summarization."""
+    # fields are only set as needed by the mode and model (e.g. enc_sections only in hier mode)
+    __slots__ = ('discard', 'enc_len', 'enc_input', 'enc_input_extend_vocab', 'article_oovs',
+                 'abs_ids', 'abs_ids_extend_vocab', 'dec_input', 'target', 'dec_len',
+                 'enc_sections', 'enc_sections_extend_vocab', 'enc_sec_len', 'sec_len', 'num_words_section_nopad',
+                 'article_id', 'sections', 'section_names', 'labels',
+                 'original_article', 'original_abstract', 'original_abstract_sents')
 
-    def __init__(self, article, abstract_sentences, article_id, sections, section_names, labels, vocab, hps):
+    def __init__(self, article, abstract_sentences, article_id, sections, section_names, labels, vocab, hps,
+                 section_roles=None):
         """Initializes the Example, performing tokenization and truncation to produce the encoder, decoder and target sequences, which are stored in self.
 
         Args:
@@ -111,47 +116,38 @@ class Example(object):
           labels: list of strings, for extractive summarization training (TODO Later)
           vocab: Vocabulary object
           hps: hyperparameters
+          section_roles: the positions of the introduction, conclusion and body sections stored with the
+            document (see data.section_roles), empty if the hier model can't use it, None if not stored
         """
-        self.hps = hps
         self.discard = False
         # Get ids of special tokens
         start_decoding = vocab.word2id(data.START_DECODING)
         stop_decoding = vocab.word2id(data.STOP_DECODING)
 
 
-        # clean section information
-        # clean sections after conclusions
+        # select the introduction, body sections and conclusion, at the positions stored
+        # with the document by the converters (see data.section_roles)
         if hps.hier:
-          end_loc = len(section_names)
-          beg_loc = 0
-          for i,s in enumerate(section_names):
-            if 'conclu' in s.lower():
-              end_loc = i + 1
-            if 'intro' in s.lower() and beg_loc == 0:
-              beg_loc = i
-              
-          if beg_loc < len(section_names) - end_loc:
-            sections = sections[beg_loc:end_loc]
-          try:
-            intro_last = sections[beg_loc][-2:] # last two sentences in the intro
-          except IndexError:
-#             print('article_id: {}, len(sections): {}, section_names: {}'.format(article_id, len(sections), section_names))
+          if section_roles is None: # datafiles written before the roles were stored
+            section_roles = data.section_roles(section_names, len(sections))
+          if not section_roles:
             self.discard = True
             return
-#           intro_first = []
-          i = 0
-#           intro_last_len = _count_words(intro_last)
-#           intro_len = intro_last_len
-#           while(intro_len < hps.max_intro_len):
-#             intro_first.append(sections[beg_loc][i])
-#             intro_len = _count_words(intro_first) + intro_last_len
-#             i += 1
-          
+          intro_loc, conclusion_loc, body_start, body_end = section_roles
+          intro = sections[intro_loc]
+          conclusion = sections[conclusion_loc]
+          body = sections[body_start:body_end][:hps.num_sections - 2]
+          if vocab.bpe is not None:
+            # split the sentences into subwords, so that the section lengths below count subwords
+            subwords = lambda sec: [' '.join(vocab.tokenize(sent)) for sent in sec]
+            intro, conclusion, body = subwords(intro), subwords(conclusion), [subwords(s) for s in body]
+          intro_last = intro[-2:] # last two sentences in the intro
+
           if not hps.split_intro:
           
             max_sents = hps.max_intro_sents - 2 # exclude the last two sents
-            intro_first = sections[beg_loc][:max_sents]
-            intro_last_words = _get_section_words(intro_last, pad=False)
+            intro_first = intro[:max_sents]
+            intro_last_words = _get_section_words(intro_last)
             intro_last_len = len(intro_last_words) # flatten list of sents, get the string inside, count words
             
             discard_last = False
@@ -160,88 +156,62 @@ class Example(object):
             len_limit = hps.max_intro_len - intro_last_len if not discard_last else hps.max_intro_len
             # truncate the intro by len_limit (we consider last 2 sentences from the intro to be there always)
             # Flatten list of lists, get the first element (string), get words, get first n words, return a striing, make it a list, extend it with intro_last
-            intro_words = _get_section_words(intro_first, len_limit, pad=False)
+            intro_words = _get_section_words(intro_first, len_limit)
             
             try:
               if intro_words[-1] != '.':
                 intro_words = intro_words[:-1] + ['.']
                 if not discard_last:
                   intro_words += intro_last_words
-                intro_words = _pad_words(intro_words, hps.max_intro_len)
+                intro_words = intro_words[:hps.max_intro_len]
             except IndexError:
               print('No first section, Example discarded: ', article_id)
               self.discard = True
+              return
           
           else:    
-            intro_first = sections[beg_loc][:hps.max_intro_sents]
-            intro_words = _get_section_words(intro_first, hps.max_intro_len, pad=True)
-
-          try:
-            conclusion_words = _get_section_words(sections[end_loc - beg_loc - 1][:hps.max_conclusion_sents], hps.max_conclusion_len)
-          except:
-            import pdb; pdb.set_trace()
-            print("ERROR, pause and check")
-            print('end_loc:', end_loc)
-            print('section_names:', section_names)
-            print('num_sections: {}'.format(len(sections)))
-            print('len_sections_sents:', [len(e) for e in sections])
-            
-#           if not hps.intro_split:
+            intro_first = intro[:hps.max_intro_sents]
+            intro_words = _get_section_words(intro_first, hps.max_intro_len)
+
+          conclusion_words = _get_section_words(conclusion[:hps.max_conclusion_sents], hps.max_conclusion_len)
           article_sections = [_get_section_words(s[:hps.max_section_sents], hps.max_section_len)
-                              for s in sections[1:-1][:hps.num_sections - 2]]
-#           else:
-#             tmp_sections = []
-#             remaining_sec = sections[1:-1]
-#             if len(remaining_sec) > hps.num_sections - 2:
-#               for i in range(hps.num_sections - 2):
-#                 tmp_sections.append(remaining_sec[i])
-#               last_sec = []
-#               while(i < len(remaining_sec)):
-#                 last_sec.extend(remaining_sec[i])
-#                 i += 1
-#               tmp_sections.append(last_sec)
-#               remaining_sec = tmp_sections
-#   
-#             article_sections = [_get_section_words(s, hps.max_section_len)
-#                                 for s in remaining_sec]
+                              for s in body]
           
           sections = [intro_words] + article_sections + [conclusion_words]
-          sec_len = len(sections)
-          self.sec_len = sec_len
-          self.num_words_section = [hps.max_section_len for e in sections] 
+          self.sec_len = len(sections)
           self.num_words_section_nopad = [len(e) for e in sections]
-          # TODO: Assumption is that sections is a list of list (sections, sentences), check if assumption is true
-          # TODO: Assumtpion is that number of sections is greater than 2, check if assumption is true
-          
-#           pad_id = vocab.word2id(data.PAD_TOKEN)
-          
-          
-            
-        
 
         article_text = ' '.join(article)
         # Process the article
-        article_words = article_text.split()
+        article_words = vocab.tokenize(article_text)
         if len(article_words) > hps.max_enc_steps:
             article_words = article_words[:hps.max_enc_steps]
         # store the length after truncation but before padding
         self.enc_len = len(article_words)
-        # list of word ids; OOVs are represented by the id for UNK token
-        self.enc_input = [vocab.word2id(w) for w in article_words]
+
+        # Process the abstract
+        abstract = ' '.join(abstract_sentences)  # string
+        abstract_words = vocab.tokenize(abstract)  # list of strings
+
+        # Map the article and abstract words to ids in a single pass. In
+        # enc_input and abs_ids, OOVs are represented by the id for UNK token;
+        # in the extended vocab versions (used in pointer-generator mode),
+        # in-article OOVs are represented by their temporary OOV id
+        (self.enc_input, enc_input_extend_vocab, article_oovs,
+         abs_ids, abs_ids_extend_vocab) = data.article_abstract2ids(article_words, abstract_words, vocab)
+        self.abs_ids = abs_ids
         
         if hps.hier:
           self.enc_sections = []
           
           for sec in sections:
-            self.enc_sections.append([vocab.word2id(w) for w in sec])
+            self.enc_sections.append(vocab.words2ids(sec))
           self.enc_sec_len = [len(e) for e in self.enc_sections]
 #           self.enc_sec_len = sec_len # TODO: Check
-
-        # Process the abstract
-        abstract = ' '.join(abstract_sentences)  # string
-        abstract_words = abstract.split()  # list of strings
-        # list of word ids; OOVs are represented by the id for UNK token
-        abs_ids = [vocab.word2id(w) for w in abstract_words]
+          if hps.pointer_gen:
+            # the section ids with the in-article OOVs as their temporary OOV ids, which the hier batches copy from
+            self.enc_sections_extend_vocab = [np.asarray(data.abstract2ids(sec, vocab, article_oovs), dtype=np.int32)
+                                              for sec in sections]
 
         # Get the decoder input sequence and target sequence
         self.dec_input, self.target = self.get_dec_inp_targ_seqs(
@@ -250,16 +220,13 @@ class Example(object):
 
         # If using pointer-generator mode, we need to store some extra info
         if hps.pointer_gen:
-            # Store a version of the enc_input where in-article OOVs are
+            # Store the version of the enc_input where in-article OOVs are
             # represented by their temporary OOV id; also store the in-article
-            # OOVs words themselves
-            self.enc_input_extend_vocab, self.article_oovs = data.article2ids(
-                article_words, vocab)
-
-            # Get a verison of the reference summary where in-article OOVs are
-            # represented by their temporary article OOV id
-            abs_ids_extend_vocab = data.abstract2ids(
-                abstract_words, vocab, self.article_oovs)
+            # OOVs words themselves, and the version of the reference summary
+            # where in-article OOVs are represented by their temporary article OOV id
+            self.enc_input_extend_vocab = enc_input_extend_vocab
+            self.article_oovs = article_oovs
+            self.abs_ids_extend_vocab = abs_ids_extend_vocab
 
             # Overwrite decoder target sequence so it uses the temp article OOV
             # ids, the target now includes words that are in the article but
@@ -268,71 +235,105 @@ class Example(object):
                 abs_ids_extend_vocab, hps.max_dec_steps, start_decoding, stop_decoding)
 
         self.article_id = article_id
-        self.sections = sections
-        self.section_names = section_names
         self.labels = labels
 
-        # Store the original strings
-        self.original_article = article
-        self.original_abstract = abstract
-        self.original_abstract_sents = abstract_sentences
+        # Store the original strings, only needed for decoding
+        if hps.mode == 'decode':
+            self.sections = sections
+            self.section_names = section_names
+            self.original_article = article
+            self.original_abstract = abstract
+            self.original_abstract_sents = abstract_sentences
+        else:
+            self.sections = None
+            self.section_names = None
+            self.original_article = None
+            self.original_abstract = None
+            self.original_abstract_sents = None
+
+    @classmethod
+    def from_ids(cls, article_id, enc_input, enc_input_extend_vocab, article_oovs,
+                 abs_ids, abs_ids_extend_vocab, enc_sections, enc_sections_extend_vocab, num_words_section_nopad,
+                 vocab, hps):
+        """Makes an Example from the token ids stored in the token id cache, without
+        redoing the tokenization and truncation of __init__. The original strings are not kept.
+
+        Args:
+          article_id: string
+          enc_input: array or list of (truncated) article word ids
+          enc_input_extend_vocab: enc_input with in-article OOVs as temporary OOV ids, or None if not hps.pointer_gen
+          article_oovs: list of in-article OOV words, or None if not hps.pointer_gen
+          abs_ids: array or list of abstract word ids
+          abs_ids_extend_vocab: abs_ids with in-article OOVs as temporary OOV ids, or None if not hps.pointer_gen
+          enc_sections: list of lists of section word ids, or None if not hps.hier
+          enc_sections_extend_vocab: enc_sections with in-article OOVs as temporary OOV ids, or None if not hps.hier and hps.pointer_gen
+          num_words_section_nopad: list of section lengths, or None if not hps.hier
+          vocab: Vocabulary object
+          hps: hyperparameters
+        """
+        self = cls.__new__(cls)
+        self.discard = False
+        start_decoding = vocab.word2id(data.START_DECODING)
+        stop_decoding = vocab.word2id(data.STOP_DECODING)
+
+        self.enc_len = len(enc_input)
+        self.enc_input = np.asarray(enc_input, dtype=np.int32)
+        if hps.hier:
+          self.enc_sections = enc_sections
+          self.enc_sec_len = [len(e) for e in enc_sections]
+          self.sec_len = len(enc_sections)
+          self.num_words_section_nopad = num_words_section_nopad
+          if hps.pointer_gen:
+            self.enc_sections_extend_vocab = enc_sections_extend_vocab
+
+        self.abs_ids = abs_ids
+        self.dec_input, self.target = self.get_dec_inp_targ_seqs(
+            abs_ids, hps.max_dec_steps, start_decoding, stop_decoding)
+        self.dec_len = len(self.dec_input)
+        if hps.pointer_gen:
+            self.enc_input_extend_vocab = np.asarray(enc_input_extend_vocab, dtype=np.int32)
+            self.article_oovs = article_oovs
+            self.abs_ids_extend_vocab = abs_ids_extend_vocab
+            _, self.target = self.get_dec_inp_targ_seqs(
+                abs_ids_extend_vocab, hps.max_dec_steps, start_decoding, stop_decoding)
+
+        self.article_id = article_id
+        self.sections = None
+        self.section_names = None
+        self.labels = None
+        self.original_article = None
+        self.original_abstract = None
+        self.original_abstract_sents = None
+        return self
 
     def get_dec_inp_targ_seqs(self, sequence, max_len, start_id, stop_id):
         """Given the reference summary as a sequence of tokens, return the input sequence for the decoder, and the target sequence which we will use to calculate loss. The sequence will be truncated if it is longer than max_len. The input sequence must start with the start_id and the target sequence must end with the stop_id (but not if it's been truncated).
 
         Args:
-          sequence: List of ids (integers)
+          sequence: array or list of ids (integers)
           max_len: integer
           start_id: integer
           stop_id: integer
 
         Returns:
-          inp: sequence length <=max_len starting with start_id
-          target: sequence same length as input, ending with stop_id only if there was no truncation
+          inp: int32 array, length <=max_len starting with start_id
+          target: int32 array, same length as input, ending with stop_id only if there was no truncation
         """
-        inp = [start_id] + sequence[:]
-        target = sequence[:]
-        if len(inp) > max_len:  # truncate
-            inp = inp[:max_len]
-            target = target[:max_len]  # no end_token
+        sequence = np.asarray(sequence, dtype=np.int32)
+        if len(sequence) + 1 > max_len:  # truncate
+            inp = np.empty(max_len, dtype=np.int32)
+            inp[1:] = sequence[:max_len - 1]
+            target = sequence[:max_len].copy()  # no end_token
         else:  # no truncation
-            target.append(stop_id)  # end token
+            inp = np.empty(len(sequence) + 1, dtype=np.int32)
+            inp[1:] = sequence
+            target = np.empty(len(sequence) + 1, dtype=np.int32)
+            target[:-1] = sequence
+            target[-1] = stop_id  # end token
+        inp[:1] = start_id
         assert len(inp) == len(target)
         return inp, target
 
-    def pad_decoder_inp_targ(self, max_len, pad_id):
-        """Pad decoder input and target sequences with pad_id up to max_len."""
-        while len(self.dec_input) < max_len:
-            self.dec_input.append(pad_id)
-        while len(self.target) < max_len:
-            self.target.append(pad_id)
-
-    def pad_encoder_input(self, max_len, pad_id):
-        """Pad the encoder input sequence with pad_id up to max_len."""
-        while len(self.enc_input) < max_len:
-            self.enc_input.append(pad_id)
-        if self.hps.pointer_gen:
-            while len(self.enc_input_extend_vocab) < max_len:
-                self.enc_input_extend_vocab.append(pad_id)
-
-    def pad_section_input(self, max_sec_len, max_secs, pad_id=None):
-        """pad encoder sections with pad_id. if the number of sections is less than max_secs, add another section with all pads"""
-#         print("Before padding -> len: {}, element_len: {}, element_type: {}".format(len(self.enc_sections), len(self.enc_sections[0]), type(self.enc_sections[0][0])))
-        for i, sec in enumerate(self.enc_sections):
-          while len(sec) < max_sec_len:
-            self.enc_sections[i].append(pad_id)
-        while len(self.enc_sections) < max_secs:
-          pads = [pad_id for _ in range(max_sec_len)]
-          self.enc_sections.append(pads)
-          self.num_words_section.append(len(pads))
-#           self.num_words_section.append(0)
-          
-#         print("After padding -> len: {}, element_len: {}, element_type: {}\n\n".format(len(self.enc_sections), len(self.enc_sections[0]), type(self.enc_sections[0][0])))
-#         if self.hps.pointer_gen:
-#             while len(self.enc_input_extend_vocab) < max_len:
-#                 self.enc_input_extend_vocab.append(pad_id)
-
-
 
 class Batch(object):
     """Class representing a minibatch of train/val/test examples for text summarization."""
@@ -346,6 +347,8 @@ class Batch(object):
            vocab: Vocabulary object
         """
         self._hps = hps
+        # the number of rows of the arrays, batches packed up to a token budget have no padding rows
+        self.batch_size = len(example_list) if hps.batch_tokens else hps.batch_size
         self.pad_id = vocab.word2id(
             data.PAD_TOKEN)  # id of the PAD token used to pad sequences
         self.sec_pad_id = vocab.word2id(data.SEC_PAD_TOKEN)
@@ -355,14 +358,48 @@ class Batch(object):
         self.init_decoder_seq(example_list, hps)
         self.store_orig_strings(example_list)  # store the original strings
 
+    @classmethod
+    def repeated(cls, example, hps, vocab):
+        """Makes the Batch of beam search decoding: the example repeated batch_size (i.e. beam_size) times.
+
+        The arrays are built for the single example and broadcast to batch_size rows with np.broadcast_to,
+        so they are read-only views that share the row of the example.
+
+        Args:
+           example: Example object
+           hps: hyperparameters
+           vocab: Vocabulary object
+        """
+        self = cls([example], hps._replace(batch_size=1), vocab)
+        self._hps = hps
+        self.batch_size = hps.batch_size
+        for k, v in list(vars(self).items()):
+            if isinstance(v, np.ndarray) and v.ndim > 0:
+                setattr(self, k, np.broadcast_to(v, (hps.batch_size,) + v.shape[1:]))
+            elif isinstance(v, list):
+                setattr(self, k, v * hps.batch_size)
+        return self
+
     def init_encoder_seq(self, example_list, hps):
         """Initializes the following:
             self.enc_batch:
               numpy array of shape (batch_size, <=max_enc_steps) containing integer ids
-              (all OOVs represented by UNK id), padded to length of longest sequence in the batch
+              (all OOVs represented by UNK id), padded to length of longest sequence in the batch.
+              In hier mode, the ids of the sections, the section j of each row at
+              j * self.max_section_len, like the word states that the decoder attends to.
             self.enc_lens:
               numpy array of shape (batch_size) containing integers.
-              The (truncated) length of each encoder input sequence (pre-padding).
+              The (truncated) length of each encoder input sequence (pre-padding),
+              in hier mode the total length of the sections.
+            self.enc_padding_mask:
+              numpy array of shape (batch_size, enc_batch length), 1s for the tokens of enc_batch and 0s for padding
+
+          If hps.hier, additionally initializes the following:
+            self.max_section_len:
+              the length the sections are padded to, the length of the longest
+              section in the batch (at most hps.max_section_len)
+            self.batch_sections:
+              numpy array of shape (batch_size, num_sections, max_section_len) containing integer ids
 
           If hps.pointer_gen, additionally initializes the following:
             self.max_art_oovs:
@@ -373,77 +410,86 @@ class Batch(object):
               Same as self.enc_batch, but in-article OOVs are represented by
               their temporary article OOV number.
         """
-        # Determine the maximum length of the encoder input sequence in this
-        # batch
+        num_examples = len(example_list)
+
+        # For pointer-generator mode, need to store some extra info
+        if hps.pointer_gen:
+            # Determine the max number of in-article OOVs in this batch
+            self.max_art_oovs = max([len(ex.article_oovs)
+                                     for ex in example_list])
+            # Store the in-article OOVs themselves
+            self.art_oovs = [ex.article_oovs for ex in example_list]
+
         if hps.hier:
-          max_enc_seq_len = hps.max_section_len * hps.num_sections
-        else:
-          max_enc_seq_len = max([ex.enc_len for ex in example_list])
-          
+          self.init_section_seq(example_list, hps)
+          return
 
-        # Pad the encoder input sequences up to the length of the longest
-        # sequence
-        for ex in example_list:
-            ex.pad_encoder_input(max_enc_seq_len, self.pad_id)
+        # Determine the maximum length of the encoder input sequence in this
+        # batch
+        max_enc_seq_len = max([ex.enc_len for ex in example_list])
 
-        # Initialize the numpy arrays
+        # Initialize the numpy arrays, the sequences of the examples are padded
+        # up to the length of the longest sequence with pad_id
         # Note: our enc_batch can have different length (second dimension)
         # for each batch because we use dynamic_rnn for the encoder.
         self.enc_batch = np.zeros(
-            (hps.batch_size, max_enc_seq_len), dtype=np.int32)
-        self.enc_lens = np.zeros((hps.batch_size), dtype=np.int32)
-        self.enc_padding_mask = np.zeros((hps.batch_size, max_enc_seq_len), dtype=np.float32)
+            (self.batch_size, max_enc_seq_len), dtype=np.int32)
+        self.enc_batch[:num_examples] = self.pad_id
+        self.enc_lens = np.zeros((self.batch_size), dtype=np.int32)
 
         # Fill in the numpy arrays
         for i, ex in enumerate(example_list):
-            self.enc_batch[i, :] = ex.enc_input[:]
+            self.enc_batch[i, :ex.enc_len] = ex.enc_input
             self.enc_lens[i] = ex.enc_len
-            for j in range(ex.enc_len):
-              self.enc_padding_mask[i][j] = 1
+        self.enc_padding_mask = (np.arange(max_enc_seq_len) < self.enc_lens[:, None]).astype(np.float32)
 
-        # For pointer-generator mode, need to store some extra info
         if hps.pointer_gen:
-            # Determine the max number of in-article OOVs in this batch
-            self.max_art_oovs = max([len(ex.article_oovs)
-                                     for ex in example_list])
-            # Store the in-article OOVs themselves
-            self.art_oovs = [ex.article_oovs for ex in example_list]
             # Store the version of the enc_batch that uses the article OOV ids
             self.enc_batch_extend_vocab = np.zeros(
-                (hps.batch_size, max_enc_seq_len), dtype=np.int32)
+                (self.batch_size, max_enc_seq_len), dtype=np.int32)
+            self.enc_batch_extend_vocab[:num_examples] = self.pad_id
             for i, ex in enumerate(example_list):
-                self.enc_batch_extend_vocab[i,
-                                            :] = ex.enc_input_extend_vocab[:]
-                                            
-        if self._hps.hier:
-          # TODO: see if you can uncomment it. Doesn't work because of unstack in the model
-#           max_num_sections = max([ex.sec_len for ex in example_list])
-          max_num_sections = self._hps.num_sections
-          max_num_sections_nopad = max([ex.sec_len for ex in example_list])
-          for ex in example_list:
-#             ex.pad_section_input(max_num_sections, self.sec_pad_id)
-            ex.pad_section_input(self._hps.max_section_len, max_num_sections, self.pad_id)
-          self.batch_doc_sec_lens = [max_num_sections for _ in example_list]
-          self.batch_sections = np.zeros((hps.batch_size, max_num_sections, self._hps.max_section_len), dtype=np.int32)
-          self.batch_sections_len = np.zeros((hps.batch_size, max_num_sections), dtype=np.int32)
-          self.batch_sections_len_nopad = np.zeros((hps.batch_size, max_num_sections_nopad), dtype=np.int32)
-          self.enc_section_padding_mask = np.zeros((hps.batch_size, max_num_sections, self._hps.max_section_len), dtype=np.float32)
-          for i, ex in enumerate(example_list):
-            j = 0
-            while(j < len(ex.enc_sections)):
-              self.batch_sections[i, j, :] = ex.enc_sections[j][:self._hps.max_section_len]
-              if j < len(ex.enc_sec_len):
-                for k in range(ex.enc_sec_len[j]):
-                  self.enc_section_padding_mask[i][j][k] = 1
-              j += 1
-            self.batch_sections_len[i, :] = ex.num_words_section[:]
-            try:
-              self.batch_sections_len_nopad[i, :] = ex.num_words_section_nopad[:]
-            except ValueError: # in cases that we want to assign a length 3 list to length 4
-              for k in range(len(ex.num_words_section_nopad)):
-                self.batch_sections_len_nopad[i, k] = ex.num_words_section_nopad[k]
-              
-            
+                self.enc_batch_extend_vocab[i, :ex.enc_len] = ex.enc_input_extend_vocab
+
+    def init_section_seq(self, example_list, hps):
+        """Initializes the section arrays of hier mode (see init_encoder_seq), and enc_batch,
+        enc_batch_extend_vocab, enc_lens and enc_padding_mask from them. The sections are only
+        padded up to the longest section in this batch."""
+        # TODO: see if you can uncomment it. Doesn't work because of unstack in the model
+#         max_num_sections = max([ex.sec_len for ex in example_list])
+        max_num_sections = hps.num_sections
+        max_num_sections_nopad = max([ex.sec_len for ex in example_list])
+        max_section_len = self.max_section_len = min(
+            hps.max_section_len, max([l for ex in example_list for l in ex.enc_sec_len] + [1]))
+        num_examples = len(example_list)
+        self.batch_doc_sec_lens = [max_num_sections for _ in example_list]
+        # missing sections of an example are all pads
+        self.batch_sections = np.zeros((self.batch_size, max_num_sections, max_section_len), dtype=np.int32)
+        self.batch_sections[:num_examples] = self.pad_id
+        self.batch_sections_len = np.zeros((self.batch_size, max_num_sections), dtype=np.int32)
+        self.batch_sections_len[:num_examples] = max_section_len
+        self.batch_sections_len_nopad = np.zeros((self.batch_size, max_num_sections_nopad), dtype=np.int32)
+        sec_lens = np.zeros((self.batch_size, max_num_sections), dtype=np.int32)
+        if hps.pointer_gen:
+          sections_extend_vocab = np.zeros_like(self.batch_sections)
+          sections_extend_vocab[:num_examples] = self.pad_id
+        for i, ex in enumerate(example_list):
+          for j, sec in enumerate(ex.enc_sections):
+            sec_lens[i, j] = min(len(sec), max_section_len)
+            self.batch_sections[i, j, :sec_lens[i, j]] = sec[:max_section_len]
+            if hps.pointer_gen:
+              sections_extend_vocab[i, j, :sec_lens[i, j]] = ex.enc_sections_extend_vocab[j][:max_section_len]
+          self.batch_sections_len_nopad[i, :len(ex.num_words_section_nopad)] = ex.num_words_section_nopad
+        self.enc_section_padding_mask = (np.arange(max_section_len) < sec_lens[:, :, None]).astype(np.float32)
+
+        # the sections side by side, at a stride of max_section_len
+        self.enc_batch = self.batch_sections.reshape(self.batch_size, -1)
+        self.enc_padding_mask = self.enc_section_padding_mask.reshape(self.batch_size, -1)
+        self.enc_lens = sec_lens.sum(axis=1, dtype=np.int32)
+        assert all(self.enc_lens[i] == sum(min(l, max_section_len) for l in ex.enc_sec_len)
+                   for i, ex in enumerate(example_list)), 'enc_lens must be the total length of the sections'
+        if hps.pointer_gen:
+          self.enc_batch_extend_vocab = sections_extend_vocab.reshape(self.batch_size, -1)
 
     def init_decoder_seq(self, example_list, hps):
         """Initializes the following:
@@ -458,28 +504,26 @@ class Batch(object):
               containing 1s and 0s. 1s correspond to real tokens in dec_batch and target_batch;
               0s correspond to padding.
             """
-        # Pad the inputs and targets
-        for ex in example_list:
-            ex.pad_decoder_inp_targ(hps.max_dec_steps, self.pad_id)
-
-        # Initialize the numpy arrays.
+        # Initialize the numpy arrays, the inputs and targets are padded with pad_id.
         # Note: our decoder inputs and targets must be the same length for each batch
         # (second dimension = max_dec_steps) because we do not use a dynamic_rnn for decoding.
         # However I believe this is possible, or will soon be possible, with Tensorflow 1.0,
         # in which case it may be best to upgrade to that.
+        num_examples = len(example_list)
         self.dec_batch = np.zeros(
-            (hps.batch_size, hps.max_dec_steps), dtype=np.int32)
+            (self.batch_size, hps.max_dec_steps), dtype=np.int32)
+        self.dec_batch[:num_examples] = self.pad_id
         self.target_batch = np.zeros(
-            (hps.batch_size, hps.max_dec_steps), dtype=np.int32)
-        self.dec_padding_mask = np.zeros(
-            (hps.batch_size, hps.max_dec_steps), dtype=np.float32)
+            (self.batch_size, hps.max_dec_steps), dtype=np.int32)
+        self.target_batch[:num_examples] = self.pad_id
+        dec_lens = np.zeros((self.batch_size), dtype=np.int32)
 
         # Fill in the numpy arrays
         for i, ex in enumerate(example_list):
-            self.dec_batch[i, :] = ex.dec_input[:]
-            self.target_batch[i, :] = ex.target[:]
-            for j in xrange(ex.dec_len):
-                self.dec_padding_mask[i][j] = 1
+            self.dec_batch[i, :ex.dec_len] = ex.dec_input
+            self.target_batch[i, :len(ex.target)] = ex.target
+            dec_lens[i] = ex.dec_len
+        self.dec_padding_mask = (np.arange(hps.max_dec_steps) < dec_lens[:, None]).astype(np.float32)
 
     def store_orig_strings(self, example_list):
         """Store the original article and abstract strings in the Batch object"""
@@ -492,19 +536,334 @@ class Batch(object):
         self.article_ids = [ex.article_id for ex in example_list]
 
 
+def id_cache_key(vocab, hps):
+  """Returns the key of the token id cache for a vocabulary and the hyperparameters in ID_CACHE_HPARAMS"""
+  h = hashlib.sha1(vocab.fingerprint().encode('utf-8'))
+  h.update(('version=%d;' % ID_CACHE_VERSION).encode('utf-8'))
+  for k in ID_CACHE_HPARAMS:
+    h.update(('%s=%r;' % (k, getattr(hps, k))).encode('utf-8'))
+  return h.hexdigest()[:16]
+
+
+def id_cache_path(data_file, key):
+  """Returns the token id cache directory of a datafile"""
+  return '%s.%s%s' % (data_file, key, ID_CACHE_SUFFIX)
+
+
+def _save_ragged(cache_dir, name, seqs, dtype):
+  """Saves a list of sequences as one flat array (name.npy) and the offsets of the sequences in it (name_offsets.npy)"""
+  offsets = np.zeros(len(seqs) + 1, dtype=np.int64)
+  np.cumsum([len(e) for e in seqs], out=offsets[1:])
+  flat = np.concatenate([np.asarray(e, dtype=dtype) for e in seqs]) if seqs else np.zeros(0, dtype=dtype)
+  np.save(os.path.join(cache_dir, name + '.npy'), flat)
+  np.save(os.path.join(cache_dir, name + '_offsets.npy'), offsets)
+
+
+class _RaggedWriter(object):
+  """Streams sequences of a fixed size dtype to a flat array file, so that they are never all in memory.
+  close() saves them like _save_ragged."""
+
+  def __init__(self, cache_dir, name, dtype):
+    self._path = os.path.join(cache_dir, name)
+    self._dtype = np.dtype(dtype)
+    self._file = open(self._path + '.raw', 'wb')
+    self._lengths = []
+
+  def add(self, seq):
+    seq = np.asarray(seq, dtype=self._dtype)
+    seq.tofile(self._file)
+    self._lengths.append(len(seq))
+
+  def close(self):
+    self._file.close()
+    offsets = np.zeros(len(self._lengths) + 1, dtype=np.int64)
+    np.cumsum(self._lengths, out=offsets[1:])
+    if offsets[-1]:
+      flat = np.lib.format.open_memmap(self._path + '.npy', mode='w+', dtype=self._dtype, shape=(int(offsets[-1]),))
+      flat[:] = np.memmap(self._path + '.raw', dtype=self._dtype, mode='r')
+      flat.flush()
+      del flat
+    else: # empty arrays can't be memory-mapped
+      np.save(self._path + '.npy', np.zeros(0, dtype=self._dtype))
+    os.remove(self._path + '.raw')
+    np.save(self._path + '_offsets.npy', offsets)
+
+
+def _load_array(fpath):
+  try:
+    return np.load(fpath, mmap_mode='r')
+  except ValueError: # empty arrays can't be memory-mapped
+    return np.load(fpath)
+
+
+def write_id_cache(examples, cache_dir, hps):
+  """Writes the token ids of Examples to a cache directory, to be read back by IdCache.
+
+  Each variable length field (enc_input, abs_ids, article_oovs, ...) is stored as a flat
+  array and an offsets array. In hier mode the section ids are stored per section, and
+  doc_sections holds the offsets of the sections of each document.
+
+  Args:
+    examples: iterable of Example objects
+    cache_dir: the directory to write. It is written under a temporary name and renamed when complete.
+    hps: hyperparameters
+  """
+  tmp_dir = '%s.tmp%d' % (cache_dir, os.getpid())
+  os.makedirs(tmp_dir)
+  # the token ids are streamed to the arrays, only the small per document fields are kept in memory
+  fields = dict((name, _RaggedWriter(tmp_dir, name, np.int32)) for name in (
+    'enc_input', 'abs_ids', 'enc_input_extend_vocab', 'abs_ids_extend_vocab', 'section_ids',
+    'section_ids_extend_vocab'))
+  article_oovs = []
+  article_ids = []
+  doc_sections = [0]
+  num_words_section_nopad = []
+  for ex in examples:
+    article_ids.append(ex.article_id)
+    fields['enc_input'].add(ex.enc_input)
+    fields['abs_ids'].add(ex.abs_ids)
+    if hps.pointer_gen:
+      fields['enc_input_extend_vocab'].add(ex.enc_input_extend_vocab)
+      fields['abs_ids_extend_vocab'].add(ex.abs_ids_extend_vocab)
+      article_oovs.append(ex.article_oovs)
+    if hps.hier:
+      for section in ex.enc_sections:
+        fields['section_ids'].add(section)
+      if hps.pointer_gen:
+        for section in ex.enc_sections_extend_vocab:
+          fields['section_ids_extend_vocab'].add(section)
+      doc_sections.append(doc_sections[-1] + len(ex.enc_sections))
+      num_words_section_nopad.extend(ex.num_words_section_nopad)
+
+  for writer in fields.values():
+    writer.close()
+  _save_ragged(tmp_dir, 'article_oovs', article_oovs, np.str_)
+  np.save(os.path.join(tmp_dir, 'article_ids.npy'), np.array(article_ids, dtype=np.str_))
+  np.save(os.path.join(tmp_dir, 'doc_sections.npy'), np.array(doc_sections, dtype=np.int64))
+  np.save(os.path.join(tmp_dir, 'num_words_section_nopad.npy'), np.array(num_words_section_nopad, dtype=np.int32))
+  try:
+    os.rename(tmp_dir, cache_dir)
+  except OSError: # another process has written the same cache in the meantime
+    for fname in os.listdir(tmp_dir):
+      os.remove(os.path.join(tmp_dir, fname))
+    os.rmdir(tmp_dir)
+
+
+class IdCache(object):
+  """Token ids of the Examples of a datafile, as written by write_id_cache. The arrays are memory-mapped."""
+
+  def __init__(self, cache_dir):
+    self._arrays = {}
+    for fname in os.listdir(cache_dir):
+      if fname.endswith('.npy'):
+        self._arrays[fname[:-len('.npy')]] = _load_array(os.path.join(cache_dir, fname))
+    self.article_ids = self._arrays['article_ids']
+
+  def __len__(self):
+    return len(self.article_ids)
+
+  def _seq(self, name, i):
+    offsets = self._arrays[name + '_offsets']
+    return np.array(self._arrays[name][offsets[i]:offsets[i + 1]])
+
+  def example(self, i, vocab, hps):
+    """Returns the Example at position i"""
+    enc_input_extend_vocab, abs_ids_extend_vocab, article_oovs = None, None, None
+    enc_sections, enc_sections_extend_vocab, num_words_section_nopad = None, None, None
+    if hps.pointer_gen:
+      enc_input_extend_vocab = self._seq('enc_input_extend_vocab', i)
+      abs_ids_extend_vocab = self._seq('abs_ids_extend_vocab', i)
+      article_oovs = self._seq('article_oovs', i).tolist()
+    if hps.hier:
+      begin, end = self._arrays['doc_sections'][i:i + 2].tolist()
+      enc_sections = [self._seq('section_ids', j) for j in xrange(begin, end)]
+      if hps.pointer_gen:
+        enc_sections_extend_vocab = [self._seq('section_ids_extend_vocab', j) for j in xrange(begin, end)]
+      num_words_section_nopad = self._arrays['num_words_section_nopad'][begin:end].tolist()
+    return Example.from_ids(str(self.article_ids[i]), self._seq('enc_input', i), enc_input_extend_vocab,
+                            article_oovs, self._seq('abs_ids', i), abs_ids_extend_vocab,
+                            enc_sections, enc_sections_extend_vocab, num_words_section_nopad, vocab, hps)
+
+
+def _resident_bytes(obj, seen):
+  """Estimates the memory held by obj and the objects it references (arrays, strings, containers and
+  the fields of Examples and Batches). Objects whose id is in seen are not counted again."""
+  if id(obj) in seen:
+    return 0
+  seen.add(id(obj))
+  size = sys.getsizeof(obj)
+  if isinstance(obj, np.ndarray):
+    if obj.base is not None: # getsizeof only counts the data of arrays that own it
+      size += obj.nbytes
+  elif isinstance(obj, dict):
+    size += sum(_resident_bytes(k, seen) + _resident_bytes(v, seen) for k, v in six.iteritems(obj))
+  elif isinstance(obj, (list, tuple, set)):
+    size += sum(_resident_bytes(e, seen) for e in obj)
+  elif isinstance(obj, (Example, Batch)):
+    fields = Example.__slots__ if isinstance(obj, Example) else vars(obj)
+    size += sum(_resident_bytes(getattr(obj, f), seen) for f in fields if hasattr(obj, f))
+  return size
+
+
+def _pack_by_tokens(examples, batch_tokens, max_dec_steps):
+  """Groups Examples sorted by encoder length into batches of at most batch_tokens padded tokens.
+
+  A batch of n Examples takes n * (longest enc_len + max_dec_steps) tokens, since the encoder inputs are
+  padded to the longest one and the decoder inputs to max_dec_steps. An Example longer than the budget
+  makes a batch of its own.
+
+  Args:
+    examples: list of Examples, sorted by enc_len
+    batch_tokens: maximum number of padded tokens of a batch
+    max_dec_steps: length of the decoder inputs
+
+  Returns:
+    batches: list of lists of Examples"""
+  batches = []
+  batch = []
+  for ex in examples:
+    if batch and (len(batch) + 1) * (ex.enc_len + max_dec_steps) > batch_tokens:
+      batches.append(batch)
+      batch = []
+    batch.append(ex)
+  if batch:
+    batches.append(batch)
+  return batches
+
+
+
+def _batch_bytes_bound(hps):
+  """Returns an upper bound of the bytes of the arrays of a Batch of hps, including the alignment of the arrays
+  in a shared buffer (see _batch_to_buffer). Batches of token-budget batching are bounded by their budget."""
+  if hps.batch_tokens:
+    rows = max(1, hps.batch_tokens // max(1, hps.max_dec_steps))
+    enc_tokens = max(hps.batch_tokens, hps.max_enc_steps)
+  else:
+    rows = hps.batch_size
+    enc_tokens = rows * (hps.num_sections * hps.max_section_len if hps.hier else hps.max_enc_steps)
+  # int32 and float32 arrays: 3 of encoder length, 3 of decoder length and 2 of sections length
+  num_bytes = 3 * 4 * enc_tokens + 4 * rows + 3 * 4 * rows * hps.max_dec_steps
+  if hps.hier:
+    num_bytes += 2 * 4 * rows * hps.num_sections * hps.max_section_len + 3 * 4 * rows * hps.num_sections
+  return num_bytes + 8 * 32
+
+
+def _batch_to_buffer(batch, buf):
+  """Copies the arrays of a Batch into the shared buffer buf, 8-byte aligned.
+
+  Returns:
+    (layout, fields): the (name, dtype, shape, offset) of the arrays in buf, and the other attributes of the
+    batch, or None if the arrays don't fit in buf"""
+  layout = []
+  fields = {}
+  offset = 0
+  for k, v in six.iteritems(vars(batch)):
+    if k == '_hps':
+      continue
+    if not isinstance(v, np.ndarray):
+      fields[k] = v
+      continue
+    offset = -(-offset // 8) * 8
+    if offset + v.nbytes > len(buf):
+      return None
+    if v.size:
+      np.frombuffer(buf, dtype=v.dtype, count=v.size, offset=offset).reshape(v.shape)[...] = v
+    layout.append((k, v.dtype.str, v.shape, offset))
+    offset += v.nbytes
+  return layout, fields
+
+
+def _batch_from_buffer(layout, fields, buf, hps):
+  """Returns the Batch written by _batch_to_buffer, whose arrays are views of buf (nothing is copied)"""
+  batch = Batch.__new__(Batch)
+  batch.__dict__.update(fields)
+  batch._hps = hps
+  for k, dtype, shape, offset in layout:
+    count = int(np.prod(shape))
+    if count:
+      v = np.frombuffer(buf, dtype=dtype, count=count, offset=offset).reshape(shape)
+    else:
+      v = np.zeros(shape, dtype=dtype)
+    setattr(batch, k, v)
+  return batch
+
+
+class _HandedOutUnits(object):
+    """The units of work of a worker process of a process-pool Batcher: they are handed out by the
+    data.WorkUnits of the parent through a queue, which also keeps the reader cursor. Stands in for
+    data.WorkUnits in the readers of the worker.
+
+    The worker reads one unit at a time. It reports the unit it starts and the unit it finishes to the
+    parent, and waits for the parent to register them, so that the cursor of the parent always holds
+    the unread part of the unit. The records read are counted in progress, in shared memory."""
+
+    def __init__(self, unit_queue, reports, acks, progress, idx):
+        self._unit_queue = unit_queue
+        self._reports = reports
+        self._acks = acks
+        self._progress = progress
+        self._idx = idx
+        self.epoch = 0
+
+    def next(self):
+        return self._unit_queue.get()
+
+    def track(self, unit, ranges):
+        self._progress[0] = 0
+        self._reports.put((self._idx, unit, ranges))
+        self._acks.get()
+        return self._progress
+
+    def done(self, progress):
+        self._reports.put((self._idx, None, None))
+        self._acks.get()
+
+
+class _RetiringUnits(object):
+    """The units of work of an example queue thread of a Batcher, taken from the shared data.WorkUnits
+    until the thread is retired: then the thread reads no further unit, and its generators end."""
+
+    def __init__(self, work_units, retired):
+        self._work_units = work_units
+        self._retired = retired
+
+    def next(self):
+        if self._retired.is_set():
+            return None
+        return self._work_units.next()
+
+    def track(self, unit, ranges):
+        return self._work_units.track(unit, ranges)
+
+    def done(self, progress):
+        self._work_units.done(progress)
+
+
 class Batcher(object):
     """A class to generate minibatches of data. Buckets examples together based on length of the encoder sequence."""
 
     BATCH_QUEUE_MAX = 100  # max number of batches the batch_queue can hold
+    SLOTS_PER_PROCESS = 4  # shared batch buffers per worker process (with hps.batcher_processes)
+    AUTOSCALE_INTERVAL = 10  # secs between the decisions of the autoscaling thread (with hps.batcher_autoscale)
+    AUTOSCALE_STARVED = 0.05  # fraction of the time waiting in next_batch above which a thread is added
+    AUTOSCALE_LOW = 0.1  # example queue fill under which the example queue threads run short
+    AUTOSCALE_HIGH = 0.9  # batch queue fill above which a thread is retired
 
     def __init__(self, data_path, vocab, hps, single_pass,
                  article_id_key,
                  article_key, abstract_key,
                  labels_key,
                  section_names_key,
-                 sections_key):
+                 sections_key,
+                 cursor_path=None,
+                 work_units=None,
+                 reader_offset=0):
         """Initialize the batcher. Start threads that process the data into batches.
 
+        With hps.batcher_processes (not in single_pass mode), worker processes process the data into
+        batches instead of threads, each running a Batcher of its own, and hand them over through shared
+        memory (see _start_processes).
+
         Args:
           data_path: tf.Example filepattern.
           vocab: Vocabulary object
@@ -518,11 +877,23 @@ class Batcher(object):
           labels_key: labels feature key in tf.Example,
           section_names_key: section names key in tf.Example,
           sections_key: sections key in tf.Example,
+          cursor_path: If given and it exists, a reader cursor saved by save_cursor,
+          from which the reading of the dataset continues.
+          work_units: If given, the units of work to read instead of the whole dataset, with a single
+          thread of each kind (used by the worker processes).
+          reader_offset: reader index of the first example queue thread (see data.reader_seed). The
+          worker processes, which read with a single thread, pass their own index.
         """
         self._data_path = data_path
         self._vocab = vocab
         self._hps = hps
         self._single_pass = single_pass
+        self._reader_offset = reader_offset
+
+        # Telemetry of the pipeline, summarized by summary()
+        self._stats = collections.Counter()
+        self._stats_lock = Lock()
+        self._summary_time = time.time()
 
         # Initialize a queue of Batches waiting to be used, and a queue of
         # Examples waiting to be batched
@@ -549,31 +920,74 @@ class Batcher(object):
             # this will tell us when we're finished reading the dataset
             self._finished_reading = False
         else:
-            self._num_example_q_threads = 16  # num threads to fill example queue
-            self._num_batch_q_threads = 4  # num threads to fill batch queue
+            self._num_example_q_threads = hps.example_threads  # num threads to fill example queue
+            self._num_batch_q_threads = hps.batch_threads  # num threads to fill batch queue
             # how many batches-worth of examples to load into cache before
             # bucketing
             self._bucketing_cache_size = 100
 
+        self._num_processes = 0
+        if work_units is not None:
+            self._num_example_q_threads = 1
+            self._num_batch_q_threads = 1
+        elif hps.batcher_processes and not single_pass:
+            self._num_processes = hps.batcher_processes
+        # With hps.batcher_autoscale, the thread counts above are the maximums, see _autoscale
+        self._autoscale = hps.batcher_autoscale and not single_pass and work_units is None
+
+        # With the token id cache, Examples are loaded from the cache
+        # directories of the datafiles instead of being processed from text.
+        # Caches that don't exist yet for this vocab and hps are built first.
+        # Decoding needs the original text, so it always reads the datafiles.
+        self._id_cache_key = None
+        num_records = None
+        if hps.id_cache and hps.mode != 'decode':
+            self._id_cache_key = id_cache_key(vocab, hps)
+            for f in sorted(data.list_datafiles(data_path)):
+                if not os.path.isdir(id_cache_path(f, self._id_cache_key)):
+                    self._build_id_cache(f)
+            num_records = lambda f: len(IdCache(id_cache_path(f, self._id_cache_key)))
+
+        # The example queue threads (or worker processes) share the units of work of each epoch,
+        # so that every thread reads a disjoint part of the dataset
+        if work_units is not None:
+            self._work_units = work_units
+        else:
+            self._work_units = data.WorkUnits(
+                data_path, single_pass, self._num_processes or self._num_example_q_threads,
+                seed=hps.shuffle_seed, num_records=num_records)
+        if cursor_path is not None and os.path.exists(cursor_path):
+            self.restore_cursor(cursor_path)
+
+        if self._num_processes:
+            self._start_processes()
+            self._watch_thread = Thread(target=self.watch_processes)
+            self._watch_thread.daemon = True
+            self._watch_thread.start()
+            return
+
         # Start the threads that load the queues
+        self._threads_lock = Lock()  # the thread lists are changed by the watcher and the autoscaling thread
+        self._num_readers = self._reader_offset  # reader index of the next example queue thread
         self._example_q_threads = []
         for _ in xrange(self._num_example_q_threads):
-            self._example_q_threads.append(
-                Thread(target=self._fill_example_queue))
-            self._example_q_threads[-1].daemon = True
-            self._example_q_threads[-1].start()
+            self._example_q_threads.append(self._start_example_thread())
         self._batch_q_threads = []
         for _ in xrange(self._num_batch_q_threads):
-            self._batch_q_threads.append(Thread(target=self._fill_batch_queue))
-            self._batch_q_threads[-1].daemon = True
-            self._batch_q_threads[-1].start()
+            self._batch_q_threads.append(self._start_thread(self._fill_batch_queue))
+        self._consumer_wait = 0.0  # total secs that next_batch waited for the batch queue
+        self._num_consumed = 0  # number of batches taken by next_batch
 
         # Start a thread that watches the other threads and restarts them if
         # they're dead
-        if not single_pass:  # We don't want a watcher in single_pass mode because the threads shouldn't run forever
+        if not single_pass and work_units is None:  # We don't want a watcher in single_pass mode because the threads shouldn't run forever
             self._watch_thread = Thread(target=self.watch_threads)
             self._watch_thread.daemon = True
             self._watch_thread.start()
+        if self._autoscale:
+            self._autoscale_thread = Thread(target=self._autoscale_threads)
+            self._autoscale_thread.daemon = True
+            self._autoscale_thread.start()
 
     def next_batch(self):
         """Return a Batch from the batch queue.
@@ -581,9 +995,15 @@ class Batcher(object):
         If mode='decode' then each batch contains a single example 
         repeated beam_size-many times; this is necessary for beam search.
 
+        With worker processes, the arrays of the batch are views of a shared buffer that is reused
+        once next_batch is called again, so a batch can't be kept beyond the next call.
+
         Returns:
           batch: a Batch object, or None if we're in single_pass mode and we've exhausted the dataset.
         """
+        if self._num_processes:
+            return self._next_shared_batch()
+
         # If the batch queue is empty, print a warning
         if self._batch_queue.qsize() == 0:
             tfv1.logging.warning(
@@ -596,23 +1016,217 @@ class Batcher(object):
                     "Finished reading dataset in single_pass mode.")
                 return None
 
+        t0 = time.time()
         batch = self._batch_queue.get()  # get the next Batch
+        waited = time.time() - t0
+        self._consumer_wait += waited
+        self._num_consumed += 1
+        self._record(next_batch_wait_secs=waited)
         return batch
 
-    def _fill_example_queue(self):
-        """Reads data from file and processes into Examples which are then placed into the example queue."""
+    def _next_shared_batch(self):
+        """Returns the next Batch built by the worker processes, whose arrays are views of its slot"""
+        if self._held_slot is not None: # the previous batch is done with
+            self._free_slots.put(self._held_slot)
+            self._held_slot = None
+        if self._ready_batches.empty():
+            tfv1.logging.warning('Bucket input queue is empty when calling next_batch. Batcher processes: %i',
+                                 self._num_processes)
+        t0 = time.time()
+        slot, layout, fields, stats = self._ready_batches.get()
+        self._record(next_batch_wait_secs=time.time() - t0, **stats)
+        batch = _batch_from_buffer(layout, fields, None if slot is None else self._slots[slot], self._hps)
+        self._held_slot = slot
+        return batch
 
-        input_gen = self.text_generator(
-            data.example_generator(self._data_path, self._single_pass))
-        cnt = 0
-        fail = 0
+    def _start_processes(self):
+        """Starts the worker processes, and a thread that hands out the units of work to them.
+
+        The workers are forked before the model and its session exist, so they share the vocab without
+        pickling it. Each builds batches with a Batcher of its own (see _process_main) and writes their
+        arrays into a free slot, one of the shared buffers of _batch_bytes_bound(hps) bytes. The trainer
+        reads them in place, and frees the slot when it asks for the next batch."""
+        self._mp = multiprocessing.get_context('fork')
+        num_slots = self.SLOTS_PER_PROCESS * self._num_processes
+        self._slots = [self._mp.RawArray('b', _batch_bytes_bound(self._hps)) for _ in xrange(num_slots)]
+        self._free_slots = self._mp.Queue()
+        for slot in xrange(num_slots):
+            self._free_slots.put(slot)
+        self._ready_batches = self._mp.Queue()
+        self._held_slot = None
+        self._unit_queue = self._mp.Queue(self._num_processes)
+        self._unit_reports = self._mp.Queue()
+        self._unit_acks = [self._mp.Queue() for _ in xrange(self._num_processes)]
+        self._unit_progress = [self._mp.RawArray('q', 1) for _ in xrange(self._num_processes)]
+        self._units_lock = Lock()
+        self._queued_units = []
+        self._processes = [self._start_process(idx) for idx in xrange(self._num_processes)]
+        tf.logging.info('Started %d batcher processes with %d slots of %.1f MB',
+                        self._num_processes, num_slots, len(self._slots[0]) / 2.0**20)
+        for target in (self._hand_out_units, self._collect_unit_reports):
+            thread = Thread(target=target)
+            thread.daemon = True
+            thread.start()
+
+    def _start_process(self, idx):
+        process = self._mp.Process(target=self._process_main, args=(idx,))
+        process.daemon = True
+        process.start()
+        return process
+
+    def _hand_out_units(self):
+        """Puts the units of work of the dataset in the unit queue of the worker processes. The units in
+        the queue stay in the cursor as unread, until a worker reports that it reads them."""
+        while True:
+            with self._units_lock:
+                unit = self._work_units.next()
+                self._queued_units.append((unit, self._work_units.track(unit, [unit[1:]])))
+            self._unit_queue.put(unit)
+
+    def _collect_unit_reports(self):
+        """Registers the units that the worker processes start and finish reading (see _HandedOutUnits)
+        in the cursor, in place of the units in the unit queue"""
+        while True:
+            idx, unit, ranges = self._unit_reports.get()
+            progress = self._unit_progress[idx]
+            with self._units_lock:
+                if unit is None:
+                    self._work_units.done(progress)
+                else:
+                    queued = next(i for i, (u, _) in enumerate(self._queued_units) if u == tuple(unit))
+                    self._work_units.done(self._queued_units.pop(queued)[1])
+                    self._work_units.track(unit, ranges, progress)
+            self._unit_acks[idx].put(None)
+
+    def _process_main(self, idx):
+        """Runs in worker process idx: builds batches from the units of work handed out by the parent,
+        and passes them through the free slots, with the telemetry counters of its pipeline. Batches too
+        big for a slot are pickled instead."""
+        random.seed() # the workers shuffle their batches differently
+        batcher = Batcher(self._data_path, self._vocab, self._hps, False,
+                          self._article_id_key, self._article_key, self._abstract_key, self._labels_key,
+                          self._section_names_key, self._sections_key,
+                          work_units=_HandedOutUnits(self._unit_queue, self._unit_reports, self._unit_acks[idx],
+                                                     self._unit_progress[idx], idx),
+                          reader_offset=idx)
+        while True:
+            batch = batcher._batch_queue.get()
+            slot = self._free_slots.get()
+            written = _batch_to_buffer(batch, self._slots[slot])
+            stats = dict(batcher._take_stats()) # the telemetry of the pipeline is summarized by the parent
+            if written is None:
+                self._free_slots.put(slot)
+                fields = dict((k, v) for k, v in six.iteritems(vars(batch)) if k != '_hps')
+                self._ready_batches.put((None, [], fields, stats))
+            else:
+                self._ready_batches.put((slot,) + written + (stats,))
+
+    def _record(self, **values):
+        """Adds values to the telemetry counters of the pipeline"""
+        with self._stats_lock:
+            self._stats.update(values)
+
+    def _take_stats(self):
+        """Returns the telemetry counters and resets them"""
+        with self._stats_lock:
+            stats, self._stats = self._stats, collections.Counter()
+        return stats
+
+    def summary(self):
+        """Returns a tf.Summary of the telemetry of the pipeline since the previous call, to tell the
+        training steps limited by the input pipeline apart from the steps limited by the model.
+
+        It holds the numbers of records read, of records filtered out by each rule of _example_generator,
+        of Examples and Batches built and their mean build time, the current depths of the queues, and
+        how long next_batch waited for batches, also as a fraction of the elapsed time. With worker
+        processes, the counters of the workers come with their batches and the batch queue depth is
+        the number of batches ready."""
+        stats = self._take_stats()
+        now = time.time()
+        elapsed, self._summary_time = now - self._summary_time, now
+        values = dict((k, stats[k]) for k in (
+            'records_read', 'filtered_broken_sentence', 'filtered_few_sections', 'filtered_long_article',
+            'filtered_abstract_len', 'filtered_discarded', 'examples', 'batches', 'next_batch_wait_secs'))
+        values['example_build_ms'] = 1000 * stats['example_secs'] / max(1, stats['examples'])
+        values['batch_build_ms'] = 1000 * stats['batch_secs'] / max(1, stats['batches'])
+        values['next_batch_wait_fraction'] = stats['next_batch_wait_secs'] / max(elapsed, 1e-6)
+        if self._num_processes:
+            values['batch_queue'] = self._ready_batches.qsize()
+        else:
+            values['example_queue'] = self._example_queue.qsize()
+            values['batch_queue'] = self._batch_queue.qsize()
+        summary = tfv1.Summary()
+        for k, v in sorted(values.items()):
+            summary.value.add(tag='batcher/' + k.replace('filtered_', 'filtered/'), simple_value=v)
+        return summary
+
+    def cursor(self):
+        """Returns the position of the reader threads in the dataset, as a JSON-serializable dict.
+
+        It holds the epoch, the units of work left in it (see data.WorkUnits) including the unread
+        part of the units being read, and the state of the random generator of the next epochs.
+        Examples that were read but are still in the queues or shuffle buffers are not part of
+        it, so a restored Batcher skips them rather than replaying already seen examples. With worker
+        processes, the units in their unit queue are part of it as unread."""
+        if self._num_processes:
+            with self._units_lock:
+                work_units = self._work_units.state()
+        else:
+            work_units = self._work_units.state()
+        return {'data_path': self._data_path,
+                'id_cache_key': self._id_cache_key,
+                'work_units': work_units}
+
+    def save_cursor(self, path):
+        """Writes the cursor to path (atomically, so that a crash leaves the previous cursor)"""
+        tmp_path = '%s.tmp' % path
+        with open(tmp_path, 'w') as f:
+            json.dump(self.cursor(), f)
+        os.rename(tmp_path, path)
+
+    def restore_cursor(self, path):
+        """Continues reading from the cursor saved at path, unless it was saved for other data"""
+        with open(path) as f:
+            cursor = json.load(f)
+        if cursor['data_path'] != self._data_path or cursor['id_cache_key'] != self._id_cache_key:
+            tf.logging.warning('Ignoring reader cursor %s, saved for data %s (token id cache %s)',
+                               path, cursor['data_path'], cursor['id_cache_key'])
+            return
+        self._work_units.restore(cursor['work_units'])
+        tf.logging.info('Restored reader cursor %s: epoch %d, %d units of work left in it',
+                        path, self._work_units.epoch, len(cursor['work_units']['units']))
+
+    def _start_thread(self, target, *args):
+        """Starts a daemon thread running target(retired, *args), where retired is an Event that asks the thread to stop"""
+        retired = Event()
+        t = Thread(target=target, args=(retired,) + args)
+        t.retired = retired
+        t.daemon = True
+        t.start()
+        return t
+
+    def _start_example_thread(self):
+        """Starts an example queue thread. Every thread gets its own reader index, which seeds its shuffling (see data.reader_seed)"""
+        self._num_readers += 1
+        return self._start_thread(self._fill_example_queue, self._num_readers - 1)
+
+    def _fill_example_queue(self, retired, reader_index):
+        """Reads data from file and processes into Examples which are then placed into the example queue.
+        Once retired is set, the thread stops after the unit of work it is reading."""
+
+        work_units = _RetiringUnits(self._work_units, retired)
+        seed = data.reader_seed(self._hps.shuffle_seed, reader_index)
+        if self._id_cache_key is not None:
+            example_gen = self._cached_example_generator(work_units, seed)
+        else:
+            example_gen = self._example_generator(work_units, seed=seed)
         while True:
             try:
-                # read the next example from file. article and abstract are
-                # both strings.
-                (article_id, article_text, abstract_sents, labels,
-                 section_names, sections) = six.next(input_gen)
+                example = six.next(example_gen)
             except StopIteration:  # if there are no more examples:
+                if retired.is_set():
+                    tf.logging.info('Retired an example queue thread.')
+                    break
                 tf.logging.info(
                     "The example generator for this example queue filling thread has exhausted data.")
                 if self._single_pass:
@@ -623,6 +1237,26 @@ class Batcher(object):
                 else:
                     raise Exception(
                         "single_pass mode is off but the example generator is out of data; error.")
+            # place the Example in the example queue.
+            self._example_queue.put(example)
+
+    def _example_generator(self, work_units, shuffle=True, seed=None):
+        """Reads documents from the datafiles of work_units, filters them and processes them into Examples.
+        If shuffle is True, the documents are read with the shuffle buffer and block shuffling of the hps,
+        seeded with seed."""
+        if shuffle:
+            example_gen = data.example_generator(
+                self._data_path, self._single_pass, work_units, self._hps.shuffle_buffer_size,
+                self._hps.shuffle_block_size, seed)
+        else:
+            example_gen = data.example_generator(self._data_path, self._single_pass, work_units)
+        input_gen = self.text_generator(example_gen)
+        cnt = 0
+        fail = 0
+        # read the next example from file. article and abstract are
+        # both strings.
+        for (article_id, article_text, abstract_sents, labels,
+             section_names, sections, num_sections, section_roles) in input_gen:
 
             # Use the <s> and </s> tags in abstract to get a list of sentences.
 #       abstract_sentences = [sent.strip() for sent in data.abstract2sents(''.join(abstract_sents))]
@@ -631,43 +1265,89 @@ class Batcher(object):
 
             
             # at least 2 sections, some articles do not have sections
-            if "_ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ __ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _" in article_text:
-              continue 
-            
-            if len(sections) <= 1:
+            # (see data.keep_document, datafiles written by the converters don't have these documents)
+            self._record(records_read=1)
+            if data.BROKEN_SENTENCE in article_text:
+              self._record(filtered_broken_sentence=1)
               continue
             
-            if not sections or len(sections) == 0:
+            if num_sections <= 1:
+              self._record(filtered_few_sections=1)
               continue
             # do not process that are too long
             if len(article_text) > self._hps.max_article_sents:
+              self._record(filtered_long_article=1)
               continue
               
             # Do not process documents with unusually long or short abstracts
             abst_len = len(' '.join(abstract_sentences).split())
             if abst_len > self._hps.max_abstract_len or\
                     abst_len < self._hps.min_abstract_len:
+                self._record(filtered_abstract_len=1)
                 continue
             
             # Process into an Example.
+            t0 = time.time()
             example = Example(article_text, abstract_sentences, article_id, sections, section_names, labels,
-                              self._vocab, self._hps)
-            # place the Example in the example queue.
+                              self._vocab, self._hps, section_roles)
+            self._record(examples=1, example_secs=time.time() - t0)
             if example.discard:
+              self._record(filtered_discarded=1)
               fail += 1
             cnt += 1
-            if example is not None and not example.discard:
-              self._example_queue.put(example)
+            if not example.discard:
+              yield example
             if cnt % 100 == 0:
               print('total in queue: {} of {}'.format(cnt - fail, cnt))
 
-    def _fill_batch_queue(self):
+    def _build_id_cache(self, data_file):
+        """Processes the documents of a datafile into Examples once and writes their token ids to its cache directory"""
+        cache_dir = id_cache_path(data_file, self._id_cache_key)
+        tf.logging.info('Building token id cache %s...', cache_dir)
+        t0 = time.time()
+        work_units = data.WorkUnits(glob.escape(data_file), single_pass=True)
+        write_id_cache(self._example_generator(work_units, shuffle=False), cache_dir, self._hps)
+        tf.logging.info('Built token id cache %s in %.1f secs', cache_dir, time.time() - t0)
+
+    def _cached_example_generator(self, work_units, seed=None):
+        """Generates the Examples of the units of work_units taken by this thread from the token id cache,
+        shuffled like the documents of data.example_generator with the given seed"""
+        hps = self._hps
+        shuffle_buffer_size, shuffle_block_size = 0, 0
+        if not self._single_pass:
+            shuffle_buffer_size, shuffle_block_size = hps.shuffle_buffer_size, hps.shuffle_block_size
+        rng = random.Random(seed)
+
+        def unit_examples():
+            while True:
+                unit = work_units.next()
+                if unit is None:
+                    return
+                cache = IdCache(id_cache_path(unit[0], self._id_cache_key))
+                ranges = data.shuffled_ranges(*unit, block_size=shuffle_block_size, rng=rng,
+                                              num_records=lambda f: len(cache))
+                progress = work_units.track(unit, ranges)
+                for start, stop in ranges:
+                    for i in xrange(start, len(cache) if stop is None else stop):
+                        progress[0] += 1
+                        t0 = time.time()
+                        example = cache.example(i, self._vocab, hps)
+                        self._record(records_read=1, examples=1, example_secs=time.time() - t0)
+                        yield example
+                work_units.done(progress)
+
+        if shuffle_buffer_size > 0:
+            return data.shuffle_buffer(unit_examples(), shuffle_buffer_size, rng)
+        return unit_examples()
+
+    def _fill_batch_queue(self, retired):
         """Takes Examples out of example queue, sorts them by encoder sequence length,
         processes into Batches and places them in the batch queue.
 
         In decode mode, makes batches that each contain a single example repeated.
+        Once retired is set, the thread stops after placing the batches it is making.
         """
-        while True:
+        while not retired.is_set():
             if self._hps.mode != 'decode':
                 # Get bucketing_cache_size-many batches of Examples into a
                 # list, then sort
@@ -679,70 +1359,165 @@ class Batcher(object):
 
                 # Group the sorted Examples into batches, optionally shuffle
                 # the batches, and place in the batch queue.
-                batches = []
-                for i in xrange(0, len(inputs), self._hps.batch_size):
-                    batches.append(inputs[i:i + self._hps.batch_size])
+                if self._hps.batch_tokens:
+                    # as many Examples per batch as fit in the token budget
+                    batches = _pack_by_tokens(inputs, self._hps.batch_tokens, self._hps.max_dec_steps)
+                else:
+                    batches = []
+                    for i in xrange(0, len(inputs), self._hps.batch_size):
+                        batches.append(inputs[i:i + self._hps.batch_size])
                 if not self._single_pass:
                     shuffle(batches)
                 for b in batches:  # each b is a list of Example objects
-                    self._batch_queue.put(Batch(b, self._hps, self._vocab))
+                    t0 = time.time()
+                    batch = Batch(b, self._hps, self._vocab)
+                    self._record(batches=1, batch_secs=time.time() - t0)
+                    self._batch_queue.put(batch)
 
             else:  # beam search decode mode
                 ex = self._example_queue.get()
-                b = [ex for _ in xrange(self._hps.batch_size)]
-                self._batch_queue.put(Batch(b, self._hps, self._vocab))
+                t0 = time.time()
+                batch = Batch.repeated(ex, self._hps, self._vocab)
+                self._record(batches=1, batch_secs=time.time() - t0)
+                self._batch_queue.put(batch)
+
+    def queue_memory(self):
+        """Returns the estimated resident memory in bytes of the examples in the example queue and of the batches in the batch queue"""
+        sizes = []
+        for q in (self._example_queue, self._batch_queue):
+            with q.mutex:
+                items = list(q.queue)
+            sizes.append(_resident_bytes(items, set()))
+        return tuple(sizes)
 
     def watch_threads(self):
-        """Watch example queue and batch queue threads and restart if dead."""
+        """Watch example queue and batch queue threads and restart if dead. Also logs the memory held by the queues."""
         while True:
             time.sleep(60)
-            for idx, t in enumerate(self._example_q_threads):
-                if not t.is_alive():  # if the thread is dead
-                    tf.logging.error(
-                        'Found example queue thread dead. Restarting.')
-                    new_t = Thread(target=self._fill_example_queue)
-                    self._example_q_threads[idx] = new_t
-                    new_t.daemon = True
-                    new_t.start()
-            for idx, t in enumerate(self._batch_q_threads):
-                if not t.is_alive():  # if the thread is dead
-                    tf.logging.error(
-                        'Found batch queue thread dead. Restarting.')
-                    new_t = Thread(target=self._fill_batch_queue)
-                    self._batch_q_threads[idx] = new_t
-                    new_t.daemon = True
-                    new_t.start()
+            example_q_bytes, batch_q_bytes = self.queue_memory()
+            tf.logging.info(
+                'Example queue: %i examples, %.1f MB. Batch queue: %i batches, %.1f MB',
+                self._example_queue.qsize(), example_q_bytes / 2.0**20,
+                self._batch_queue.qsize(), batch_q_bytes / 2.0**20)
+            with self._threads_lock:
+                for idx, t in enumerate(self._example_q_threads):
+                    if not t.is_alive():  # if the thread is dead
+                        tf.logging.error(
+                            'Found example queue thread dead. Restarting.')
+                        self._example_q_threads[idx] = self._start_example_thread()
+                for idx, t in enumerate(self._batch_q_threads):
+                    if not t.is_alive():  # if the thread is dead
+                        tf.logging.error(
+                            'Found batch queue thread dead. Restarting.')
+                        self._batch_q_threads[idx] = self._start_thread(self._fill_batch_queue)
+
+    def _autoscale_threads(self):
+        """Adds and retires example and batch queue threads according to the queue depths and to how
+        long the trainer waits in next_batch, between 1 and the thread counts of the hps.
+
+        Every AUTOSCALE_INTERVAL secs, it looks at the fraction of the time next_batch waited and at the
+        average fill of the queues (sampled every second). If the trainer waited, a thread is added to the
+        stage that runs short: the example queue threads if the example queue is nearly empty, else the
+        batch queue threads. If the trainer took batches without waiting and the batch queue stayed nearly
+        full, a thread is retired, an example queue thread first since they do most of the work. Retired
+        threads finish the unit of work or batches at hand (see _fill_example_queue and _fill_batch_queue)."""
+        hps = self._hps
+        example_q_max = self.BATCH_QUEUE_MAX * hps.batch_size
+        while True:
+            wait0, consumed0 = self._consumer_wait, self._num_consumed
+            example_fill, batch_fill = [], []
+            for _ in xrange(self.AUTOSCALE_INTERVAL):
+                time.sleep(1)
+                example_fill.append(self._example_queue.qsize() / float(example_q_max))
+                batch_fill.append(self._batch_queue.qsize() / float(self.BATCH_QUEUE_MAX))
+            waited = (self._consumer_wait - wait0) / self.AUTOSCALE_INTERVAL
+            example_fill, batch_fill = np.mean(example_fill), np.mean(batch_fill)
+
+            with self._threads_lock:
+                decision = None
+                if waited > self.AUTOSCALE_STARVED:
+                    if example_fill < self.AUTOSCALE_LOW:
+                        if len(self._example_q_threads) < hps.example_threads:
+                            self._example_q_threads.append(self._start_example_thread())
+                            decision = 'added an example queue thread'
+                    elif len(self._batch_q_threads) < hps.batch_threads:
+                        self._batch_q_threads.append(self._start_thread(self._fill_batch_queue))
+                        decision = 'added a batch queue thread'
+                elif (waited < self.AUTOSCALE_STARVED / 10 and batch_fill > self.AUTOSCALE_HIGH and
+                      self._num_consumed > consumed0): # not while the trainer isn't taking batches yet
+                    for threads, kind in ((self._example_q_threads, 'an example queue'),
+                                          (self._batch_q_threads, 'a batch queue')):
+                        if len(threads) > 1:
+                            threads.pop().retired.set()
+                            decision = 'retired %s thread' % kind
+                            break
+                if decision is not None:
+                    tf.logging.info(
+                        'Batcher autoscaling: %s (now %d example and %d batch queue threads). Over the last '
+                        '%d secs the trainer waited %.0f%% of the time for batches, the example queue was %.0f%% '
+                        'full and the batch queue %.0f%% full.', decision, len(self._example_q_threads),
+                        len(self._batch_q_threads), self.AUTOSCALE_INTERVAL, 100 * waited,
+                        100 * example_fill, 100 * batch_fill)
+
+    def watch_processes(self):
+        """Watch the worker processes and restart them if dead. A batch that a dead process was writing
+        takes its slot with it, and the rest of the unit it was reading is dropped from the cursor."""
+        while True:
+            time.sleep(60)
+            tf.logging.info('Batcher processes: %i batches ready', self._ready_batches.qsize())
+            for idx, p in enumerate(self._processes):
+                if not p.is_alive():
+                    tf.logging.error('Found batcher process dead (exit code %s). Restarting.', p.exitcode)
+                    with self._units_lock:
+                        self._work_units.done(self._unit_progress[idx])
+                    self._processes[idx] = self._start_process(idx)
 
     def text_generator(self, example_gen):
-        """Generates article and abstract text from tf.Example."""
-        while True:
-            e = six.next(example_gen)
+        """Generates article and abstract text from tf.Example.
+
+        Only the features that the model configuration consumes are decoded and split:
+        the sections and section names only in hier mode, and the labels never, as no
+        model uses them yet (they are yielded as None). num_sections is always yielded,
+        counted without splitting the sections. section_roles are the positions of the sections
+        of the hier model stored by the converters (see data.section_roles), None if not stored.
+
+        Yields:
+          (article_id, article_text, abstract_text, labels, section_names, sections, num_sections, section_roles)
+        """
+        hier = self._hps.hier
+        for e in example_gen:
+            if isinstance(e, data.ColumnarDocument): # already split into lists
+                yield (e.article_id, e.article_text, e.abstract_sents, None, e.section_names, e.sections,
+                       len(e.sections), e.section_roles)
+                continue
             try:
                 article_id = self._get_example_feature(e, self._article_id_key)
-                article_text = self._get_example_feature(e, self._article_key)
-                abstract_text = self._get_example_feature(
-                    e, self._abstract_key)
-                if not self._hps.pubmed:
-                  labels = self._get_example_feature(e, self._labels_key)
-                section_names = self._get_example_feature(
-                    e, self._section_names_key)
+                abstract_text = _string_to_list(self._get_example_feature(e, self._abstract_key))
                 sections = self._get_example_feature(e, self._sections_key)
-
-                # convert to list
-                article_text = _string_to_list(article_text)
-                abstract_text = _string_to_list(abstract_text)
-                if not self._hps.pubmed:
-                  labels = _string_to_list(labels, dtype='int')
+                num_sections = sections.count(SECTION_SEPARATOR) + 1
+                section_names = None
+                section_roles = None
+
+                # The article is the flattened sections, so when the sections are
+                # split anyway (hier mode, or newer datafiles without article_body)
+                # it is derived from them instead of being decoded a second time
+                if hier or self._article_key not in e.features.feature:
+                  sections = _string_to_nested_list(sections)  # list of lists
+                  article_text = _flatten(sections)
                 else:
-                  labels = None
-                section_names = _string_to_list(section_names)
-                sections = _string_to_nested_list(sections)  # list of lists
+                  sections = None
+                  article_text = _string_to_list(self._get_example_feature(e, self._article_key))
+                if hier:
+                  section_names = _string_to_list(self._get_example_feature(
+                      e, self._section_names_key))
+                  if 'section_roles' in e.features.feature:
+                    section_roles = tuple(e.features.feature['section_roles'].int64_list.value)
             except ValueError:
                 tf.logging.error(
                     'Failed to get article or abstract from example')
                 continue
 
-            yield (article_id, article_text, abstract_text, labels, section_names, sections)
+            yield (article_id, article_text, abstract_text, None, section_names, sections, num_sections, section_roles)
 
     def _get_example_feature(self, ex, key):
         """Extract text for a feature from td.Example.
@@ -0,0 +1,164 @@
+"""This file contains a byte pair encoding (BPE) tokenizer, used to split words into subwords so that a small vocabulary covers the text.
+
+The merges are learned from the word counts of the vocab files written by scripts/json_to_bin.py and scripts/pubmed_write_bin.py (see scripts/learn_bpe.py).
+A segmented word is a sequence of subwords, where all but the last subword end with CONTINUATION, e.g. "summar@@ ization".
+"""
+
+import hashlib
+import heapq
+from collections import Counter, defaultdict
+
+CONTINUATION = '@@' # suffix of the subwords that are continued by the next subword
+END_OF_WORD = '</w>' # marks the last symbol of a word while learning and applying the merges
+
+
+def _symbols(word):
+  return list(word[:-1]) + [word[-1] + END_OF_WORD]
+
+
+def learn_bpe(word_counts, num_merges, min_count=2):
+  """Learns the merges of the byte pair encoding.
+
+  Args:
+    word_counts: iterable of (word, count) pairs
+    num_merges: maximum number of merges to learn
+    min_count: stop when the most frequent pair of symbols occurs less often than this
+
+  Returns:
+    merges: list of pairs of symbols, in the order they were learned"""
+  words = []
+  counts = []
+  for w, c in word_counts:
+    if w:
+      words.append(_symbols(w))
+      counts.append(c)
+
+  stats = Counter() # pair -> count
+  index = defaultdict(set) # pair -> ids of the words that contain it
+  for i, w in enumerate(words):
+    for pair in zip(w, w[1:]):
+      stats[pair] += counts[i]
+      index[pair].add(i)
+  heap = [(-c, pair) for pair, c in stats.items()]
+  heapq.heapify(heap)
+
+  merges = []
+  while heap and len(merges) < num_merges:
+    neg_count, pair = heapq.heappop(heap)
+    if -neg_count != stats.get(pair, 0): # stale entry, the count of the pair changed since it was pushed
+      continue
+    if -neg_count < min_count:
+      break
+    merges.append(pair)
+    first, second = pair
+    merged = first + second
+    changed = set()
+    for i in index.pop(pair):
+      w = words[i]
+      if len(w) < 2:
+        continue
+      c = counts[i]
+      for p in zip(w, w[1:]):
+        stats[p] -= c
+        changed.add(p)
+      new_w = []
+      j = 0
+      while j < len(w):
+        if j < len(w) - 1 and w[j] == first and w[j + 1] == second:
+          new_w.append(merged)
+          j += 2
+        else:
+          new_w.append(w[j])
+          j += 1
+      words[i] = new_w
+      for p in zip(new_w, new_w[1:]):
+        stats[p] += c
+        index[p].add(i)
+        changed.add(p)
+    for p in changed:
+      if stats[p] > 0:
+        heapq.heappush(heap, (-stats[p], p))
+      else:
+        del stats[p]
+  return merges
+
+
+def write_merges(merges, fpath):
+  """Writes the merges to a codes file, one pair of symbols per line"""
+  with open(fpath, 'w', encoding='utf-8') as f:
+    for first, second in merges:
+      f.write('%s %s\n' % (first, second))
+
+
+def merge_subwords(tokens):
+  """Joins the subwords of segmented words back into words"""
+  words = []
+  prefix = ''
+  for t in tokens:
+    if t.endswith(CONTINUATION):
+      prefix += t[:-len(CONTINUATION)]
+    else:
+      words.append(prefix + t)
+      prefix = ''
+  if prefix:
+    words.append(prefix)
+  return words
+
+
+class BPE(object):
+  """Splits words into subwords by applying the merges of a codes file written by write_merges"""
+
+  def __init__(self, codes_file, protected=()):
+    """
+    Args:
+      codes_file: path to the codes file
+      protected: words that are never split, e.g. the special tokens of the vocab"""
+    with open(codes_file, 'rb') as f:
+      raw = f.read()
+    self._fingerprint = hashlib.sha1(raw).hexdigest()
+    self._ranks = {}
+    for line in raw.decode('utf-8').splitlines():
+      pieces = line.split()
+      if len(pieces) == 2:
+        self._ranks.setdefault(tuple(pieces), len(self._ranks))
+    self._cache = {w: [w] for w in protected}
+
+  def num_merges(self):
+    return len(self._ranks)
+
+  def fingerprint(self):
+    """Returns a hash of the codes file"""
+    return self._fingerprint
+
+  def segment_word(self, word):
+    """Returns the subwords of a word"""
+    subwords = self._cache.get(word)
+    if subwords is not None:
+      return subwords
+    symbols = _symbols(word) if word else []
+    ranks = self._ranks
+    while len(symbols) > 1:
+      pair = min(zip(symbols, symbols[1:]), key=lambda p: ranks.get(p, float('inf')))
+      if pair not in ranks:
+        break
+      first, second = pair
+      new_symbols = []
+      j = 0
+      while j < len(symbols):
+        if j < len(symbols) - 1 and symbols[j] == first and symbols[j + 1] == second:
+          new_symbols.append(first + second)
+          j += 2
+        else:
+          new_symbols.append(symbols[j])
+          j += 1
+      symbols = new_symbols
+    subwords = [s + CONTINUATION for s in symbols[:-1]]
+    if symbols:
+      subwords.append(symbols[-1][:-len(END_OF_WORD)])
+    self._cache[word] = subwords
+    return subwords
+
+  def segment(self, words):
+    """Returns the subwords of a list of words"""
+    segment_word = self.segment_word
+    return [s for w in words for s in segment_word(w)]
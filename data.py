@@ -19,9 +19,21 @@ import codecs
 """This file contains code to read the train/eval/test data from file and process it, and read the vocab data from file and process it"""
 
 import glob
+import gzip
+import hashlib
+import json
+import mmap
+import os
 import random
 import struct
 import csv
+import threading
+import zlib
+from collections import namedtuple
+from itertools import chain, repeat
+import numpy as np
+import bpe
+import tensorflow as tf
 from tensorflow.core.example import example_pb2
 
 # <s> and </s> are used in the data files to segment the abstracts into sentences. They don't receive vocab ids.
@@ -36,51 +48,68 @@ STOP_DECODING = '[STOP]' # This has a vocab id, which is used at the end of untr
 
 # Note: none of <s>, </s>, [PAD], [UNK], [START], [STOP] should appear in the vocab file.
 
+# Suffix of the sidecar offset index that is written next to each .bin datafile
+INDEX_SUFFIX = '.idx'
+
+# Magic bytes at the start and end of a block-compressed shard (see CompressedRecordWriter). Read as the
+# <length> prefix of an uncompressed .bin datafile they would be negative, so the two can't be confused.
+COMPRESSED_MAGIC = b'LSBZ\x01\x00\x00\xff'
+# Default number of records per compressed block
+COMPRESSED_BLOCK_SIZE = 64
+
+# Metadata file that marks a directory as a columnar dataset (see ColumnarWriter)
+COLUMNAR_META = 'meta.json'
+COLUMNAR_VERSION = 2
+# Versions of columnar datasets that can be read, version 1 has no section_roles column
+COLUMNAR_READ_VERSIONS = (1, 2)
+
+# Columns of a columnar dataset and their dtypes. Each column is a flat raw array in <name>.<dtype>.
+#   tokens: lexicon ids of the article tokens; sent_offsets: token offsets of the article sentences;
+#   sec_offsets: sentence offsets of the sections; doc_offsets: section offsets of the documents.
+#   The abstract sentences and section names are stored the same way, one level shallower, and labels
+#   has one entry per section name. section_roles has the 4 values of section_roles() per document (-1s if empty).
+COLUMNAR_COLUMNS = [('tokens', 'int32'), ('sent_offsets', 'int64'), ('sec_offsets', 'int64'),
+                    ('doc_offsets', 'int64'), ('abstract_tokens', 'int32'),
+                    ('abstract_sent_offsets', 'int64'), ('abstract_doc_offsets', 'int64'),
+                    ('name_tokens', 'int32'), ('name_offsets', 'int64'), ('doc_name_offsets', 'int64'),
+                    ('labels', 'int32'), ('section_roles', 'int32')]
+
 
 class Vocab(object):
   """Vocabulary class for mapping between words and ids (integers)"""
 
-  def __init__(self, vocab_file, max_size):
+  def __init__(self, vocab_file, max_size, bpe_codes=None):
     """Creates a vocab of up to max_size words, reading from the vocab_file. If max_size is 0, reads the entire vocab file.
 
+    The vocab file can be gzipped. The words read are saved to a binary cache next to the vocab file, one per max_size (see _vocab_cache_path) and keyed by the hash of the file, from which later runs load the vocab without parsing the file.
+
     Args:
       vocab_file: path to the vocab file, which is assumed to contain "<word> <frequency>" on each line, sorted with most frequent word first. This code doesn't actually use the frequencies, though.
-      max_size: integer. The maximum size of the resulting Vocabulary."""
-    self._word_to_id = {}
-    self._id_to_word = {}
-    self._count = 0 # keeps track of total number of words in the Vocab
+      max_size: integer. The maximum size of the resulting Vocabulary.
+      bpe_codes: path to the codes file of a byte pair encoding (see bpe.py), or None. If given, text is split into the subwords of the vocab file by tokenize()."""
+    self._fingerprint = None
+    self.bpe = None if bpe_codes is None else bpe.BPE(bpe_codes, protected=[SENTENCE_START, SENTENCE_END, UNKNOWN_TOKEN, PAD_TOKEN, START_DECODING, STOP_DECODING, SEC_PAD_TOKEN])
+    self._words = None # words in id order, as an object array for ids_to_words
 
     # [SPAD], [UNK], [PAD], [START] and [STOP] get the ids 0,1,2,3.
-    for w in [SEC_PAD_TOKEN, UNKNOWN_TOKEN, PAD_TOKEN, START_DECODING, STOP_DECODING]:
-      self._word_to_id[w] = self._count
-      self._id_to_word[self._count] = w
-      self._count += 1
-      
-    # read vocab file and add words up to the max_size
-    isascii = lambda s: len(s) == len(s.encode())    
-    idx = 0
-    bad_lines = 0
-    # Read the vocab file and add words up to max_size
-    with codecs.open(vocab_file, 'r', encoding='utf-8') as vocab_f:
-      for line in vocab_f:
-        pieces = line.split()
-        if len(pieces) != 2:
-          bad_lines += 1
-          print(('Warning: incorrectly formatted line in vocabulary file: %s\n' % line))
-          continue
-        w = pieces[0]
-        if w in [SENTENCE_START, SENTENCE_END, UNKNOWN_TOKEN, PAD_TOKEN, START_DECODING, STOP_DECODING, SEC_PAD_TOKEN]:
-          raise Exception('<s>, </s>, [UNK], [PAD], [START] and [STOP] shouldn\'t be in the vocab file, but %s is' % w)
-        if w in self._word_to_id:
-          raise Exception('Duplicated word in vocabulary file: %s' % w)
-        self._word_to_id[w] = self._count
-        self._id_to_word[self._count] = w
-        self._count += 1
-        if max_size != 0 and self._count >= max_size:
-          print(("max_size of vocab was specified as %i; we now have %i words. Stopping reading." % (max_size, self._count)))
-          break
-    print('total bad lines: {:d}/{:d}'.format(bad_lines, idx))
+    words = [SEC_PAD_TOKEN, UNKNOWN_TOKEN, PAD_TOKEN, START_DECODING, STOP_DECODING]
+
+    with open(vocab_file, 'rb') as f:
+      raw = f.read()
+    cache_key = '%s:%d' % (hashlib.sha1(raw).hexdigest(), max_size)
+    cached = _load_vocab_cache(vocab_file, max_size, cache_key)
+    if cached is not None:
+      words.extend(cached)
+    else:
+      words.extend(_parse_vocab(raw, max_size, len(words)))
+      _save_vocab_cache(vocab_file, max_size, cache_key, words[5:])
+      if max_size != 0 and len(words) >= max_size:
+        print(("max_size of vocab was specified as %i; we now have %i words. Stopping reading." % (max_size, len(words))))
+    self._word_to_id = dict(zip(words, range(len(words))))
+    self._id_to_word = dict(enumerate(words))
+    self._count = len(words) # keeps track of total number of words in the Vocab
     print(("Finished constructing vocabulary of %i total words. Last word added: %s" % (self._count, self._id_to_word[self._count-1])))
+    self._unk_id = self._word_to_id[UNKNOWN_TOKEN]
 
   def word2id(self, word):
     """Returns the id (integer) of a word (string). Returns [UNK] id if word is OOV."""
@@ -88,6 +117,29 @@ class Vocab(object):
       return self._word_to_id[UNKNOWN_TOKEN]
     return self._word_to_id[word]
 
+  def words2ids(self, words):
+    """Returns the ids of words as a np.int32 array, with the [UNK] id for OOVs.
+
+    Args:
+      words: list of words (strings), or a string of space separated words
+    """
+    if isinstance(words, str):
+      words = words.split()
+    elif not hasattr(words, '__len__'):
+      words = list(words)
+    # map runs the dict lookups in C, without a Python call per word
+    return np.fromiter(map(self._word_to_id.get, words, repeat(self._unk_id)), dtype=np.int32, count=len(words))
+
+  def ids_to_words(self, ids):
+    """Returns the words (list of strings) of an array or list of ids. Raises ValueError if an id is not in the vocab."""
+    ids = np.asarray(ids, dtype=np.int64)
+    bad = (ids < 0) | (ids >= self._count)
+    if bad.any():
+      raise ValueError('Id not found in vocab: %d' % ids[bad].flat[0])
+    if self._words is None:
+      self._words = np.array([self._id_to_word[i] for i in range(self._count)], dtype=object)
+    return self._words[ids].tolist()
+
   def id2word(self, word_id):
     """Returns the word (string) corresponding to an id (integer)."""
     if word_id not in self._id_to_word:
@@ -98,6 +150,26 @@ class Vocab(object):
     """Returns the total size of the vocabulary"""
     return self._count
 
+  def tokenize(self, text):
+    """Splits text into tokens of the vocabulary: words, or subwords in BPE mode"""
+    words = text.split()
+    return words if self.bpe is None else self.bpe.segment(words)
+
+  def detokenize(self, tokens):
+    """Joins tokens of the vocabulary back into words, inverse of tokenize"""
+    return tokens if self.bpe is None else bpe.merge_subwords(tokens)
+
+  def fingerprint(self):
+    """Returns a hash of the words of the vocabulary in id order (and of the BPE codes). Used to key files derived from the vocabulary, such as the token id cache."""
+    if self._fingerprint is None:
+      h = hashlib.sha1()
+      for i in range(self._count):
+        h.update(self._id_to_word[i].encode('utf-8') + b'\n')
+      if self.bpe is not None:
+        h.update(self.bpe.fingerprint().encode('utf-8'))
+      self._fingerprint = h.hexdigest()
+    return self._fingerprint
+
   def write_metadata(self, fpath):
     """Writes metadata file for Tensorboard word embedding visualizer as described here:
       https://www.tensorflow.org/get_started/embedding_viz
@@ -113,51 +185,811 @@ class Vocab(object):
         writer.writerow({"word": self._id_to_word[i].encode('utf-8')})
 
 
-def example_generator(data_path, single_pass):
+# Suffix of the binary cache of the words read from a vocab file (see Vocab)
+VOCAB_CACHE_SUFFIX = '.cache.npz'
+
+
+def _parse_vocab(raw, max_size, count):
+  """Returns the words of the raw (possibly gzipped) contents of a vocab file, stopping when count plus the number of words reaches max_size"""
+  if raw[:2] == b'\x1f\x8b': # gzip magic
+    raw = gzip.decompress(raw)
+  special_tokens = {SENTENCE_START, SENTENCE_END, UNKNOWN_TOKEN, PAD_TOKEN, START_DECODING, STOP_DECODING, SEC_PAD_TOKEN}
+  words = []
+  seen = set()
+  bad_lines = 0
+  num_lines = 0
+  for line in raw.decode('utf-8').splitlines():
+    num_lines += 1
+    pieces = line.split()
+    if len(pieces) != 2:
+      bad_lines += 1
+      if bad_lines <= 10:
+        print(('Warning: incorrectly formatted line in vocabulary file: %s\n' % line))
+      continue
+    w = pieces[0]
+    if w in special_tokens:
+      raise Exception('<s>, </s>, [UNK], [PAD], [START] and [STOP] shouldn\'t be in the vocab file, but %s is' % w)
+    if w in seen:
+      raise Exception('Duplicated word in vocabulary file: %s' % w)
+    seen.add(w)
+    words.append(w)
+    if max_size != 0 and count + len(words) >= max_size:
+      break
+  print('total bad lines: {:d}/{:d}'.format(bad_lines, num_lines))
+  return words
+
+
+def _vocab_cache_path(vocab_file, max_size):
+  """Returns the path of the vocab cache of a vocab file read up to max_size words, so that vocabs of different sizes don't overwrite each other's cache"""
+  return '%s.%d%s' % (vocab_file, max_size, VOCAB_CACHE_SUFFIX)
+
+
+def _load_vocab_cache(vocab_file, max_size, key):
+  """Returns the words saved by _save_vocab_cache, or None if there is no cache for this key"""
+  cache_file = _vocab_cache_path(vocab_file, max_size)
+  if not os.path.exists(cache_file):
+    return None
+  try:
+    with np.load(cache_file) as cache:
+      if str(cache['key']) != key:
+        return None
+      num_words = int(cache['num_words'])
+      words = cache['blob'].tobytes().decode('utf-8').split('\n') if num_words else []
+      if len(words) != num_words:
+        return None
+  except (IOError, OSError, ValueError, KeyError) as e:
+    print('Warning: could not read vocab cache %s: %s' % (cache_file, e))
+    return None
+  return words
+
+
+def _save_vocab_cache(vocab_file, max_size, key, words):
+  """Saves the words read from a vocab file as a blob of the '\\n'-separated words, and their number"""
+  blob = '\n'.join(words).encode('utf-8')
+  cache_file = _vocab_cache_path(vocab_file, max_size)
+  tmp_file = '%s.tmp%d' % (cache_file, os.getpid())
+  try:
+    with open(tmp_file, 'wb') as f:
+      np.savez(f, key=np.array(key), blob=np.frombuffer(blob, dtype=np.uint8), num_words=np.array(len(words)))
+    os.rename(tmp_file, cache_file)
+  except (IOError, OSError) as e: # e.g. read-only vocab directory
+    print('Warning: could not write vocab cache %s: %s' % (cache_file, e))
+
+
+def list_datafiles(data_path):
+  """Returns the datafiles and columnar dataset directories matching the data_path pattern, leaving out sidecar index files and cache directories"""
+  return [f for f in glob.glob(data_path)
+          if (os.path.isfile(f) and not f.endswith(INDEX_SUFFIX)) or is_columnar(f)]
+
+
+def is_columnar(path):
+  """Returns True if path is a columnar dataset directory written by ColumnarWriter"""
+  return os.path.isfile(os.path.join(path, COLUMNAR_META))
+
+
+def index_path(data_file):
+  """Returns the path of the sidecar offset index of a .bin datafile"""
+  return data_file + INDEX_SUFFIX
+
+
+def save_record_index(data_file, offsets, lengths, article_ids):
+  """Writes the sidecar offset index of a .bin datafile.
+
+  Args:
+    data_file: path to the .bin datafile the index describes
+    offsets: byte offset of each serialized tf.Example (just after its <length> prefix)
+    lengths: byte size of each serialized tf.Example
+    article_ids: article id (string) of each record
+  """
+  with open(index_path(data_file), 'wb') as f:
+    np.savez(f,
+             offsets=np.asarray(offsets, dtype=np.int64),
+             lengths=np.asarray(lengths, dtype=np.int64),
+             article_ids=np.asarray(article_ids, dtype=np.str_))
+
+
+def build_record_index(data_file, article_id_key='article_id'):
+  """Scans a .bin datafile once and writes its sidecar offset index.
+
+  Returns:
+    offsets, lengths, article_ids: numpy arrays, as described in save_record_index
+  """
+  offsets, lengths, article_ids = [], [], []
+  with open(data_file, 'rb') as reader:
+    while True:
+      len_bytes = reader.read(8)
+      if not len_bytes: break # finished reading this file
+      str_len = struct.unpack('q', len_bytes)[0]
+      offsets.append(reader.tell())
+      lengths.append(str_len)
+      e = example_pb2.Example.FromString(reader.read(str_len))
+      article_ids.append(e.features.feature[article_id_key].bytes_list.value[0].decode('utf-8', 'ignore'))
+  try:
+    save_record_index(data_file, offsets, lengths, article_ids)
+  except (IOError, OSError) as e: # e.g. read-only data directory, the index is still usable in memory
+    print('Warning: could not write offset index of %s: %s' % (data_file, e))
+  return (np.asarray(offsets, dtype=np.int64), np.asarray(lengths, dtype=np.int64),
+          np.asarray(article_ids, dtype=np.str_))
+
+
+def load_record_index(data_file, build=True):
+  """Loads the sidecar offset index of a .bin datafile.
+
+  If the index is missing or stale (it doesn't cover the datafile exactly) and build is True, it is (re)built from the datafile.
+
+  Returns:
+    offsets, lengths, article_ids: numpy arrays, or None if there is no usable index and build is False
+  """
+  idx_file = index_path(data_file)
+  if os.path.exists(idx_file):
+    with np.load(idx_file) as idx:
+      offsets, lengths, article_ids = idx['offsets'], idx['lengths'], idx['article_ids']
+    end = offsets[-1] + lengths[-1] if len(offsets) else 0
+    if end == os.path.getsize(data_file):
+      return offsets, lengths, article_ids
+    print('Warning: offset index of %s is stale' % data_file)
+  if not build:
+    return None
+  return build_record_index(data_file)
+
+
+class RecordIndexWriter(object):
+  """Keeps track of record offsets while a .bin datafile is written, so that its sidecar index can be saved without reading the datafile again."""
+
+  def __init__(self):
+    self._pos = 0
+    self.offsets = []
+    self.lengths = []
+    self.article_ids = []
+
+  def add(self, str_len, article_id):
+    """Registers a record of str_len bytes that was just written (with its 8 byte <length> prefix) to the datafile."""
+    self.offsets.append(self._pos + 8)
+    self.lengths.append(str_len)
+    self.article_ids.append(article_id)
+    self._pos += 8 + str_len
+
+  def save(self, data_file):
+    save_record_index(data_file, self.offsets, self.lengths, self.article_ids)
+
+
+class RecordReader(object):
+  """Random access to the records of a .bin datafile.
+
+  The datafile is memory-mapped and located through its sidecar offset index, so records are returned as zero-copy memoryview slices of the mapping, without any read syscalls or intermediate buffers. Callers don't have to release the memoryviews before close(): the mapping stays open until the last of them is released or garbage collected."""
+
+  def __init__(self, data_file, build_index=True):
+    """
+    Args:
+      data_file: path to a .bin datafile
+      build_index: if True, build the sidecar index when it is missing or stale. Otherwise raise IOError."""
+    index = load_record_index(data_file, build=build_index)
+    if index is None:
+      raise IOError('No offset index for %s' % data_file)
+    self.data_file = data_file
+    self.offsets, self.lengths, self.article_ids = index
+    self._positions = None # article_id -> position, built on first lookup
+    self._mmap = None
+    with open(data_file, 'rb') as f:
+      if os.fstat(f.fileno()).st_size > 0: # empty files can't be mapped
+        self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    self._buf = memoryview(self._mmap) if self._mmap is not None else memoryview(b'')
+
+  def __len__(self):
+    return len(self.offsets)
+
+  def record(self, i):
+    """Returns the serialized tf.Example at position i as a memoryview"""
+    start = int(self.offsets[i])
+    return self._buf[start:start + int(self.lengths[i])]
+
+  def records(self, start=0, stop=None):
+    """Generates memoryviews of the serialized tf.Examples at positions [start, stop)"""
+    buf = self._buf
+    for offset, length in zip(self.offsets[start:stop].tolist(), self.lengths[start:stop].tolist()):
+      yield buf[offset:offset + length]
+
+  def position(self, article_id):
+    """Returns the position of the record of article_id. Raises KeyError if it is not in this datafile."""
+    if self._positions is None:
+      self._positions = {a: i for i, a in enumerate(self.article_ids.tolist())}
+    return self._positions[article_id]
+
+  def record_by_id(self, article_id):
+    """Returns the serialized tf.Example of article_id as a memoryview"""
+    return self.record(self.position(article_id))
+
+  def close(self):
+    """Closes the mapping, or leaves it to be closed with the last memoryview of a record that is still alive. The reader can't be used afterwards."""
+    buf, mmap_ = self._buf, self._mmap
+    self._buf, self._mmap = memoryview(b''), None
+    try:
+      buf.release()
+      if mmap_ is not None:
+        mmap_.close()
+    except BufferError: # views of records are still exported, they keep the mapping alive
+      pass
+
+
+# A sentence of underscores found in documents with broken text, which are left out
+BROKEN_SENTENCE = '_ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ __ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _ _'
+
+
+def keep_document(sections):
+  """Returns False for the documents that the Batcher discards whatever the model: those with less than
+  two sections, or with broken text (BROKEN_SENTENCE). The converters leave them out of the datafiles."""
+  return len(sections) > 1 and BROKEN_SENTENCE not in chain.from_iterable(sections)
+
+
+def section_roles(section_names, num_sections):
+  """Finds the sections that the hierarchical model reads from the section names of a document.
+
+  The introduction is the first section named "intro..." and the conclusion the last one named "conclu...".
+  The converters store the result with the documents, so that Examples only slice the sections.
+
+  Args:
+    section_names: list of strings
+    num_sections: number of sections of the document
+
+  Returns:
+    (intro, conclusion, body_start, body_end): the positions of the introduction and the conclusion among
+    the sections and the range of the body sections, or () if the document has no such sections"""
+  end_loc = len(section_names)
+  beg_loc = 0
+  for i, name in enumerate(section_names):
+    name = name.lower()
+    if 'conclu' in name:
+      end_loc = i + 1
+    if 'intro' in name and beg_loc == 0:
+      beg_loc = i
+  # the sections are cut to [beg_loc, end_loc) only if more sections follow the conclusion than precede the
+  # introduction, and the introduction and conclusion are then looked up at their positions in the cut sections
+  if beg_loc < len(section_names) - end_loc:
+    start, count = beg_loc, max(0, min(end_loc, num_sections) - beg_loc)
+  else:
+    start, count = 0, num_sections
+  conclusion = end_loc - beg_loc - 1
+  if beg_loc >= count or not -count <= conclusion < count:
+    return ()
+  if conclusion < 0:
+    conclusion += count
+  return (start + beg_loc, start + conclusion, start + 1, start + max(1, count - 1))
+
+
+# A document as generated by text_generator in batch_reader: article_text is the list of article sentences,
+# abstract_sents the list of abstract sentences and sections the list of sections, each a list of sentences.
+# section_roles is the tuple of section_roles(), or None for datasets written without it.
+ColumnarDocument = namedtuple('ColumnarDocument',
+                              'article_id article_text abstract_sents labels section_names sections section_roles')
+
+
+class ColumnarWriter(object):
+  """Writes documents to a columnar dataset directory.
+
+  Instead of one serialized tf.Example of delimiter-joined strings per document, the tokens of all the documents are stored in flat arrays, and the sentence, section and document boundaries in offset arrays (see COLUMNAR_COLUMNS). Tokens are stored as ids into the lexicon of the dataset (lexicon.txt), article ids in article_ids.txt, and the dtype and size of every column in meta.json. The columns are memory-mapped by ColumnarReader."""
+
+  def __init__(self, path):
+    if not os.path.isdir(path):
+      os.makedirs(path)
+    self._path = path
+    self._lexicon = {}
+    self._article_ids = []
+    self._files = {}
+    self._sizes = {}
+    for name, dtype in COLUMNAR_COLUMNS:
+      self._files[name] = open(os.path.join(path, '%s.%s' % (name, dtype)), 'wb')
+      self._sizes[name] = 0
+      if name.endswith('offsets'):
+        self._append(name, [0])
+
+  def _append(self, name, values):
+    values = np.asarray(values, dtype=dict(COLUMNAR_COLUMNS)[name])
+    values.tofile(self._files[name])
+    self._sizes[name] += len(values)
+
+  def _add_sequences(self, tokens_name, offsets_name, seqs):
+    """Appends the tokens of strings to the tokens_name column, and their end offsets to the offsets_name column"""
+    ids, ends = [], []
+    start = self._sizes[tokens_name]
+    for s in seqs:
+      ids.extend([self._lexicon.setdefault(w, len(self._lexicon)) for w in s.split()])
+      ends.append(start + len(ids))
+    self._append(tokens_name, ids)
+    self._append(offsets_name, ends)
+
+  def add(self, article_id, abstract_sents, sections, section_names, labels=None, roles=None):
+    """Appends a document.
+
+    Args:
+      article_id: string
+      abstract_sents: list of abstract sentences (strings of space separated tokens)
+      sections: list of sections, each a list of sentences
+      section_names: list of strings
+      labels: list of ints, one per section name. Defaults to zeros.
+      roles: the section_roles() of the document, computed if None
+    """
+    if roles is None:
+      roles = section_roles(section_names, len(sections))
+    num_sents = self._sizes['sent_offsets'] - 1
+    self._add_sequences('tokens', 'sent_offsets', chain.from_iterable(sections))
+    self._append('sec_offsets', num_sents + np.cumsum([len(sec) for sec in sections], dtype=np.int64))
+    self._append('doc_offsets', [self._sizes['sec_offsets'] - 1])
+    self._add_sequences('abstract_tokens', 'abstract_sent_offsets', abstract_sents)
+    self._append('abstract_doc_offsets', [self._sizes['abstract_sent_offsets'] - 1])
+    self._add_sequences('name_tokens', 'name_offsets', section_names)
+    self._append('doc_name_offsets', [self._sizes['name_offsets'] - 1])
+    self._append('labels', labels if labels is not None else [0] * len(section_names))
+    self._append('section_roles', roles or [-1] * 4)
+    self._article_ids.append(article_id)
+
+  def close(self):
+    """Writes the lexicon, the article ids and the metadata of the dataset"""
+    for f in self._files.values():
+      f.close()
+    lexicon = sorted(self._lexicon, key=self._lexicon.get)
+    with codecs.open(os.path.join(self._path, 'lexicon.txt'), 'w', 'utf-8') as f:
+      f.write(''.join(w + '\n' for w in lexicon))
+    with codecs.open(os.path.join(self._path, 'article_ids.txt'), 'w', 'utf-8') as f:
+      f.write(''.join(a + '\n' for a in self._article_ids))
+    meta = {'version': COLUMNAR_VERSION, 'num_docs': len(self._article_ids),
+            'columns': {name: {'dtype': dtype, 'size': self._sizes[name]} for name, dtype in COLUMNAR_COLUMNS}}
+    with open(os.path.join(self._path, COLUMNAR_META), 'w') as f:
+      json.dump(meta, f, indent=1, sort_keys=True)
+
+
+def _read_columnar_meta(path):
+  with open(os.path.join(path, COLUMNAR_META)) as f:
+    meta = json.load(f)
+  if meta['version'] not in COLUMNAR_READ_VERSIONS:
+    raise ValueError('Unsupported columnar dataset version %s in %s' % (meta['version'], path))
+  return meta
+
+
+class ColumnarReader(object):
+  """Random access to the documents of a columnar dataset written by ColumnarWriter.
+
+  The columns are memory-mapped with np.memmap, so the token ids of a section or a whole document are slices of the mapping, without any copy."""
+
+  def __init__(self, path):
+    meta = _read_columnar_meta(path)
+    self.path = path
+    self.num_docs = meta['num_docs']
+    self._cols = {}
+    for name, spec in meta['columns'].items():
+      fpath = os.path.join(path, '%s.%s' % (name, spec['dtype']))
+      if spec['size']:
+        self._cols[name] = np.memmap(fpath, dtype=spec['dtype'], mode='r', shape=(spec['size'],))
+      else: # empty files can't be mapped
+        self._cols[name] = np.zeros(0, dtype=spec['dtype'])
+    with codecs.open(os.path.join(path, 'lexicon.txt'), 'r', 'utf-8') as f:
+      self.lexicon = np.array(f.read().split('\n')[:-1], dtype=object)
+    with codecs.open(os.path.join(path, 'article_ids.txt'), 'r', 'utf-8') as f:
+      self.article_ids = f.read().split('\n')[:-1]
+
+  def __len__(self):
+    return self.num_docs
+
+  def _bounds(self, name, i, j=None):
+    """Returns the offsets [i, j] (j defaults to i + 1) of an offsets column, as ints"""
+    offsets = self._cols[name]
+    return int(offsets[i]), int(offsets[i + 1 if j is None else j])
+
+  def section_tokens(self, i, j):
+    """Returns the lexicon ids of the tokens of section j of document i, as a memmap slice"""
+    sec = self._bounds('doc_offsets', i)[0] + j
+    sent_start, sent_end = self._bounds('sec_offsets', sec)
+    return self._cols['tokens'][slice(*self._bounds('sent_offsets', sent_start, sent_end))]
+
+  def document_tokens(self, i):
+    """Returns the lexicon ids of the article tokens of document i, as a memmap slice"""
+    sec_start, sec_end = self._bounds('doc_offsets', i)
+    sent_start, sent_end = self._bounds('sec_offsets', sec_start, sec_end)
+    return self._cols['tokens'][slice(*self._bounds('sent_offsets', sent_start, sent_end))]
+
+  def _strings(self, tokens_name, offsets_name, start, end):
+    """Returns the strings [start, end) of a tokens column, delimited by an offsets column"""
+    offsets = self._cols[offsets_name][start:end + 1].tolist()
+    words = self.lexicon[self._cols[tokens_name][offsets[0]:offsets[-1]]].tolist()
+    return [' '.join(words[a - offsets[0]:b - offsets[0]]) for a, b in zip(offsets[:-1], offsets[1:])]
+
+  def document(self, i):
+    """Returns document i as a ColumnarDocument"""
+    sec_start, sec_end = self._bounds('doc_offsets', i)
+    sec_offsets = self._cols['sec_offsets'][sec_start:sec_end + 1].tolist()
+    sentences = self._strings('tokens', 'sent_offsets', sec_offsets[0], sec_offsets[-1])
+    sections = [sentences[a - sec_offsets[0]:b - sec_offsets[0]] for a, b in zip(sec_offsets[:-1], sec_offsets[1:])]
+    abstract_sents = self._strings('abstract_tokens', 'abstract_sent_offsets', *self._bounds('abstract_doc_offsets', i))
+    name_start, name_end = self._bounds('doc_name_offsets', i)
+    section_names = self._strings('name_tokens', 'name_offsets', name_start, name_end)
+    labels = self._cols['labels'][name_start:name_end].tolist()
+    roles = None
+    if 'section_roles' in self._cols:
+      roles = tuple(self._cols['section_roles'][4 * i:4 * i + 4].tolist())
+      if roles[0] < 0:
+        roles = ()
+    return ColumnarDocument(self.article_ids[i], sentences, abstract_sents, labels, section_names, sections, roles)
+
+  def close(self):
+    self._cols = {}
+
+
+def _read_records(data_file, ranges):
+  """Generates the serialized tf.Examples of the position ranges [start, stop) of a .bin datafile, range by range. Goes through the memory-mapped RecordReader, opened once for all the ranges, if the datafile has an offset index; otherwise the datafile is read sequentially, seeking over the records before start."""
+  if os.path.exists(index_path(data_file)):
+    reader = RecordReader(data_file)
+    record = None
+    try:
+      for start, stop in ranges:
+        for record in reader.records(start, stop):
+          yield record.tobytes() # protobuf parsing wants bytes
+          record.release()
+    finally:
+      if record is not None: # the generator may be closed before the last view was released
+        record.release()
+      reader.close()
+    return
+  with open(data_file, 'rb') as reader:
+    for start, stop in ranges:
+      reader.seek(0)
+      pos = 0
+      while stop is None or pos < stop:
+        len_bytes = reader.read(8)
+        if not len_bytes: break # finished reading this file
+        str_len = struct.unpack('q', len_bytes)[0]
+        if pos < start:
+          reader.seek(str_len, os.SEEK_CUR)
+        else:
+          yield struct.unpack('%ds' % str_len, reader.read(str_len))[0]
+        pos += 1
+
+
+def is_compressed(data_file):
+  """Returns True if data_file is a block-compressed shard written by CompressedRecordWriter"""
+  with open(data_file, 'rb') as f:
+    return f.read(len(COMPRESSED_MAGIC)) == COMPRESSED_MAGIC
+
+
+class CompressedRecordWriter(object):
+  """Writes a block-compressed shard, the compressed counterpart of a .bin datafile.
+
+  Layout: <magic> <block>* <block index> <index offset><number of blocks> <magic>. A block is the
+  zlib-compressed <length><blob> records of up to block_size consecutive tf.Examples, exactly as they
+  would be in a .bin datafile, so blocks can be decompressed independently. The block index holds the
+  (file offset, compressed size, number of records) of each block as int64."""
+
+  def __init__(self, data_file, block_size=COMPRESSED_BLOCK_SIZE, level=6):
+    """
+    Args:
+      data_file: path of the shard to write
+      block_size: number of records per block
+      level: zlib compression level"""
+    self._writer = open(data_file, 'wb')
+    self._writer.write(COMPRESSED_MAGIC)
+    self._block_size = block_size
+    self._level = level
+    self._block = []
+    self._blocks = []
+
+  def write(self, example_str):
+    """Appends a serialized tf.Example"""
+    self._block.append(struct.pack('q', len(example_str)))
+    self._block.append(example_str)
+    if len(self._block) >= 2 * self._block_size:
+      self._flush()
+
+  def _flush(self):
+    if not self._block:
+      return
+    block = zlib.compress(b''.join(self._block), self._level)
+    self._blocks.append((self._writer.tell(), len(block), len(self._block) // 2))
+    self._writer.write(block)
+    self._block = []
+
+  def close(self):
+    self._flush()
+    index_offset = self._writer.tell()
+    self._writer.write(np.asarray(self._blocks, dtype=np.int64).reshape(-1, 3).tobytes())
+    self._writer.write(struct.pack('qq', index_offset, len(self._blocks)))
+    self._writer.write(COMPRESSED_MAGIC)
+    self._writer.close()
+
+
+def load_block_index(data_file):
+  """Returns the block index of a block-compressed shard: an int64 array with a (file offset, compressed size, number of records) row per block"""
+  with open(data_file, 'rb') as f:
+    f.seek(-(16 + len(COMPRESSED_MAGIC)), os.SEEK_END)
+    index_offset, num_blocks = struct.unpack('qq', f.read(16))
+    if f.read(len(COMPRESSED_MAGIC)) != COMPRESSED_MAGIC:
+      raise IOError('Truncated block-compressed shard %s' % data_file)
+    f.seek(index_offset)
+    return np.frombuffer(f.read(num_blocks * 24), dtype=np.int64).reshape(num_blocks, 3)
+
+
+def _read_compressed_records(data_file, ranges):
+  """Generates the serialized tf.Examples of the position ranges [start, stop) of a block-compressed shard, range by range. The block index is loaded and the shard opened once for all the ranges, and blocks are decompressed one at a time (a block shared by consecutive ranges only once)."""
+  blocks = load_block_index(data_file)
+  ends = np.cumsum(blocks[:, 2])
+  num_records = int(ends[-1]) if len(ends) else 0
+  last = None, None # (number, contents) of the last decompressed block
+  with open(data_file, 'rb') as reader:
+    for start, stop in ranges:
+      if stop is None:
+        stop = num_records
+      b = int(np.searchsorted(ends, start, side='right')) # first block holding a record >= start
+      pos = int(ends[b - 1]) if b else 0 # position of the first record of the block
+      while pos < stop and b < len(blocks):
+        if last[0] != b:
+          offset, size, _ = blocks[b].tolist()
+          reader.seek(offset)
+          last = b, zlib.decompress(reader.read(size))
+        block = last[1]
+        i = 0
+        while i < len(block) and pos < stop:
+          str_len = struct.unpack_from('q', block, i)[0]
+          i += 8
+          if pos >= start:
+            yield block[i:i + str_len]
+          i += str_len
+          pos += 1
+        b += 1
+
+
+def read_records(data_file, start=0, stop=None):
+  """Generates the serialized tf.Examples at positions [start, stop) of a .bin datafile or a block-compressed shard, in order"""
+  return _read_datafile_records(data_file, [(start, stop)])
+
+
+def _read_datafile_records(data_file, ranges):
+  if is_compressed(data_file):
+    return _read_compressed_records(data_file, ranges)
+  return _read_records(data_file, ranges)
+
+
+def _read_unit(data_file, ranges):
+  """Generates the records of the position ranges [start, stop) of a datafile, range by range: deserialized tf.Examples of a .bin datafile or block-compressed shard, or ColumnarDocuments of a columnar dataset. The datafile is opened once for all the ranges."""
+  if is_columnar(data_file):
+    reader = ColumnarReader(data_file)
+    try:
+      for start, stop in ranges:
+        for i in range(start, len(reader) if stop is None else stop):
+          yield reader.document(i)
+    finally:
+      reader.close()
+    return
+  for example_str in _read_datafile_records(data_file, ranges):
+    yield example_pb2.Example.FromString(example_str)
+
+
+def _num_indexed_records(data_file):
+  if is_columnar(data_file):
+    return _read_columnar_meta(data_file)['num_docs']
+  if is_compressed(data_file):
+    return int(load_block_index(data_file)[:, 2].sum())
+  index = load_record_index(data_file, build=False)
+  return len(index[0]) if index is not None else None
+
+
+class WorkUnits(object):
+  """Hands out disjoint units of work to the threads that read a dataset, so that each thread reads its own part of every epoch instead of the whole dataset.
+
+  A unit of work is a tuple (datafile, start, stop): the records at positions [start, stop) of the datafile (stop=None meaning until the end). Units are whole datafiles, unless there are fewer datafiles than readers, in which case the datafiles are split into record ranges so that every reader gets a share (.bin datafiles without an offset index are indexed first, see build_record_index). The units are reshuffled at the start of every epoch (kept in order in single_pass mode).
+
+  Readers that register their progress through a unit with track() make the position of the whole dataset resumable: state() returns it as a JSON-serializable dict, and restore() continues from it."""
+
+  def __init__(self, data_path, single_pass, num_readers=1, seed=None, num_records=None):
+    """
+    Args:
+      data_path: Path to tf.Example data files. Can include wildcards.
+      single_pass: Boolean. If True, hand out the units of a single epoch, in order, then stop.
+      num_readers: number of threads sharing these units
+      seed: seed of the random generator that shuffles the units
+      num_records: function returning the number of addressable records of a datafile, or None if the datafile can only be read as a whole. Defaults to the size of its offset index."""
+    self._data_path = data_path
+    self._num_records = num_records or _num_indexed_records
+    self._single_pass = single_pass
+    self._num_readers = num_readers
+    self._rng = random.Random(seed)
+    self._lock = threading.Lock()
+    self._in_flight = {} # id(progress) -> (unit, ranges, progress) of the units being read, see track()
+    self._units = []
+    self._next = 0
+    self._started = False
+    self.epoch = 0
+
+  def _make_units(self):
+    filelist = list_datafiles(self._data_path) # get the list of datafiles
+    assert filelist, ('Error: Empty filelist at %s' % self._data_path) # check filelist isn't empty
+    filelist = sorted(filelist)
+    if not self._single_pass:
+      self._rng.shuffle(filelist)
+    if len(filelist) >= self._num_readers:
+      return [(f, 0, None) for f in filelist]
+    units = []
+    for f in filelist:
+      num_records = self._num_records(f)
+      if num_records is None: # unindexed .bin datafile: index it, otherwise the spare readers would read the same files
+        tf.logging.info('Building the offset index of %s to split it between %d readers', f, self._num_readers)
+        num_records = len(load_record_index(f)[0])
+      if not num_records:
+        units.append((f, 0, None))
+        continue
+      step = -(-num_records // self._num_readers) # ceil
+      units.extend((f, start, min(start + step, num_records)) for start in range(0, num_records, step))
+    if not self._single_pass:
+      self._rng.shuffle(units)
+    return units
+
+  def next(self):
+    """Returns the next unit of work (datafile, start, stop), or None once the dataset has been handed out in single_pass mode."""
+    with self._lock:
+      while self._next >= len(self._units):
+        if self._started:
+          if self._single_pass:
+            return None
+          self.epoch += 1
+          tf.logging.info('Finished handing out %d epoch(s)', self.epoch)
+        self._units = self._make_units()
+        self._next = 0
+        self._started = True
+      unit = self._units[self._next]
+      self._next += 1
+      return unit
+
+  def track(self, unit, ranges, progress=None):
+    """Registers that a reader reads unit as the record ranges `ranges` (see shuffled_ranges), in this order.
+
+    Args:
+      progress: the one element counter to register, for readers whose counter is kept elsewhere (e.g. in memory shared with a worker process). Defaults to a new list.
+
+    Returns:
+      progress: a one element list, the number of records of the unit read so far. The reader increments it as it reads, and calls done(progress) once it has read the whole unit.
+    """
+    if progress is None:
+      progress = [0]
+    with self._lock:
+      self._in_flight[id(progress)] = (unit, ranges, progress)
+    return progress
+
+  def done(self, progress):
+    with self._lock:
+      self._in_flight.pop(id(progress), None)
+
+  def state(self):
+    """Returns the position in the dataset as a JSON-serializable dict: the epoch, the units left in it (starting with the unread ranges of the units being read) and the state of the random generator that shuffles the next epochs."""
+    with self._lock:
+      units = []
+      for unit, ranges, progress in self._in_flight.values():
+        n = progress[0]
+        for start, stop in ranges:
+          if stop is not None and n >= stop - start:
+            n -= stop - start
+            continue
+          units.append((unit[0], start + n, stop))
+          n = 0
+      units.extend(self._units[self._next:])
+      version, internal, gauss = self._rng.getstate()
+      return {'epoch': self.epoch, 'started': self._started, 'units': [list(u) for u in units],
+              'rng_state': [version, list(internal), gauss]}
+
+  def restore(self, state):
+    """Continues from a position returned by state()"""
+    with self._lock:
+      self._units = [tuple(u) for u in state['units']]
+      self._next = 0
+      self._in_flight = {}
+      self.epoch = state['epoch']
+      self._started = state['started']
+      version, internal, gauss = state['rng_state']
+      self._rng.setstate((version, tuple(internal), gauss))
+
+
+def example_generator(data_path, single_pass, work_units=None, shuffle_buffer_size=0, shuffle_block_size=0, seed=None):
   """Generates tf.Examples from data files.
 
     Binary data format: <length><blob>. <length> represents the byte size
     of <blob>. <blob> is serialized tf.Example proto. The tf.Example contains
-    the tokenized article text and summary.
+    the tokenized article text and summary. Datafiles that have a sidecar
+    offset index (see RecordReader) are read through a memory map.
+    Block-compressed shards (see CompressedRecordWriter) are decompressed
+    block by block as they are read. They and columnar dataset directories
+    (see ColumnarWriter) can be mixed with .bin datafiles.
 
   Args:
     data_path:
       Path to tf.Example data files. Can include wildcards, e.g. if you have several training data chunk files train_001.bin, train_002.bin, etc, then pass data_path=train_* to access them all.
     single_pass:
       Boolean. If True, go through the dataset exactly once, generating examples in the order they appear, then return. Otherwise, generate random examples indefinitely.
+    work_units:
+      Optional WorkUnits shared with other generators over the same dataset. Each generator then only reads the units it takes, so that together they read every epoch exactly once. If None, this generator reads the whole dataset.
+    shuffle_buffer_size:
+      If > 0 and not single_pass, the records go through a shuffle buffer of this many records (see shuffle_buffer), so that records that are close in a datafile are spread out.
+    shuffle_block_size:
+      If > 0 and not single_pass, the records of datafiles that can be read by position (indexed, compressed or columnar) are read in blocks of this many records, in random order (see shuffled_ranges).
+    seed:
+      seed of the random generator of the shuffle buffer and block order. Generators sharing work_units should each get their own (see reader_seed).
 
   Yields:
-    Deserialized tf.Example.
+    Deserialized tf.Example, or ColumnarDocument for the documents of columnar datasets.
   """
-  epoch = 0
+  if work_units is None:
+    work_units = WorkUnits(data_path, single_pass)
+  if single_pass:
+    shuffle_buffer_size, shuffle_block_size = 0, 0
+  rng = random.Random(seed)
+  records = _unit_records(work_units, shuffle_block_size, rng)
+  if shuffle_buffer_size > 0:
+    records = shuffle_buffer(records, shuffle_buffer_size, rng)
+  return records
+
+
+def reader_seed(seed, reader_index):
+  """Returns the seed of the shuffling of reader reader_index of a dataset, derived from the shuffle seed: one seed reproduces the run, without all the readers drawing the same random stream. None (random) if seed is None."""
+  if seed is None:
+    return None
+  return int(hashlib.sha1(('%s:%d' % (seed, reader_index)).encode('utf-8')).hexdigest()[:16], 16)
+
+
+def _unit_records(work_units, shuffle_block_size, rng):
+  num_units = 0
+  num_records = 0
   while True:
-    num_files = 0
-    filelist = glob.glob(data_path) # get the list of datafiles
-    assert filelist, ('Error: Empty filelist at %s' % data_path) # check filelist isn't empty
-    if single_pass:
-      filelist = sorted(filelist)
-    else:
-      random.shuffle(filelist)
-    num_records = 0
-    for f in filelist:
-      num_files += 1
-      reader = open(f, 'rb')
-      while True:
-        len_bytes = reader.read(8)
-        if not len_bytes: break # finished reading this file
-        str_len = struct.unpack('q', len_bytes)[0]
-        example_str = struct.unpack('%ds' % str_len, reader.read(str_len))[0]
-        num_records += 1
-        if num_records % 1000 == 0:
-          print(('example_generator read {:d} records'.format(num_records)), end='\r', flush=True)
-        yield example_pb2.Example.FromString(example_str)
-      if num_files % 1000 == 0:
-        print(('example_generator read {:d} files'.format(num_files)), end='\r', flush=True)
-    if single_pass:
+    unit = work_units.next()
+    if unit is None:
       print("example_generator completed reading all datafiles. No more data.")
       break
-  epoch += 1
-  print(('Finished processing {:d} epoch(s)'.format(epoch)))
+    ranges = shuffled_ranges(*unit, block_size=shuffle_block_size, rng=rng)
+    progress = work_units.track(unit, ranges)
+    for record in _read_unit(unit[0], ranges):
+      progress[0] += 1
+      num_records += 1
+      if num_records % 1000 == 0:
+        print(('example_generator read {:d} records'.format(num_records)), end='\r', flush=True)
+      yield record
+    work_units.done(progress)
+    num_units += 1
+    if num_units % 1000 == 0:
+      print(('example_generator read {:d} units'.format(num_units)), end='\r', flush=True)
+
+
+def shuffled_ranges(data_file, start=0, stop=None, block_size=0, rng=random, num_records=None):
+  """Splits the records [start, stop) of a datafile into blocks of block_size records, in random order.
+
+  This shuffles the order in which a datafile is read at the cost of one seek per block. If block_size is 0, or the number of records of the datafile is unknown (unindexed .bin datafiles), returns the range [start, stop) as a whole.
+
+  Args:
+    data_file: path to the datafile
+    start, stop: the record range, stop=None meaning until the end of the datafile
+    block_size: number of records per block. For block-compressed shards, use a multiple of their block size so that no block is decompressed twice.
+    rng: random generator
+    num_records: function returning the number of records of a datafile, as in WorkUnits
+
+  Returns:
+    list of (start, stop) ranges
+  """
+  if block_size > 0 and stop is None:
+    stop = (num_records or _num_indexed_records)(data_file)
+  if block_size <= 0 or stop is None:
+    return [(start, stop)]
+  ranges = [(b, min(b + block_size, stop)) for b in range(start, stop, block_size)]
+  rng.shuffle(ranges)
+  return ranges
+
+
+def shuffle_buffer(records, buffer_size, rng=random):
+  """Shuffles a stream of records while holding at most buffer_size of them in memory.
+
+  The buffer is filled with the first buffer_size records; then each new record replaces a randomly chosen buffered one, which is yielded. The records left at the end are yielded in random order. A record can thus move up to about buffer_size positions earlier, and arbitrarily later, in the stream."""
+  buf = []
+  for record in records:
+    if len(buf) < buffer_size:
+      buf.append(record)
+      continue
+    i = rng.randrange(buffer_size)
+    yield buf[i]
+    buf[i] = record
+  rng.shuffle(buf)
+  for record in buf:
+    yield record
 
 
 def article2ids(article_words, vocab):
@@ -172,19 +1004,8 @@ def article2ids(article_words, vocab):
       A list of word ids (integers); OOVs are represented by their temporary article OOV number. If the vocabulary size is 50k and the article has 3 OOVs, then these temporary OOV numbers will be 50000, 50001, 50002.
     oovs:
       A list of the OOV words in the article (strings), in the order corresponding to their temporary article OOV numbers."""
-  ids = []
-  oovs = []
-  unk_id = vocab.word2id(UNKNOWN_TOKEN)
-  for w in article_words:
-    i = vocab.word2id(w)
-    if i == unk_id: # If w is OOV
-      if w not in oovs: # Add to list of OOVs
-        oovs.append(w)
-      oov_num = oovs.index(w) # This is 0 for the first article OOV, 1 for the second article OOV...
-      ids.append(vocab.size() + oov_num) # This is e.g. 50000 for the first article OOV, 50001 for the second...
-    else:
-      ids.append(i)
-  return ids, oovs
+  _, ids, oovs, _, _ = article_abstract2ids(article_words, [], vocab)
+  return ids.tolist(), oovs
 
 
 def abstract2ids(abstract_words, vocab, article_oovs):
@@ -197,19 +1018,42 @@ def abstract2ids(abstract_words, vocab, article_oovs):
 
   Returns:
     ids: List of ids (integers). In-article OOV words are mapped to their temporary OOV numbers. Out-of-article OOV words are mapped to the UNK token id."""
-  ids = []
   unk_id = vocab.word2id(UNKNOWN_TOKEN)
-  for w in abstract_words:
-    i = vocab.word2id(w)
-    if i == unk_id: # If w is an OOV word
-      if w in article_oovs: # If w is an in-article OOV
-        vocab_idx = vocab.size() + article_oovs.index(w) # Map to its temporary article OOV number
-        ids.append(vocab_idx)
-      else: # If w is an out-of-article OOV
-        ids.append(unk_id) # Map to the UNK token id
-    else:
-      ids.append(i)
-  return ids
+  oov_ids = {w: vocab.size() + k for k, w in reversed(list(enumerate(article_oovs)))} # first occurrence wins, as with list.index
+  ids = vocab.words2ids(abstract_words)
+  for j in np.flatnonzero(ids == unk_id).tolist(): # If abstract_words[j] is an OOV word
+    # Map in-article OOVs to their temporary article OOV number, out-of-article OOVs to the UNK token id
+    ids[j] = oov_ids.get(abstract_words[j], unk_id)
+  return ids.tolist()
+
+
+def article_abstract2ids(article_words, abstract_words, vocab):
+  """Maps the article and abstract words to all the id sequences of an Example at once, with a single vocab lookup per word. OOVs are numbered through a dict, instead of list searches that are quadratic in the number of OOVs of an article.
+
+  Args:
+    article_words: list of article words (strings)
+    abstract_words: list of abstract words (strings)
+    vocab: Vocabulary object
+
+  Returns:
+    enc_ids: int32 array of article word ids; OOVs are represented by the id for UNK token
+    enc_ids_extend_vocab: int32 array of article word ids; OOVs are represented by their temporary article OOV number (as in article2ids)
+    oovs: list of the OOV words in the article, in the order corresponding to their temporary article OOV numbers
+    abs_ids: int32 array of abstract word ids; OOVs are represented by the id for UNK token
+    abs_ids_extend_vocab: int32 array of abstract word ids; in-article OOVs are represented by their temporary article OOV number, other OOVs by the UNK token id (as in abstract2ids)
+  """
+  unk_id = vocab.word2id(UNKNOWN_TOKEN)
+  size = vocab.size()
+  enc_ids = vocab.words2ids(article_words)
+  enc_ids_extend_vocab = enc_ids.copy()
+  oov_ids = {} # in-article OOV -> temporary article OOV number, in order of first occurrence
+  for j in np.flatnonzero(enc_ids == unk_id).tolist():
+    enc_ids_extend_vocab[j] = oov_ids.setdefault(article_words[j], size + len(oov_ids))
+  abs_ids = vocab.words2ids(abstract_words)
+  abs_ids_extend_vocab = abs_ids.copy()
+  for j in np.flatnonzero(abs_ids == unk_id).tolist():
+    abs_ids_extend_vocab[j] = oov_ids.get(abstract_words[j], unk_id)
+  return enc_ids, enc_ids_extend_vocab, list(oov_ids), abs_ids, abs_ids_extend_vocab
 
 
 def outputids2words(id_list, vocab, article_oovs):
@@ -223,19 +1067,36 @@ def outputids2words(id_list, vocab, article_oovs):
   Returns:
     words: list of words (strings)
   """
-  words = []
-  for i in id_list:
-    try:
-      w = vocab.id2word(i) # might be [UNK]
-    except ValueError as e: # w is OOV
-      assert article_oovs is not None, "Error: model produced a word ID that isn't in the vocabulary. This should not happen in baseline (no pointer-generator) mode"
-      article_oov_idx = i - vocab.size()
-      try:
-        w = article_oovs[article_oov_idx]
-      except ValueError as e: # i doesn't correspond to an article oov
-        raise ValueError('Error: model produced word ID %i which corresponds to article OOV %i but this example only has %i article OOVs' % (i, article_oov_idx, len(article_oovs)))
-    words.append(w)
-  return words
+  ids = np.asarray(id_list, dtype=np.int64)
+  in_vocab = ids < vocab.size()
+  if in_vocab.all():
+    return vocab.ids_to_words(ids) # might contain [UNK]
+  assert article_oovs is not None, "Error: model produced a word ID that isn't in the vocabulary. This should not happen in baseline (no pointer-generator) mode"
+  words = np.empty(len(ids), dtype=object)
+  words[in_vocab] = vocab.ids_to_words(ids[in_vocab])
+  for j in np.flatnonzero(~in_vocab).tolist(): # in-article OOVs
+    article_oov_idx = int(ids[j]) - vocab.size()
+    if article_oov_idx >= len(article_oovs): # i doesn't correspond to an article oov
+      raise ValueError('Error: model produced word ID %i which corresponds to article OOV %i but this example only has %i article OOVs' % (ids[j], article_oov_idx, len(article_oovs)))
+    words[j] = article_oovs[article_oov_idx]
+  return words.tolist()
+
+
+def shortlist_ids(enc_ids, vocab_size, num_frequent):
+  """Returns the candidate words of the decode shortlist (see --decode_shortlist) of a batch of articles, and the positions of the article tokens among the candidates.
+
+  Args:
+    enc_ids: int array of the (extended) vocab ids of the articles, shape (batch_size, enc_len)
+    vocab_size: size of the vocab. Larger ids are in-article OOVs (pointer-generator mode)
+    num_frequent: number of most frequent words of the vocab in the shortlist
+
+  Returns:
+    shortlist: sorted np.int32 array of the vocab ids of the candidates: the num_frequent most frequent words and the in-vocab words of the articles
+    positions: np.int32 array shaped like enc_ids, the positions of the tokens among the candidates, where the in-article OOVs follow the shortlist in the order of their ids
+  """
+  shortlist = np.union1d(np.arange(min(num_frequent, vocab_size)), enc_ids[enc_ids < vocab_size]).astype(np.int32)
+  positions = np.where(enc_ids < vocab_size, np.searchsorted(shortlist, enc_ids), len(shortlist) + enc_ids - vocab_size)
+  return shortlist, positions.astype(np.int32)
 
 
 def abstract2sents(abstract):
@@ -261,8 +1122,10 @@ def abstract2sents(abstract):
 def show_art_oovs(article, vocab):
   """Returns the article string, highlighting the OOVs by placing __underscores__ around them"""
   unk_token = vocab.word2id(UNKNOWN_TOKEN)
-  words = [t for t in ' '.join(article).split(' ')]
-  words = [("__%s__" % w) if vocab.word2id(w)==unk_token else w for w in words]
+  words = ' '.join(article).split(' ')
+  if vocab.bpe is not None:
+    words = vocab.bpe.segment(words)
+  words = [("__%s__" % w) if i == unk_token else w for w, i in zip(words, vocab.words2ids(words).tolist())]
   out_str = ' '.join(words)
   return out_str
 
@@ -279,9 +1142,11 @@ def show_abs_oovs(abstract, vocab, article_oovs):
   """
   unk_token = vocab.word2id(UNKNOWN_TOKEN)
   words = abstract.split(' ')
+  if vocab.bpe is not None:
+    words = vocab.bpe.segment(words)
   new_words = []
-  for w in words:
-    if vocab.word2id(w) == unk_token: # w is oov
+  for w, i in zip(words, vocab.words2ids(words).tolist()):
+    if i == unk_token: # w is oov
       if article_oovs is None: # baseline mode
         new_words.append("__%s__" % w)
       else: # pointer-generator mode
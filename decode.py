@@ -121,10 +121,11 @@ class BeamSearchDecoder(object):
         decoded_words = decoded_words[:fst_stop_idx]
       except ValueError:
         decoded_words = decoded_words
-      decoded_output = ' '.join(decoded_words) # single string
+      summary_words = self._vocab.detokenize(decoded_words) # joins subwords in BPE mode
+      decoded_output = ' '.join(summary_words) # single string
 
       if FLAGS.single_pass:
-        self.write_for_rouge(original_abstract_sents, decoded_words, article_id) # write ref summary and decoded summary to file, to eval with pyrouge later
+        self.write_for_rouge(original_abstract_sents, summary_words, article_id) # write ref summary and decoded summary to file, to eval with pyrouge later
         print_results(article_withunks, abstract_withunks, decoded_output, article_id) # log output to screen
         all_decoded[article_id] = self.prepare_for_attnvis(article_withunks, abstract_withunks, decoded_words, best_hyp.attn_dists, best_hyp.p_gens, best_hyp.attn_dists_sec)
         counter += 1 # this is how many examples we've decoded
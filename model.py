@@ -25,6 +25,7 @@ import numpy as np
 import tensorflow as tf
 import tensorflow.compat.v1 as tfv1
 from util import load_embeddings
+import data
 from tensorflow.contrib.tensorboard.plugins import projector
 from tensorflow.python.ops import array_ops
 from six.moves import xrange
@@ -49,32 +50,43 @@ class SummarizationModel(object):
       print('using hierarchical attention mechanism for considering sections')
       from attention_decoder import attention_decoder
     self.attn_decoder = attention_decoder
+    self._shortlist_batch = None # batch of the cached feed of _shortlist_feed
 
   def _add_placeholders(self):
     """Add placeholders to the graph. These are entry points for any input data."""
     hps = self._hps
 
+    # the batch dimension is left undefined when the batches are packed up to a token budget
+    # (see --batch_tokens), in decode mode the batches always hold beam_size hypotheses
+    batch_size = None if hps.batch_tokens and hps.mode != 'decode' else hps.batch_size
+
     # encoder part
-    self._enc_batch = tfv1.placeholder(tf.int32, [hps.batch_size, None], name='enc_batch')
-    self._enc_padding_mask = tfv1.placeholder(tf.float32, [hps.batch_size, None], name='enc_padding_mask')
+    self._enc_batch = tfv1.placeholder(tf.int32, [batch_size, None], name='enc_batch')
+    self._enc_padding_mask = tfv1.placeholder(tf.float32, [batch_size, None], name='enc_padding_mask')
     if self._hps.hier:
-      self._enc_batch_sections = tfv1.placeholder(tf.int32, [hps.batch_size, hps.num_sections, None], name='enc_batch_sections')
-      self._doc_sec_lens = tfv1.placeholder(tf.int32, [hps.batch_size]) # length of doc in num sections
-      self._batch_sections_len = tfv1.placeholder(tf.int32, [hps.batch_size, hps.num_sections])
-      self._enc_section_padding_mask = tfv1.placeholder(tf.int32, [hps.batch_size, hps.num_sections, None], name='enc_section_padding_mask')
-    self._enc_lens = tfv1.placeholder(tf.int32, [hps.batch_size], name='enc_lens')
+      self._enc_batch_sections = tfv1.placeholder(tf.int32, [batch_size, hps.num_sections, None], name='enc_batch_sections')
+      self._doc_sec_lens = tfv1.placeholder(tf.int32, [batch_size]) # length of doc in num sections
+      self._batch_sections_len = tfv1.placeholder(tf.int32, [batch_size, hps.num_sections])
+      self._enc_section_padding_mask = tfv1.placeholder(tf.int32, [batch_size, hps.num_sections, None], name='enc_section_padding_mask')
+    self._enc_lens = tfv1.placeholder(tf.int32, [batch_size], name='enc_lens')
     if FLAGS.pointer_gen:
-      self._enc_batch_extend_vocab = tfv1.placeholder(tf.int32, [hps.batch_size, None], name='enc_batch_extend_vocab')
+      self._enc_batch_extend_vocab = tfv1.placeholder(tf.int32, [batch_size, None], name='enc_batch_extend_vocab')
       self._max_art_oovs = tfv1.placeholder(tf.int32, [], name='max_art_oovs')
 
     # decoder part
-    self._dec_batch = tfv1.placeholder(tf.int32, [hps.batch_size, hps.max_dec_steps], name='dec_batch')
-    self._target_batch = tfv1.placeholder(tf.int32, [hps.batch_size, hps.max_dec_steps], name='target_batch')
-    self._dec_padding_mask = tfv1.placeholder(tf.float32, [hps.batch_size, hps.max_dec_steps], name='padding_mask')
+    self._dec_batch = tfv1.placeholder(tf.int32, [batch_size, hps.max_dec_steps], name='dec_batch')
+    self._target_batch = tfv1.placeholder(tf.int32, [batch_size, hps.max_dec_steps], name='target_batch')
+    self._dec_padding_mask = tfv1.placeholder(tf.float32, [batch_size, hps.max_dec_steps], name='padding_mask')
 
     if hps.mode=="decode" and hps.coverage:
       self.prev_coverage = tfv1.placeholder(tf.float32, [hps.batch_size, None], name='prev_coverage')
 
+    if hps.mode=="decode" and hps.decode_shortlist > 0:
+      # candidate vocab ids of the output projection, and the positions of the article tokens among the candidates (see _shortlist_feed)
+      self._shortlist = tfv1.placeholder(tf.int32, [None], name='shortlist')
+      if FLAGS.pointer_gen:
+        self._enc_batch_shortlist = tfv1.placeholder(tf.int32, [hps.batch_size, None], name='enc_batch_shortlist')
+
 
   def _make_feed_dict(self, batch, just_enc=False):
     """Make a feed dictionary mapping parts of the batch to the appropriate placeholders.
@@ -152,7 +164,7 @@ class SummarizationModel(object):
       return tf.contrib.rnn.LSTMStateTuple(new_c, new_h) # Return new cell and state
 
 
-  def _calc_final_dist(self, vocab_dists, attn_dists):
+  def _calc_final_dist(self, vocab_dists, attn_dists, vsize=None, enc_batch_extend_vocab=None):
     """Calculate the final distribution, for the pointer-generator model
 
     Args:
@@ -161,19 +173,27 @@ class SummarizationModel(object):
         vocabulary file.
       attn_dists: The attention distributions. List length max_dec_steps of
         (batch_size, attn_len) arrays
+      vsize: size of the vocabulary distributions, the vocab size if None. Smaller with the decode shortlist.
+      enc_batch_extend_vocab: positions of the article tokens in the extended vocabulary distributions, self._enc_batch_extend_vocab if None
 
     Returns:
       final_dists: The final distributions. List length max_dec_steps of
         (batch_size, extended_vsize) arrays. extended_vsize is the vocab + article OOV
     """
 
+    if vsize is None:
+      vsize = self._vocab.size()
+    if enc_batch_extend_vocab is None:
+      enc_batch_extend_vocab = self._enc_batch_extend_vocab
+
     with tfv1.variable_scope('final_distribution'):
       vocab_dists = [p_gen * dist for (p_gen,dist) in zip(self.p_gens, vocab_dists)]
       attn_dists = [(1-p_gen) * dist for (p_gen,dist) in zip(self.p_gens, attn_dists)]
 
       # Extend the vocabulary dist with zeros (for OOV words
-      extended_vsize = self._vocab.size() + self._max_art_oovs 
-      extra_zeros = tf.zeros((self._hps.batch_size, self._max_art_oovs))
+      extended_vsize = vsize + self._max_art_oovs
+      batch_size = tf.shape(enc_batch_extend_vocab)[0]
+      extra_zeros = tf.zeros((batch_size, self._max_art_oovs))
       # list length max_dec_steps of shape (batch_size, extended_vsize)
       vocab_dists_extended = [tf.concat(axis=1, values=[dist, extra_zeros])
                               for dist in vocab_dists]
@@ -181,13 +201,13 @@ class SummarizationModel(object):
 
       # Project the values in the attention distributions onto the appropriate
       # entries in the final distributions
-      batch_nums = tf.range(0, limit=self._hps.batch_size) # shape (batch_size)
+      batch_nums = tf.range(0, limit=batch_size) # shape (batch_size)
       batch_nums = tf.expand_dims(batch_nums, 1) # shape (batch_size, 1)
 
-      attn_len = tf.shape(self._enc_batch_extend_vocab)[1] 
+      attn_len = tf.shape(enc_batch_extend_vocab)[1]
       batch_nums = tf.tile(batch_nums, [1, attn_len]) # shape (batch_size, attn_len)
-      indices = tf.stack( (batch_nums, self._enc_batch_extend_vocab), axis=2) 
-      shape = [self._hps.batch_size, extended_vsize]
+      indices = tf.stack( (batch_nums, enc_batch_extend_vocab), axis=2)
+      shape = [batch_size, extended_vsize]
       # indices has shape [batch_size, extended_vsize, 2]
       # sample slice: [[[0, 701], ... ], [[1, 529], ...], [[2, 728], ...]]
       # scatter the distribution among corresponding batches and vocabulary index
@@ -257,7 +277,7 @@ class SummarizationModel(object):
 
       with tfv1.variable_scope('embedding'):
         if hps.pretrained_embeddings:
-          word2vec = load_embeddings(hps.embeddings_path, self._vocab.word2id, hps.rand_unif_init_mag)
+          word2vec = load_embeddings(hps.embeddings_path, self._vocab, hps.rand_unif_init_mag)
           self.embedding = tfv1.get_variable('embedding', [vsize, hps.emb_dim],
                                     dtype=tf.float32, initializer=tf.constant_initializer(word2vec))
           # self.assign_embedding = tf.assign(self.embedding, word2vec)
@@ -436,13 +456,18 @@ class SummarizationModel(object):
         
 
       # Project decoder output to vocabulary
+      # In decode mode with a shortlist, only to the candidate words of the shortlist
+      shortlist = hps.mode == "decode" and hps.decode_shortlist > 0
       with tfv1.variable_scope('output_projection'), tf.device(self._next_device()):
         if self._hps.output_weight_sharing:
           # share weights of embedding layer with projection
           # self.embedding is in shape [vsize, hps.emb_dim]
           w_proj = tfv1.get_variable('w_proj', [self._hps.emb_dim, self._hps.hidden_dim],
                               dtype=tf.float32, initializer=self.trunc_norm_init)
-          w = tf.tanh(tf.transpose(tf.matmul(self.embedding, w_proj))) # shape = [vsize, hps.hidden_dim]
+          emb = tf.gather(self.embedding, self._shortlist) if shortlist else self.embedding
+          w = tf.tanh(tf.transpose(tf.matmul(emb, w_proj))) # shape = [vsize, hps.hidden_dim]
+          if shortlist:
+            w_full = tf.tanh(tf.transpose(tf.matmul(self.embedding, w_proj)))
           
   #         w_t = tf.transpose(w)
           b = tfv1.get_variable('b', [vsize],
@@ -453,6 +478,12 @@ class SummarizationModel(object):
   #         w_t = tf.transpose(w)
           b = tfv1.get_variable('b', [vsize],
                               dtype=tf.float32, initializer=self.trunc_norm_init)
+          if shortlist:
+            w_full = w
+            w = tf.gather(w, self._shortlist, axis=1)
+        if shortlist:
+          b_full = b
+          b = tf.gather(b, self._shortlist)
         # vocabulary score at each decoder step
         vocab_scores = []
         for i,output in enumerate(decoder_outputs):
@@ -464,14 +495,26 @@ class SummarizationModel(object):
         # shape of each element is [batch_size, vsize]
         vocab_dists = [tf.nn.softmax(s) for s in vocab_scores] 
 
+        if shortlist:
+          # exact fallback: the vocab distribution over the whole vocab, run by decode_onestep with the
+          # decoder output, attention and p_gen of the step fed in, so that the decoder isn't run again
+          self._dec_output = decoder_outputs[0]
+          exact_vocab_dists = [tf.nn.softmax(tfv1.nn.xw_plus_b(self._dec_output, w_full, b_full))]
+
       
       # pointing / generating
       if FLAGS.pointer_gen:
-        final_dists = self._calc_final_dist(vocab_dists, self.attn_dists)
+        if shortlist:
+          final_dists = self._calc_final_dist(vocab_dists, self.attn_dists, tf.size(self._shortlist), self._enc_batch_shortlist)
+          exact_dists = self._calc_final_dist(exact_vocab_dists, self.attn_dists)
+        else:
+          final_dists = self._calc_final_dist(vocab_dists, self.attn_dists)
 #         log_dists = [tf.math.log(dist) for dist in final_dists]
       else:
 #         log_dists = [tf.math.log(dist) for dist in vocab_dists]
         final_dists = vocab_dists
+        if shortlist:
+          exact_dists = exact_vocab_dists
         
 
       # Calculate Losses:
@@ -484,7 +527,7 @@ class SummarizationModel(object):
             # This is fiddly; we use tf.gather_nd to pick out the gold target words
             # will be list length max_dec_steps containing shape (batch_size)
             loss_per_step = [] 
-            batch_nums = tf.range(0, limit=hps.batch_size) # shape (batch_size)
+            batch_nums = tf.range(0, limit=tf.shape(self._target_batch)[0]) # shape (batch_size)
             for dec_step, dist in enumerate(final_dists):
               # The indices of the target words. shape (batch_size)
               targets = self._target_batch[:,dec_step] 
@@ -520,6 +563,14 @@ class SummarizationModel(object):
         assert len(final_dists) == 1 # final_dists is a singleton list containing shape (batch_size, extended_vsize)
         final_dists = final_dists[0]
         topk_probs, self._topk_ids = tf.nn.top_k(final_dists, hps.batch_size*2) # take the k largest probs. note batch_size=beam_size in decode mode
+        if shortlist:
+          # map the positions among the candidates back to (extended) vocab ids
+          candidates = self._shortlist
+          if FLAGS.pointer_gen:
+            candidates = tf.concat([candidates, vsize + tf.range(self._max_art_oovs)], axis=0)
+          self._topk_ids = tf.gather(candidates, self._topk_ids)
+          exact_topk_probs, self._exact_topk_ids = tf.nn.top_k(exact_dists[0], hps.batch_size*2)
+          self._exact_topk_log_probs = tf.math.log(exact_topk_probs)
         self._topk_log_probs = tf.math.log(topk_probs)
 
   def _add_train_op(self):
@@ -722,8 +773,22 @@ class SummarizationModel(object):
       feed[self.prev_coverage] = np.stack(prev_coverage, axis=0)
       to_return['coverage'] = self.coverage
 
+    if self._hps.decode_shortlist > 0:
+      feed.update(self._shortlist_feed(batch))
+      to_return['dec_output'] = self._dec_output
+
     results = sess.run(to_return, feed_dict=feed) # run the decoder step
 
+    if self._hps.decode_shortlist > 0 and np.exp(results['probs'][:, 0].min()) < self._hps.decode_shortlist_fallback:
+      # a hypothesis has no likely continuation among the candidates: score this step over the whole vocab
+      exact_feed = {self._dec_output: results['dec_output']}
+      if FLAGS.pointer_gen:
+        exact_feed[self.attn_dists[0]] = results['attn_dists'][0]
+        exact_feed[self.p_gens[0]] = results['p_gens'][0]
+        exact_feed[self._enc_batch_extend_vocab] = batch.enc_batch_extend_vocab
+        exact_feed[self._max_art_oovs] = batch.max_art_oovs
+      results['ids'], results['probs'] = sess.run([self._exact_topk_ids, self._exact_topk_log_probs], feed_dict=exact_feed)
+
     # Convert results['states'] (a single LSTMStateTuple) into a list of LSTMStateTuple -- one for each hypothesis
     new_states = [tf.contrib.rnn.LSTMStateTuple(results['states'].c[i, :], results['states'].h[i, :]) for i in xrange(beam_size)]
 
@@ -755,6 +820,22 @@ class SummarizationModel(object):
     return results['ids'], results['probs'], new_states, attn_dists, p_gens, new_coverage, attn_dists_sec
 
 
+  def _shortlist_feed(self, batch):
+    """Returns the feed of the decode shortlist of the batch: the hps.decode_shortlist most frequent words
+    of the vocab and the words of the article, and in pointer-generator mode the positions of the article
+    tokens among the candidates, where the in-article OOVs follow the shortlist.
+    Cached, as beam search decodes the same batch for many steps."""
+    if self._shortlist_batch is not batch:
+      enc_ids = batch.enc_batch_extend_vocab if FLAGS.pointer_gen else batch.enc_batch
+      shortlist, enc_positions = data.shortlist_ids(enc_ids, self._vocab.size(), self._hps.decode_shortlist)
+      feed = {self._shortlist: shortlist}
+      if FLAGS.pointer_gen:
+        feed[self._enc_batch_shortlist] = enc_positions
+      self._shortlist_batch = batch
+      self._shortlist_cache = feed
+    return self._shortlist_cache
+
+
 def _mask_and_avg(values, padding_mask):
   """Applies mask to values then returns overall average (a scalar)
 
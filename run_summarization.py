@@ -34,17 +34,23 @@ import util
 tfv1.disable_v2_behavior()
 FLAGS = tf.app.flags.FLAGS
 
+# Name of the file in log_root/train where the position of the training batcher in the dataset is saved
+READER_CURSOR = 'reader_cursor.json'
+
 # Where to find data
 tf.app.flags.DEFINE_string(
     'data_path', '', 'Path expression to tf.Example datafiles. Can include wildcards to access multiple datafiles.')
 tf.app.flags.DEFINE_string(
     'vocab_path', '', 'Path expression to text vocabulary file.')
+tf.app.flags.DEFINE_string(
+    'bpe_codes', '', 'Path to the BPE codes file written by scripts/learn_bpe.py. If set, the text is split into subwords and vocab_path should be the subword vocab file written with it.')
 
 # Some keys
 tf.app.flags.DEFINE_string('article_id_key', 'article_id',
                            'tf.Example feature key for article.')
 tf.app.flags.DEFINE_string('article_key', 'article_body',
-                           'tf.Example feature key for article.')
+                           'tf.Example feature key for article. If a record doesn\'t have it, '
+                           'the article is the concatenation of its sections.')
 tf.app.flags.DEFINE_string('abstract_key', 'abstract',
                            'tf.Example feature key for abstract.')
 tf.app.flags.DEFINE_string('labels_key', 'labels',
@@ -68,12 +74,19 @@ tf.app.flags.DEFINE_integer(
     'hidden_dim', 256, 'dimension of RNN hidden states')
 tf.app.flags.DEFINE_integer('emb_dim', 128, 'dimension of word embeddings')
 tf.app.flags.DEFINE_integer('batch_size', 16, 'minibatch size')
+tf.app.flags.DEFINE_integer('batch_tokens', 0, 'if > 0, train/eval batches hold as many examples as fit in this many padded '
+                            'tokens (examples * (longest article + max_dec_steps)) instead of batch_size examples. '
+                            'Not supported with --hier')
 tf.app.flags.DEFINE_integer(
     'max_enc_steps', 1200, 'max timesteps of encoder (max source text tokens)')
 tf.app.flags.DEFINE_integer(
     'max_dec_steps', 150, 'max timesteps of decoder (max summary tokens)')
 tf.app.flags.DEFINE_integer(
     'beam_size', 4, 'beam size for beam search decoding.')
+tf.app.flags.DEFINE_integer(
+    'decode_shortlist', 0, 'If > 0, in decode mode the output projection and softmax are computed only over this many most frequent words of the vocab and the words of the article, instead of the whole vocab. The probabilities are then normalized over these candidates, so they are at least the full-vocab probabilities, except at the steps of decode_shortlist_fallback. 0 uses the exact softmax over the whole vocab.')
+tf.app.flags.DEFINE_float(
+    'decode_shortlist_fallback', 0.1, 'With decode_shortlist, the decoder steps where the most probable candidate of a hypothesis has a probability below this are scored again over the whole vocab, so that their probabilities and ids are exact. 0 never falls back, 1 always does.')
 tf.app.flags.DEFINE_integer(
     'min_dec_steps', 35, 'Minimum sequence length of generated summary. Applies only for beam search decoding mode')
 tf.app.flags.DEFINE_integer(
@@ -109,9 +122,18 @@ tf.app.flags.DEFINE_boolean('use_do', False, 'If True, use drop out on lstm cell
 tf.app.flags.DEFINE_float('do_prob', 0.2, 'Dropout probability in lstm cells')
 
 tf.app.flags.DEFINE_boolean('pretrained_embeddings', False, 'use pretrained embeddings')
-tf.app.flags.DEFINE_string('embeddings_path', '', 'path to plain text embedding files')
+tf.app.flags.DEFINE_string('embeddings_path', '', 'path to plain text embedding files, converted once to a .npy matrix next to it for the vocab')
 
 tf.app.flags.DEFINE_boolean('pubmed', False, 'pubmed data')
+tf.app.flags.DEFINE_boolean('id_cache', False, 'In train/eval mode, read the token ids of the examples from a cache next to each datafile instead of processing the text every epoch. The cache is keyed by the vocab and the truncation hyperparameters, and is built on first use.')
+tf.app.flags.DEFINE_integer('shuffle_buffer_size', 0, 'If > 0, in train/eval mode the examples go through a shuffle buffer of this many examples per reader thread, so that examples are mixed within datafiles and not only by file order. Memory grows with the buffer size.')
+tf.app.flags.DEFINE_integer('shuffle_block_size', 0, 'If > 0, in train/eval mode datafiles that can be read by position (with an offset index, block-compressed or columnar) are read in blocks of this many examples in random order.')
+tf.app.flags.DEFINE_integer('shuffle_seed', None, 'Seed of the shuffle buffer and block order, from which each reader thread derives its own. Random if not set.')
+tf.app.flags.DEFINE_integer('batcher_processes', 0, 'If > 0, in train/eval mode the batches are built by this many worker processes instead of threads, and handed to the model through shared memory, so that batching scales with the number of cores.')
+tf.app.flags.DEFINE_integer('example_threads', 16, 'In train/eval mode, number of batcher threads that read and process the examples.')
+tf.app.flags.DEFINE_integer('batch_threads', 4, 'In train/eval mode, number of batcher threads that make batches of the examples.')
+tf.app.flags.DEFINE_boolean('batcher_autoscale', False, 'In train/eval mode, adjust the number of batcher threads to the load: add threads while the model waits for batches and retire them while the batches are ahead, between 1 and --example_threads / --batch_threads. The decisions are logged.')
+tf.app.flags.DEFINE_boolean('reader_cursor', True, 'In train mode, save the position of the batcher in the dataset next to the checkpoints in log_root/train whenever a checkpoint is written, and continue from it when training restarts. Only the position is restored, not the order: the examples that were in the shuffle buffers and queues are skipped, and the shuffling after the restart differs from that of an uninterrupted run.')
 
 tf.app.flags.DEFINE_string('optimizer', 'adagrad', 'optimizer can be `adagrad`, `adam` or `sgd`')
 tf.app.flags.DEFINE_boolean('multi_layer_encoder', False, 'whether encoder is a multilayer LSTM')
@@ -254,6 +276,20 @@ def convert_linear_attn_to_hier_model():
     exit()
 
 
+class CursorSaver(tfv1.train.Saver):
+  """A Saver that also saves the reader cursor of the batcher (see Batcher.save_cursor) whenever it writes a checkpoint"""
+
+  def __init__(self, batcher, cursor_path, *args, **kwargs):
+    super(CursorSaver, self).__init__(*args, **kwargs)
+    self._batcher = batcher
+    self._cursor_path = cursor_path
+
+  def save(self, *args, **kwargs):
+    ckpt = super(CursorSaver, self).save(*args, **kwargs)
+    self._batcher.save_cursor(self._cursor_path)
+    return ckpt
+
+
 def setup_training(model, batcher):
     """Does setup before starting training (run_training)"""
     train_dir = os.path.join(FLAGS.log_root, "train")
@@ -270,7 +306,10 @@ def setup_training(model, batcher):
 
     if FLAGS.restore_best_model:
       restore_best_model()
-    saver = tfv1.train.Saver(max_to_keep=3) # keep 3 checkpoints at a time
+    if FLAGS.reader_cursor: # the reader position is saved with every checkpoint
+      saver = CursorSaver(batcher, os.path.join(train_dir, READER_CURSOR), max_to_keep=3)
+    else:
+      saver = tfv1.train.Saver(max_to_keep=3) # keep 3 checkpoints at a time
 
     sv = tf.train.Supervisor(logdir=train_dir,
                              is_chief=True,
@@ -338,6 +377,8 @@ def run_training(model, batcher, sess_context_manager, sv, summary_writer):
             summary_writer.add_summary(
                 summaries, train_step)  # write the summaries
             if train_step % 100 == 0:  # flush the summary writer every so often
+                # with the telemetry of the batcher, to tell steps waiting for data from steps waiting for compute
+                summary_writer.add_summary(batcher.summary(), train_step)
                 summary_writer.flush()
 
 def run_eval(model, batcher, vocab, hier=False):
@@ -414,7 +455,7 @@ def main(unused_argv):
             raise Exception(
                 "Logdir %s doesn't exist. Run in train mode to create it." % (FLAGS.log_root))
 
-    vocab = Vocab(FLAGS.vocab_path, FLAGS.vocab_size)  # create a vocabulary
+    vocab = Vocab(FLAGS.vocab_path, FLAGS.vocab_size, FLAGS.bpe_codes or None)  # create a vocabulary
 
     # If in decode mode, set batch_size = beam_size
     # Reason: in decode mode, we decode one example at a time.
@@ -428,24 +469,40 @@ def main(unused_argv):
         raise Exception(
             "The single_pass flag should only be True in decode mode")
 
+    if FLAGS.batch_tokens and FLAGS.hier:
+        raise Exception(
+            "The batch_tokens flag is not supported with the hier model, its encoder inputs have a fixed length")
+
+    # Beam search takes the 2*beam_size most probable candidates of each step
+    if 0 < FLAGS.decode_shortlist < 2 * FLAGS.beam_size:
+        raise Exception(
+            "The decode_shortlist should be at least 2*beam_size")
+
     # Make a namedtuple hps, containing the values of the hyperparameters that
     # the model needs
     hparam_list = ['mode', 'lr', 'adagrad_init_acc', 'rand_unif_init_mag', 'trunc_norm_init_std', 'max_grad_norm',
-                   'hidden_dim', 'emb_dim', 'batch_size', 'max_dec_steps', 'max_enc_steps', 'coverage', 'cov_loss_wt', 'pointer_gen', 'min_lr',
+                   'hidden_dim', 'emb_dim', 'batch_size', 'batch_tokens', 'max_dec_steps', 'max_enc_steps', 'coverage', 'cov_loss_wt', 'pointer_gen', 'min_lr',
                    'max_abstract_len', 'min_abstract_len', 'max_article_sents',
                    'max_section_len','min_section_len','use_sections','max_article_len',
                    'max_intro_len', 'max_conclusion_len',
                    'max_intro_sents', 'max_conclusion_sents', 'max_section_sents',
                    'enc_layers', 'optimizer', 'multi_layer_encoder',
                    'num_sections', 'hier', 'phased_lstm', 'output_weight_sharing', 'use_do' ,'do_prob', 
-                   'embeddings_path', 'pretrained_embeddings', 'pubmed', 'num_gpus', 'split_intro', 'temperature']
+                   'embeddings_path', 'pretrained_embeddings', 'pubmed', 'num_gpus', 'split_intro', 'temperature',
+                   'id_cache', 'shuffle_buffer_size', 'shuffle_block_size', 'shuffle_seed', 'batcher_processes',
+                   'example_threads', 'batch_threads', 'batcher_autoscale',
+                   'decode_shortlist', 'decode_shortlist_fallback']
     hps_dict = {}
     for key, val in list(FLAGS.__flags.items()):  # for each flag
         if key in hparam_list:  # if it's in the list
             hps_dict[key] = val.value  # add it to the dict
     hps = namedtuple("HParams", list(hps_dict.keys()))(**hps_dict)
 
-    # Create a batcher object that will create minibatches of data
+    # Create a batcher object that will create minibatches of data. In train mode it
+    # continues from the reader position saved with the checkpoints, if any
+    cursor_path = None
+    if hps.mode == 'train' and FLAGS.reader_cursor:
+        cursor_path = os.path.join(FLAGS.log_root, "train", READER_CURSOR)
     batcher = Batcher(FLAGS.data_path, vocab, hps,
                       FLAGS.single_pass,
                       FLAGS.article_id_key,
@@ -453,7 +510,8 @@ def main(unused_argv):
                       FLAGS.abstract_key,
                       FLAGS.labels_key,
                       FLAGS.section_names_key,
-                      FLAGS.sections_key)
+                      FLAGS.sections_key,
+                      cursor_path=cursor_path)
 
     tfv1.set_random_seed(111)  # a seed value for randomness
 
@@ -0,0 +1,75 @@
+"""
+Micro-benchmark of the assembly of Batches from Examples (batch_reader.Batch), reports batches per second.
+The Examples are made from random token ids, so no data is needed, only a vocab file.
+Usage: python bench_batch.py   --batch_size 16   --max_enc_steps 2400
+       python bench_batch.py   --batch_size 16   --hier   --num_sections 6   --max_section_len 400
+"""
+import os
+import sys
+import time
+from collections import namedtuple
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import data
+import batch_reader
+
+HParams = namedtuple('HParams', 'batch_size batch_tokens max_enc_steps max_dec_steps pointer_gen hier num_sections max_section_len')
+
+
+def make_example(vocab, hps, rng):
+  """Returns an Example of random token ids, with lengths up to the maximums of hps"""
+  vsize = vocab.size()
+  max_enc_len = min(hps.max_enc_steps, hps.num_sections * hps.max_section_len) if hps.hier else hps.max_enc_steps
+  enc_input = rng.randint(4, vsize, rng.randint(max_enc_len // 2, max_enc_len + 1)).tolist()
+  abs_ids = rng.randint(4, vsize, rng.randint(hps.max_dec_steps // 2, hps.max_dec_steps + 10)).tolist()
+  enc_input_extend_vocab, article_oovs, abs_ids_extend_vocab = None, None, None
+  if hps.pointer_gen:
+    article_oovs = ['oov%d' % k for k in range(rng.randint(0, 20))]
+    enc_input_extend_vocab = [vsize + rng.randint(len(article_oovs)) if article_oovs and rng.rand() < 0.02 else i
+                              for i in enc_input]
+    abs_ids_extend_vocab = list(abs_ids)
+  enc_sections, enc_sections_extend_vocab, num_words_section_nopad = None, None, None
+  if hps.hier:
+    enc_sections = [rng.randint(4, vsize, rng.randint(1, hps.max_section_len + 1)).tolist()
+                    for _ in range(rng.randint(2, hps.num_sections + 1))]
+    if hps.pointer_gen:
+      enc_sections_extend_vocab = [[vsize + rng.randint(len(article_oovs)) if article_oovs and rng.rand() < 0.02 else i
+                                    for i in s] for s in enc_sections]
+    num_words_section_nopad = [len(s) for s in enc_sections]
+  return batch_reader.Example.from_ids('bench', enc_input, enc_input_extend_vocab, article_oovs,
+                                       abs_ids, abs_ids_extend_vocab, enc_sections, enc_sections_extend_vocab,
+                                       num_words_section_nopad, vocab, hps)
+
+
+def bench(vocab, hps, num_batches, seed=0):
+  """Returns the number of batches per second that batch_reader.Batch assembles. The Examples are made beforehand and not timed."""
+  rng = np.random.RandomState(seed)
+  example_lists = [[make_example(vocab, hps, rng) for _ in range(hps.batch_size)] for _ in range(num_batches)]
+  t0 = time.time()
+  for example_list in example_lists:
+    batch_reader.Batch(example_list, hps, vocab)
+  return num_batches / (time.time() - t0)
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    ap = ArgumentParser()
+    ap.add_argument('--vocab_path', default=os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data', 'vocab.gz'),
+                    help='path to the vocab file')
+    ap.add_argument('--vocab_size', type=int, default=50000)
+    ap.add_argument('--batch_size', type=int, default=16)
+    ap.add_argument('--max_enc_steps', type=int, default=2400)
+    ap.add_argument('--max_dec_steps', type=int, default=210)
+    ap.add_argument('--no_pointer_gen', action='store_true', help='benchmark batches without the pointer-generator fields')
+    ap.add_argument('--hier', action='store_true', help='benchmark batches with sections')
+    ap.add_argument('--num_sections', type=int, default=6)
+    ap.add_argument('--max_section_len', type=int, default=400)
+    ap.add_argument('--num_batches', type=int, default=50, help='number of batches to time')
+    args = ap.parse_args()
+
+    vocab = data.Vocab(args.vocab_path, args.vocab_size)
+    hps = HParams(args.batch_size, 0, args.max_enc_steps, args.max_dec_steps, not args.no_pointer_gen,
+                  args.hier, args.num_sections, args.max_section_len)
+    print('{:.1f} batches/s'.format(bench(vocab, hps, args.num_batches)))
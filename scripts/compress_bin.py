@@ -0,0 +1,84 @@
+"""
+Script to convert .bin datafiles to block-compressed shards (see data.CompressedRecordWriter) and back.
+Compressed shards can be used as training data in place of the .bin datafiles, they are decompressed block by block while reading.
+The output goes to a directory of its own, so that a wildcard data path matches the datafiles of one format only.
+Usage: python compress_bin.py   "data/chunked/train_*.bin"    data/compressed                (writes data/compressed/train_000.binz, ...)
+       python compress_bin.py   "data/compressed/train_*.binz"   data/chunked --decompress  (writes data/chunked/train_000.bin, ...)
+"""
+import os
+import sys
+import struct
+
+from tensorflow.core.example import example_pb2
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import data
+
+COMPRESSED_EXT = '.binz'
+
+
+def compress(infile, outfile, block_size=data.COMPRESSED_BLOCK_SIZE, level=6):
+  writer = data.CompressedRecordWriter(outfile, block_size, level)
+  num_records = 0
+  for example_str in data.read_records(infile):
+    writer.write(example_str)
+    num_records += 1
+  writer.close()
+  return num_records
+
+
+def decompress(infile, outfile, article_id_key='article_id'):
+  index_writer = data.RecordIndexWriter()
+  num_records = 0
+  with open(outfile, 'wb') as writer:
+    for example_str in data.read_records(infile):
+      str_len = len(example_str)
+      writer.write(struct.pack('q', str_len))
+      writer.write(struct.pack('%ds' % str_len, example_str))
+      article_id = example_pb2.Example.FromString(example_str).features.feature[article_id_key].bytes_list.value[0]
+      index_writer.add(str_len, article_id.decode('utf-8', 'ignore'))
+      num_records += 1
+  index_writer.save(outfile)
+  return num_records
+
+
+def _out_path(infile, out_dir, ext):
+  root, old_ext = os.path.splitext(os.path.basename(infile))
+  return os.path.join(out_dir, root + ext if old_ext in ('.bin', COMPRESSED_EXT) else root + old_ext + ext)
+
+
+def convert_all(data_path, out_dir, to_compressed=True, block_size=data.COMPRESSED_BLOCK_SIZE, level=6):
+  filelist = sorted(data.list_datafiles(data_path))
+  assert filelist, ('Error: Empty filelist at %s' % data_path)
+  # next to the input, train_*.bin and train_*.binz would both match the data path train_* and be read twice per epoch
+  in_dirs = set(os.path.realpath(os.path.dirname(f)) for f in filelist)
+  assert os.path.realpath(out_dir) not in in_dirs, ('Error: the output directory %s holds input datafiles, use another one' % out_dir)
+  if not os.path.exists(out_dir):
+    os.makedirs(out_dir)
+  for f in filelist:
+    if data.is_compressed(f) == to_compressed:
+      print('Skipping {}, it is already {}'.format(f, 'compressed' if to_compressed else 'uncompressed'))
+      continue
+    if to_compressed:
+      outfile = _out_path(f, out_dir, COMPRESSED_EXT)
+      num_records = compress(f, outfile, block_size, level)
+    else:
+      outfile = _out_path(f, out_dir, '.bin')
+      num_records = decompress(f, outfile)
+    print('Wrote {:d} records of {} to {} ({:.1f} MB -> {:.1f} MB)'.format(
+      num_records, f, outfile, os.path.getsize(f) / 2**20, os.path.getsize(outfile) / 2**20))
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    ap = ArgumentParser()
+    ap.add_argument('data_path', help='path to the datafiles to convert, can include wildcards')
+    ap.add_argument('out_dir', help='directory of the converted datafiles, other than that of the input datafiles')
+    ap.add_argument('--decompress', action='store_true',
+                    help='convert block-compressed shards back to .bin datafiles')
+    ap.add_argument('--block_size', type=int, default=data.COMPRESSED_BLOCK_SIZE,
+                    help='number of records per compressed block')
+    ap.add_argument('--level', type=int, default=6, help='zlib compression level')
+    args = ap.parse_args()
+
+    convert_all(args.data_path, args.out_dir, not args.decompress, args.block_size, args.level)
@@ -0,0 +1,31 @@
+"""
+Script to write the sidecar offset index (<file>.bin.idx) of existing .bin datafiles,
+so that they can be memory-mapped and randomly accessed by data.RecordReader
+Usage: python index_bin.py   "data/train_*.bin"
+"""
+import os
+import sys
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import data
+
+
+def index_all(data_path, article_id_key='article_id'):
+  filelist = sorted(data.list_datafiles(data_path))
+  assert filelist, ('Error: Empty filelist at %s' % data_path)
+  for f in filelist:
+    if data.is_columnar(f) or data.is_compressed(f): # these carry their own index
+      continue
+    offsets, _, _ = data.build_record_index(f, article_id_key)
+    print('Indexed {:d} records of {}'.format(len(offsets), f))
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    ap = ArgumentParser()
+    ap.add_argument('data_path', help='path to the .bin datafiles, can include wildcards')
+    ap.add_argument('--article_id_key', help='tf.Example feature key for article id',
+                    default='article_id')
+    args = ap.parse_args()
+
+    index_all(args.data_path, args.article_id_key)
@@ -3,10 +3,16 @@ Script to convert jsonlines files to tensorflow binary files
 Usage: python json_to_bin.py   demofile.txt   output_demo.bin
 If you want to create vocabulary you can pass additional path to the output vocab file
 python json_to_bin.py   input.txt    output.bin   --vocab_file   output.vocab
+To convert in parallel into numbered chunk files output_000.bin, output_001.bin, ... (read with output_*.bin)
+python json_to_bin.py   input.txt    output.bin   --num_workers   8
+To write a columnar dataset directory (memory-mapped token and offset arrays) instead of a .bin file
+python json_to_bin.py   input.txt    output_dir   --columnar
 """
 import os
+import sys
 import glob
 import gzip
+import multiprocessing
 import json
 import random
 import collections
@@ -18,6 +24,9 @@ import re
 from itertools import chain
 import pathlib
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import data as data_utils
+
 VOCAB_SIZE=50000
 
 dm_single_close_quote = u'\u2019'  # unicode
@@ -62,19 +71,31 @@ def _nested_list_to_string(lst):
   return ret
 
 
-def write_to_bin(infile, outfile, vocab_file=False):
+def _write_examples(lines, outfile, vocab_counter=None, total_bytes=None):
+  """Converts jsonlines (bytes) to tf.Examples, and writes them and their offset index to outfile.
+  Updates vocab_counter with their tokens if given. Returns the number of articles written."""
   pathlib.Path(outfile).parent.mkdir(parents=True, exist_ok=True)
   writer = open(outfile, 'wb')
-  if vocab_file:
-    vocab_counter = collections.Counter()
-  num_articles = sum([1 for _ in open(infile)])
+  index_writer = data_utils.RecordIndexWriter()
   idx = 0
-  for line in open(infile):
-    idx += 1
+  read_bytes = 0
+  for line in lines:
+    read_bytes += len(line)
     if not line.strip():
       continue
     line = line.strip()
-    data = json.loads(line)
+    data = json.loads(line.decode('utf-8'))
+
+    # Write the vocab to file, if applicable. The documents left out below are counted too, so that
+    # the vocab is the same as the vocab of the unfiltered conversion
+    if vocab_counter is not None:
+      article_body_str = _list_to_string(list(chain.from_iterable(data['sections'])))
+      _update_vocab(vocab_counter, article_body_str, _list_to_string(data['abstract_text']))
+
+    # leave out the documents that the batcher would discard anyway
+    if not data_utils.keep_document(data['sections']):
+      continue
+    idx += 1
     tf_example = tf.train.Example()
     article_id = data['article_id'].encode('ascii', 'ignore')
     tf_example.features.feature['article_id'].bytes_list.value.extend([article_id])
@@ -85,13 +106,14 @@ def write_to_bin(infile, outfile, vocab_file=False):
     sections_str = _nested_list_to_string(data['sections'])
     tf_example.features.feature['sections'].bytes_list.value.extend([sections_str.encode('utf-8', 'ignore')])
 
-    # add article body
-    article_body = list(chain.from_iterable(data['sections']))
-    article_body_str = _list_to_string(article_body)
-    tf_example.features.feature['article_body'].bytes_list.value.extend([article_body_str.encode('utf-8', 'ignore')])
+    # the article body is not stored, as it is the flattened sections.
+    # readers derive it from the sections (see Batcher.text_generator)
 
     # add section names
     section_names = [e if e else 'None' for e in data['section_names']]
+    # positions of the introduction, conclusion and body sections of the hier model, empty if it can't use the document
+    roles = data_utils.section_roles(section_names, len(data['sections']))
+    tf_example.features.feature['section_roles'].int64_list.value.extend(roles)
     section_names = _list_to_string(section_names)
     tf_example.features.feature['section_names'].bytes_list.value.extend([section_names.encode('utf-8', 'ignore')])
 
@@ -105,41 +127,142 @@ def write_to_bin(infile, outfile, vocab_file=False):
     writer.write(struct.pack('q', str_len))
     # s format is bytes (char[])
     writer.write(struct.pack('%ds' % str_len, tf_example_str))
+    index_writer.add(str_len, article_id.decode('ascii'))
+
+    if total_bytes and idx % 5 == 0:
+      print('Finished writing {:.3f}\% of {:.1f} MB ({:d} articles).'.format(
+        read_bytes * 100.0 / total_bytes, total_bytes / 2**20, idx), end='\r', flush=True)
 
-    if idx % 5 == 0:
-      print('Finished writing {:.3f}\% of {:d} articles.'.format(
-        idx * 100.0 / num_articles, num_articles), end='\r', flush=True)
-
-    # Write the vocab to file, if applicable
-    if vocab_file:
-      art_tokens = article_body_str.split(' ')
-      art_tokens = [t for t in art_tokens
-                    if t not in [
-                      SENTENCE_START, SENTENCE_END, SENTENCE_SEPARATOR,
-                      SECTION_SEPARATOR.strip(),
-                      LIST_SEPARATOR.strip()]]
-      abs_tokens = abstract_str.split(' ')
-      # remove these tags from vocab
-      abs_tokens = [t for t in abs_tokens if t not in [
-        SENTENCE_START, SENTENCE_END, SENTENCE_SEPARATOR,
-        SECTION_SEPARATOR.strip(),
-        LIST_SEPARATOR.strip()]]
-      tokens = art_tokens + abs_tokens
-      tokens = [t.strip() for t in tokens]  # strip
-      tokens = [t for t in tokens if t != ""]  # remove empty
-      vocab_counter.update(tokens)
+  writer.close()
+  index_writer.save(outfile)
+  return idx
 
 
+def write_to_bin(infile, outfile, vocab_file=False):
+  vocab_counter = collections.Counter() if vocab_file else None
+  with open(infile, 'rb') as lines:
+    _write_examples(lines, outfile, vocab_counter, os.path.getsize(infile))
   print("Finished writing file %s\n" % outfile)
-  writer.close()
 
   # write vocab to file
   if vocab_file:
-    print("Writing vocab file...")
-    with open(vocab_file, 'w') as writer:
-      for word, count in vocab_counter.most_common(VOCAB_SIZE):
-        writer.write(word + ' ' + str(count) + '\n')
-    print("Finished writing vocab file")
+    _write_vocab(vocab_counter, vocab_file)
+
+
+def _read_lines(infile, start, end):
+  """Generates the lines of infile (as bytes) that start in the byte range [start, end)"""
+  with open(infile, 'rb') as f:
+    if start > 0:
+      # skip the rest of the line that started before start (nothing if start is a line start)
+      f.seek(start - 1)
+      f.readline()
+    while f.tell() < end:
+      line = f.readline()
+      if not line:
+        break
+      yield line
+
+
+def _write_chunk(task):
+  infile, start, end, chunk_file, make_vocab = task
+  vocab_counter = collections.Counter() if make_vocab else None
+  num_articles = _write_examples(_read_lines(infile, start, end), chunk_file, vocab_counter)
+  return chunk_file, num_articles, vocab_counter
+
+
+def write_to_chunks(infile, outfile, vocab_file=False, num_workers=None, chunk_size_mb=64):
+  """Converts the jsonlines file in parallel: it is split into byte ranges of chunk_size_mb, that
+  worker processes convert to numbered chunk files named after outfile (e.g. train.bin ->
+  train_000.bin, train_001.bin, ...), which example_generator reads with a wildcard (train_*.bin).
+  The vocab counts of the chunks are merged in chunk order, so that the vocab file is the same as
+  the one of write_to_bin."""
+  num_workers = num_workers or multiprocessing.cpu_count()
+  total_bytes = os.path.getsize(infile)
+  chunk_bytes = int(chunk_size_mb * 2**20)
+  root, ext = os.path.splitext(outfile)
+  tasks = [(infile, start, start + chunk_bytes, '%s_%03d%s' % (root, i, ext or '.bin'), bool(vocab_file))
+           for i, start in enumerate(range(0, total_bytes, chunk_bytes))]
+  vocab_counter = collections.Counter()
+  num_articles = 0
+  pool = multiprocessing.Pool(num_workers)
+  try:
+    for i, (chunk_file, n, chunk_counter) in enumerate(pool.imap(_write_chunk, tasks)):
+      num_articles += n
+      if chunk_counter:
+        vocab_counter.update(chunk_counter)
+      print('Finished writing {:d} of {:d} chunks ({:d} articles).'.format(
+        i + 1, len(tasks), num_articles), end='\r', flush=True)
+  finally:
+    pool.close()
+    pool.join()
+  print("Finished writing {:d} articles to {:d} chunks {}_*{}\n".format(
+    num_articles, len(tasks), root, ext or '.bin'))
+
+  if vocab_file:
+    _write_vocab(vocab_counter, vocab_file)
+
+
+def write_to_columnar(infile, outdir, vocab_file=False):
+  """Writes the jsonlines data as a columnar dataset directory (see data.ColumnarWriter),
+  that the batcher reads through memory-mapped token and offset arrays instead of tf.Examples"""
+  writer = data_utils.ColumnarWriter(outdir)
+  if vocab_file:
+    vocab_counter = collections.Counter()
+  total_bytes = os.path.getsize(infile)
+  idx = 0
+  read_bytes = 0
+  for line in open(infile, 'rb'):
+    read_bytes += len(line)
+    if not line.strip():
+      continue
+    data = json.loads(line.strip().decode('utf-8'))
+    if vocab_file: # counts the documents left out too, see _write_examples
+      _update_vocab(vocab_counter,
+                    _list_to_string(list(chain.from_iterable(data['sections']))),
+                    _list_to_string(data['abstract_text']))
+    if not data_utils.keep_document(data['sections']):
+      continue
+    idx += 1
+    article_id = data['article_id'].encode('ascii', 'ignore').decode('ascii')
+    section_names = [e if e else 'None' for e in data['section_names']]
+    writer.add(article_id, data['abstract_text'], data['sections'], section_names)
+
+    if total_bytes and idx % 5 == 0:
+      print('Finished writing {:.3f}\% of {:.1f} MB ({:d} articles).'.format(
+        read_bytes * 100.0 / total_bytes, total_bytes / 2**20, idx), end='\r', flush=True)
+
+  writer.close()
+  print("Finished writing columnar dataset %s\n" % outdir)
+
+  if vocab_file:
+    _write_vocab(vocab_counter, vocab_file)
+
+
+def _update_vocab(vocab_counter, article_body_str, abstract_str):
+  art_tokens = article_body_str.split(' ')
+  art_tokens = [t for t in art_tokens
+                if t not in [
+                  SENTENCE_START, SENTENCE_END, SENTENCE_SEPARATOR,
+                  SECTION_SEPARATOR.strip(),
+                  LIST_SEPARATOR.strip()]]
+  abs_tokens = abstract_str.split(' ')
+  # remove these tags from vocab
+  abs_tokens = [t for t in abs_tokens if t not in [
+    SENTENCE_START, SENTENCE_END, SENTENCE_SEPARATOR,
+    SECTION_SEPARATOR.strip(),
+    LIST_SEPARATOR.strip()]]
+  tokens = art_tokens + abs_tokens
+  tokens = [t.strip() for t in tokens]  # strip
+  tokens = [t for t in tokens if t != ""]  # remove empty
+  vocab_counter.update(tokens)
+
+
+def _write_vocab(vocab_counter, vocab_file):
+  print("Writing vocab file...")
+  with open(vocab_file, 'w') as writer:
+    for word, count in vocab_counter.most_common(VOCAB_SIZE):
+      writer.write(word + ' ' + str(count) + '\n')
+  print("Finished writing vocab file")
 
 
 
@@ -151,6 +274,21 @@ if __name__ == '__main__':
     ap.add_argument('--vocab_file', help='path to the output vocabulary file'
                                          'this is optional, if not set it will not create'
                                          'vocab', default=False)
+    ap.add_argument('--columnar', action='store_true',
+                    help='write a columnar dataset directory at outfile instead of a .bin file')
+    ap.add_argument('--num_workers', type=int, default=0,
+                    help='convert in parallel with this many processes (-1 for all cores), '
+                         'writing numbered chunk files outfile_000.bin, outfile_001.bin, ...')
+    ap.add_argument('--chunk_size_mb', type=float, default=64,
+                    help='size of the input byte range converted into each chunk file')
     args = ap.parse_args()
 
-    write_to_bin(args.infile, args.outfile, args.vocab_file)
+    if args.columnar and args.num_workers:
+      ap.error('--columnar writes a single dataset directory, it can\'t be used with --num_workers')
+    if args.columnar:
+      write_to_columnar(args.infile, args.outfile, args.vocab_file)
+    elif args.num_workers:
+      write_to_chunks(args.infile, args.outfile, args.vocab_file,
+                      args.num_workers if args.num_workers > 0 else None, args.chunk_size_mb)
+    else:
+      write_to_bin(args.infile, args.outfile, args.vocab_file)
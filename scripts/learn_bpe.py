@@ -0,0 +1,53 @@
+"""
+Script to learn the byte pair encoding (BPE) merges from the word counts of a vocab file written by json_to_bin.py or pubmed_write_bin.py,
+and to write the subword vocab file to train with instead of the word vocab (see --bpe_codes in run_summarization.py)
+Usage: python learn_bpe.py   data/vocab   data/vocab.bpe   data/vocab.subwords   --num_merges 16000
+"""
+import os
+import sys
+import collections
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import bpe
+
+
+def read_word_counts(vocab_file):
+  word_counts = []
+  with open(vocab_file, encoding='utf-8') as f:
+    for line in f:
+      pieces = line.split()
+      if len(pieces) == 2:
+        word_counts.append((pieces[0], int(pieces[1])))
+  return word_counts
+
+
+def learn(vocab_file, codes_file, subword_vocab_file, num_merges, min_count=2):
+  word_counts = read_word_counts(vocab_file)
+  merges = bpe.learn_bpe(word_counts, num_merges, min_count)
+  bpe.write_merges(merges, codes_file)
+  print('Wrote {:d} merges learned from {:d} words to {}'.format(len(merges), len(word_counts), codes_file))
+
+  tokenizer = bpe.BPE(codes_file)
+  subword_counter = collections.Counter()
+  for word, count in word_counts:
+    for subword in tokenizer.segment_word(word):
+      subword_counter[subword] += count
+  with open(subword_vocab_file, 'w', encoding='utf-8') as writer:
+    for subword, count in subword_counter.most_common():
+      writer.write(subword + ' ' + str(count) + '\n')
+  print('Wrote {:d} subwords to {}, use a --vocab_size of at least {:d}'.format(
+    len(subword_counter), subword_vocab_file, len(subword_counter) + 5))
+
+
+if __name__ == '__main__':
+    from argparse import ArgumentParser
+    ap = ArgumentParser()
+    ap.add_argument('vocab_file', help='path to the word vocab file ("<word> <count>" per line)')
+    ap.add_argument('codes_file', help='path to write the merges to')
+    ap.add_argument('subword_vocab_file', help='path to write the subword vocab file to')
+    ap.add_argument('--num_merges', type=int, default=16000, help='number of merges to learn')
+    ap.add_argument('--min_count', type=int, default=2,
+                    help='stop when the most frequent pair occurs less often than this')
+    args = ap.parse_args()
+
+    learn(args.vocab_file, args.codes_file, args.subword_vocab_file, args.num_merges, args.min_count)
@@ -1,5 +1,6 @@
 import spacy
 import os
+import sys
 import glob
 import gzip
 import pickle
@@ -12,6 +13,9 @@ import numbers
 import re
 from itertools import chain
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import data
+
 random.seed(200)
 
 CHUNK_SIZE = 2000
@@ -52,6 +56,7 @@ class BinWriter(object):
     while not finished:
       chunk_fname = os.path.join(self.chunks_dir, '%s_%03d.bin' %
                                  (set_name, chunk))  # new chunk
+      index_writer = data.RecordIndexWriter()
       with open(chunk_fname, 'wb') as writer:
         for _ in range(CHUNK_SIZE):
           len_bytes = reader.read(8)
@@ -62,7 +67,10 @@ class BinWriter(object):
           example_str = struct.unpack('%ds' % str_len, reader.read(str_len))[0]
           writer.write(struct.pack('q', str_len))
           writer.write(struct.pack('%ds' % str_len, example_str))
+          article_id = tf.train.Example.FromString(example_str).features.feature['article_id'].bytes_list.value[0]
+          index_writer.add(str_len, article_id.decode('ascii'))
         chunk += 1
+      index_writer.save(chunk_fname)
 
 
   def chunk_all(self):
@@ -127,11 +135,36 @@ class BinWriter(object):
     for set_name in sets:
       print('processing {} set'.format(set_name))
       out_file = os.path.join(outdir, set_name) + '.bin'
+      index_writer = data.RecordIndexWriter()
       with open(out_file, 'wb') as writer:
         num_articles = len(sets[set_name])
         for idx, f in enumerate(sets[set_name]):
           with gzip.open(f) as f_:
             article_json = pickle.load(f_)
+          # Write the vocab to file, if applicable. The documents left out below are counted too, so that
+          # the vocab is the same as the vocab of the unfiltered conversion
+          if makevocab:
+            article_body_str = self._list_to_string(list(chain.from_iterable(article_json['sections'])))
+            art_tokens = article_body_str.split(' ')
+            art_tokens = [t for t in art_tokens
+                          if t not in [
+                SENTENCE_START, SENTENCE_END, SENTENCE_SEPARATOR,
+                SECTION_SEPARATOR.strip(),
+                LIST_SEPARATOR.strip()]]
+            abs_tokens = article_body_str.split(' ')
+            # remove these tags from vocab
+            abs_tokens = [t for t in abs_tokens if t not in [
+                SENTENCE_START, SENTENCE_END, SENTENCE_SEPARATOR,
+                SECTION_SEPARATOR.strip(),
+                LIST_SEPARATOR.strip()]]
+            tokens = art_tokens + abs_tokens
+            tokens = [t.strip() for t in tokens]  # strip
+            tokens = [t for t in tokens if t != ""]  # remove empty
+            vocab_counter.update(tokens)
+
+          # leave out the documents that the batcher would discard anyway
+          if not data.keep_document(article_json['sections']):
+            continue
           tf_example = tf.train.Example()
   
           article_id = f.split('/')[-1].replace('.pkl.gz', '').encode('ascii', 'ignore')
@@ -160,13 +193,14 @@ class BinWriter(object):
           sections_str = self._nested_list_to_string(new_sections)
           tf_example.features.feature['sections'].bytes_list.value.extend([sections_str.encode('utf-8', 'ignore')])
           
-          # add article body
-          article_body = list(chain.from_iterable(new_sections))
-          article_body_str = self._list_to_string(article_body)
-          tf_example.features.feature['article_body'].bytes_list.value.extend([article_body_str.encode('utf-8', 'ignore')])
+          # the article body is not stored, as it is the flattened sections.
+          # readers derive it from the sections (see Batcher.text_generator)
           
           # add section names
           section_names = [e if e else 'None' for e in article_json['section_names']]
+          # positions of the introduction, conclusion and body sections of the hier model, empty if it can't use the document
+          roles = data.section_roles(section_names, len(new_sections))
+          tf_example.features.feature['section_roles'].int64_list.value.extend(roles)
           section_names = self._list_to_string(section_names)
           tf_example.features.feature['section_names'].bytes_list.value.extend([section_names.encode('utf-8', 'ignore')])  
           
@@ -177,31 +211,14 @@ class BinWriter(object):
           writer.write(struct.pack('q', str_len))
           # s format is bytes (char[])
           writer.write(struct.pack('%ds' % str_len, tf_example_str))
+          index_writer.add(str_len, article_id.decode('ascii'))
   
           if idx % 5 == 0:
             print('Finished writing {:.3f}\% of {:d} articles.'.format(
                 idx * 100.0 / num_articles, num_articles), end='\r', flush=True)
   
-          # Write the vocab to file, if applicable
-          if makevocab:
-            art_tokens = article_body_str.split(' ')
-            art_tokens = [t for t in art_tokens
-                          if t not in [
-                SENTENCE_START, SENTENCE_END, SENTENCE_SEPARATOR,
-                SECTION_SEPARATOR.strip(),
-                LIST_SEPARATOR.strip()]]
-            abs_tokens = article_body_str.split(' ')
-            # remove these tags from vocab
-            abs_tokens = [t for t in abs_tokens if t not in [
-                SENTENCE_START, SENTENCE_END, SENTENCE_SEPARATOR,
-                SECTION_SEPARATOR.strip(),
-                LIST_SEPARATOR.strip()]]
-            tokens = art_tokens + abs_tokens
-            tokens = [t.strip() for t in tokens]  # strip
-            tokens = [t for t in tokens if t != ""]  # remove empty
-            vocab_counter.update(tokens)
-  
         print("Finished writing file %s\n" % out_file)
+      index_writer.save(out_file)
   
     # write vocab to file
     if makevocab:
@@ -8,6 +8,7 @@ from pathlib import Path
 import os
 import collections
 import re
+from itertools import chain
 
 # To represent list of sections as string and retrieve it back
 SECTION_SEPARATOR = ' <SCTN/> '
@@ -116,7 +117,6 @@ class BinReader:
             e = six.next(example_gen)
             try:
                 article_id = self._get_example_feature(e, 'article_id')
-                article_text = self._get_example_feature(e, 'article_body')
                 abstract_text = self._get_example_feature(
                     e, 'abstract')
                 if not self._pubmed:
@@ -126,14 +126,17 @@ class BinReader:
                 sections = self._get_example_feature(e, 'sections')
 
                 # convert to list
-                article_text = _string_to_list(article_text)
+                sections = _string_to_nested_list(sections)  # list of lists
+                if 'article_body' in e.features.feature:
+                  article_text = _string_to_list(self._get_example_feature(e, 'article_body'))
+                else: # newer datafiles don't duplicate the sections as article_body
+                  article_text = list(chain.from_iterable(sections))
                 abstract_text = _string_to_list(abstract_text)
                 if not self._pubmed:
                   labels = _string_to_list(labels, dtype='int')
                 else:
                   labels = None
                 section_names = _string_to_list(section_names)
-                sections = _string_to_nested_list(sections)  # list of lists
             except ValueError:
                 tf.logging.error(
                     'Failed to get article or abstract from example')
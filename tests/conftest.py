@@ -0,0 +1,78 @@
+"""Fixtures of the tests: a small synthetic dataset converted by scripts/json_to_bin.py, and the hyperparameters of the Batcher."""
+import json
+import os
+import random
+import sys
+from collections import namedtuple
+
+import pytest
+import tensorflow as tf
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'scripts'))
+
+if not hasattr(tf, 'logging'): # the code uses tf.logging of tensorflow 1.x (requirements.txt), which tensorflow 2 has under compat.v1
+  tf.logging = tf.compat.v1.logging
+
+BATCHER_KEYS = ('article_id', 'article_body', 'abstract', 'labels', 'section_names', 'sections')
+
+DEFAULT_HPS = dict(
+  mode='train', batch_size=4, batch_tokens=0, max_enc_steps=200, max_dec_steps=20, beam_size=4,
+  pointer_gen=True, hier=False, num_sections=4, max_section_len=50, max_intro_len=60, max_conclusion_len=40,
+  max_intro_sents=10, max_conclusion_sents=10, max_section_sents=10, split_intro=False, pubmed=False,
+  max_article_sents=350, max_abstract_len=500, min_abstract_len=5, id_cache=False,
+  shuffle_buffer_size=0, shuffle_block_size=0, shuffle_seed=None,
+  batcher_processes=0, example_threads=4, batch_threads=2, batcher_autoscale=False)
+
+
+def make_hps(**kwargs):
+  """Returns the hyperparameters of the Batcher, DEFAULT_HPS updated with kwargs"""
+  hps = dict(DEFAULT_HPS)
+  hps.update(kwargs)
+  return namedtuple('HParams', list(hps.keys()))(**hps)
+
+
+def _sentence(rng, words, n):
+  return ' '.join(rng.choice(words) for _ in range(n)) + ' .'
+
+
+def make_documents(num_docs, seed=0):
+  """Returns jsonlines documents of random sentences, with an introduction, body sections and a conclusion"""
+  rng = random.Random(seed)
+  words = ['w%d' % i for i in range(300)]
+  docs = []
+  for i in range(num_docs):
+    names = ['introduction'] + ['section %d' % j for j in range(rng.randint(1, 4))] + ['conclusion']
+    docs.append({
+      'article_id': 'doc%03d' % i,
+      'abstract_text': ['<S> %s </S>' % _sentence(rng, words, rng.randint(5, 15)) for _ in range(rng.randint(1, 3))],
+      'section_names': names,
+      'sections': [[_sentence(rng, words, rng.randint(3, 20)) for _ in range(rng.randint(1, 6))] for _ in names],
+    })
+  docs.append({'article_id': 'nosections', 'abstract_text': ['<S> a b c d e f . </S>'],
+               'section_names': ['introduction'], 'sections': [['a b c .']]}) # left out by the converters
+  return docs
+
+
+@pytest.fixture(scope='session')
+def dataset(tmp_path_factory):
+  """A .bin datafile (with its offset index), a columnar dataset and the vocab of 40 synthetic documents"""
+  import json_to_bin
+  d = tmp_path_factory.mktemp('dataset')
+  docs = make_documents(40)
+  jsonl = str(d / 'docs.jsonl')
+  with open(jsonl, 'w') as f:
+    for doc in docs:
+      f.write(json.dumps(doc) + '\n')
+  paths = namedtuple('Dataset', 'docs jsonl bin columnar vocab')(
+    docs, jsonl, str(d / 'train.bin'), str(d / 'train_col'), str(d / 'vocab'))
+  json_to_bin.write_to_bin(paths.jsonl, paths.bin, paths.vocab)
+  json_to_bin.write_to_columnar(paths.jsonl, paths.columnar)
+  return paths
+
+
+@pytest.fixture(scope='session')
+def vocab(dataset):
+  import data
+  return data.Vocab(dataset.vocab, 500)
@@ -0,0 +1,103 @@
+import threading
+from collections import namedtuple
+
+import batch_reader
+
+HParams = namedtuple('HParams', 'batch_size example_threads batch_threads')
+
+
+class FakeQueue(object):
+  def __init__(self, size):
+    self.size = size
+
+  def qsize(self):
+    return self.size
+
+
+class FakeThread(object):
+  def __init__(self):
+    self.retired = threading.Event()
+
+
+class FakeTrainer(object):
+  """Stands in for the time module of batch_reader: every second slept by the autoscaling thread, the trainer
+  waits wait_per_sec secs in next_batch and takes a batch if taking. Stops the autoscaling thread after intervals."""
+
+  class Stop(Exception):
+    pass
+
+  def __init__(self, batcher, intervals, wait_per_sec, taking=True):
+    self._batcher = batcher
+    self._secs_left = intervals * batcher.AUTOSCALE_INTERVAL
+    self._wait_per_sec = wait_per_sec
+    self._taking = taking
+
+  def sleep(self, secs):
+    if self._secs_left == 0:
+      raise self.Stop()
+    self._secs_left -= 1
+    self._batcher._consumer_wait += self._wait_per_sec
+    self._batcher._num_consumed += self._taking
+
+
+def _batcher(example_threads, batch_threads, example_q_size, batch_q_size):
+  batcher = batch_reader.Batcher.__new__(batch_reader.Batcher)
+  batcher._hps = HParams(batch_size=4, example_threads=3, batch_threads=2)
+  batcher._example_queue = FakeQueue(example_q_size)
+  batcher._batch_queue = FakeQueue(batch_q_size)
+  batcher._threads_lock = threading.Lock()
+  batcher._example_q_threads = [FakeThread() for _ in range(example_threads)]
+  batcher._batch_q_threads = [FakeThread() for _ in range(batch_threads)]
+  batcher._start_thread = lambda *args: FakeThread()
+  batcher._consumer_wait = 0.0
+  batcher._num_consumed = 0
+  batcher._num_readers = 0
+  return batcher
+
+
+def _autoscale(batcher, monkeypatch, intervals, wait_per_sec, taking=True):
+  monkeypatch.setattr(batch_reader, 'time', FakeTrainer(batcher, intervals, wait_per_sec, taking))
+  try:
+    batcher._autoscale_threads()
+  except FakeTrainer.Stop:
+    pass
+  return len(batcher._example_q_threads), len(batcher._batch_q_threads)
+
+
+def test_full_queues_retire_example_threads_first(monkeypatch):
+  batcher = _batcher(3, 2, 0, batch_reader.Batcher.BATCH_QUEUE_MAX)
+  threads = batcher._example_q_threads + batcher._batch_q_threads
+  assert _autoscale(batcher, monkeypatch, 2, 0) == (1, 2)
+  assert _autoscale(batcher, monkeypatch, 3, 0) == (1, 1) # never fewer than 1
+  assert [t.retired.is_set() for t in threads] == [False, True, True, False, True]
+
+
+def test_no_retiring_while_the_trainer_takes_no_batches(monkeypatch):
+  batcher = _batcher(3, 2, 0, batch_reader.Batcher.BATCH_QUEUE_MAX)
+  assert _autoscale(batcher, monkeypatch, 3, 0, taking=False) == (3, 2)
+
+
+def test_waiting_trainer_adds_threads_to_the_stage_that_runs_short(monkeypatch):
+  starved = batch_reader.Batcher.AUTOSCALE_STARVED * 2
+  batcher = _batcher(1, 1, 0, 0) # examples run short
+  assert _autoscale(batcher, monkeypatch, 3, starved) == (3, 1) # up to hps.example_threads
+  batcher = _batcher(1, 1, 4 * batch_reader.Batcher.BATCH_QUEUE_MAX, 0) # batches run short
+  assert _autoscale(batcher, monkeypatch, 3, starved) == (1, 2)
+
+
+class FakeUnits(object):
+  def __init__(self):
+    self.handed_out = 0
+
+  def next(self):
+    self.handed_out += 1
+    return self.handed_out
+
+
+def test_retired_thread_takes_no_new_unit():
+  retired = threading.Event()
+  units = batch_reader._RetiringUnits(FakeUnits(), retired)
+  assert units.next() == 1
+  retired.set()
+  assert units.next() is None
+  assert units._work_units.handed_out == 1
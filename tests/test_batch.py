@@ -0,0 +1,48 @@
+import numpy as np
+
+import batch_reader
+import data
+from conftest import BATCHER_KEYS, make_hps
+
+
+def _example(vocab, hps, section_lens, first_id):
+  sections = [np.arange(first_id + 100 * j, first_id + 100 * j + n, dtype=np.int32) for j, n in enumerate(section_lens)]
+  sections_extend_vocab = [s.copy() for s in sections]
+  sections_extend_vocab[0][0] = vocab.size() # the in-article OOV 'oov'
+  enc_input = np.concatenate(sections)
+  return batch_reader.Example.from_ids('doc%d' % first_id, enc_input, enc_input, ['oov'], [5, 6], [5, 6],
+                                       sections, sections_extend_vocab, list(section_lens), vocab, hps)
+
+
+def test_hier_batch_of_sections_shorter_than_max_section_len(vocab):
+  hps = make_hps(hier=True, batch_size=3, num_sections=4, max_section_len=50)
+  examples = [_example(vocab, hps, [3, 7], 10), _example(vocab, hps, [5, 2, 4], 20)]
+  batch = batch_reader.Batch(examples, hps, vocab)
+  stride = batch.max_section_len
+  assert stride == 7
+  assert batch.enc_batch.shape == batch.enc_batch_extend_vocab.shape == (3, 4 * stride)
+  assert batch.enc_lens.tolist() == [10, 11, 0]
+  for i, ex in enumerate(examples):
+    mask = np.zeros(4 * stride, dtype=bool)
+    for j, (sec, sec_ext) in enumerate(zip(ex.enc_sections, ex.enc_sections_extend_vocab)):
+      assert batch.enc_batch[i, j * stride:j * stride + len(sec)].tolist() == sec.tolist()
+      assert batch.enc_batch_extend_vocab[i, j * stride:j * stride + len(sec)].tolist() == sec_ext.tolist()
+      mask[j * stride:j * stride + len(sec)] = True
+    assert (batch.enc_padding_mask[i] == mask).all()
+    assert (batch.enc_batch[i, ~mask] == batch.pad_id).all()
+  assert (batch.enc_batch == batch.batch_sections.reshape(3, -1)).all()
+
+
+def test_section_ids_extend_vocab(dataset):
+  vocab = data.Vocab(dataset.vocab, 100) # small, so that the articles have OOVs
+  hps = make_hps(hier=True)
+  batcher = batch_reader.Batcher(dataset.bin, vocab, hps, True, *BATCHER_KEYS)
+  num_oovs = 0
+  for ex in batcher._example_generator(data.WorkUnits(dataset.bin, True), shuffle=False):
+    for sec, sec_ext in zip(ex.enc_sections, ex.enc_sections_extend_vocab):
+      in_vocab = sec_ext < vocab.size()
+      assert (sec[in_vocab] == sec_ext[in_vocab]).all()
+      assert (sec[~in_vocab] == vocab.word2id(data.UNKNOWN_TOKEN)).all()
+      assert (sec_ext[~in_vocab] < vocab.size() + len(ex.article_oovs)).all()
+      num_oovs += (~in_vocab).sum()
+  assert num_oovs
@@ -0,0 +1,43 @@
+import multiprocessing
+
+import numpy as np
+import pytest
+
+import batch_reader
+import data
+from scripts import bench_batch
+
+
+@pytest.fixture
+def vocab(tmp_path):
+  path = tmp_path / 'vocab'
+  path.write_text(u''.join(u'w%d %d\n' % (i, 1000 - i) for i in range(200)))
+  return data.Vocab(str(path), 200)
+
+
+def _batch(vocab, hier):
+  hps = bench_batch.HParams(batch_size=4, batch_tokens=0, max_enc_steps=120, max_dec_steps=20, pointer_gen=True,
+                            hier=hier, num_sections=4, max_section_len=30)
+  rng = np.random.RandomState(0)
+  return batch_reader.Batch([bench_batch.make_example(vocab, hps, rng) for _ in range(hps.batch_size)], hps, vocab)
+
+
+@pytest.mark.parametrize('hier', [False, True])
+def test_batch_round_trips_through_a_shared_buffer(vocab, hier):
+  batch = _batch(vocab, hier)
+  buf = multiprocessing.RawArray('b', batch_reader._batch_bytes_bound(batch._hps))
+  layout, fields = batch_reader._batch_to_buffer(batch, buf)
+  copy = batch_reader._batch_from_buffer(layout, fields, buf, batch._hps)
+  assert sorted(vars(copy)) == sorted(vars(batch))
+  for k, v in vars(batch).items():
+    if isinstance(v, np.ndarray):
+      assert v.dtype == getattr(copy, k).dtype and np.array_equal(v, getattr(copy, k)), k
+    elif k != '_hps':
+      assert getattr(copy, k) == v, k
+  assert not copy.enc_batch.flags.owndata # a view of the buffer
+
+
+def test_batch_too_big_for_the_buffer(vocab):
+  batch = _batch(vocab, False)
+  buf = multiprocessing.RawArray('b', batch.enc_batch.nbytes // 2)
+  assert batch_reader._batch_to_buffer(batch, buf) is None
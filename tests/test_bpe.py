@@ -0,0 +1,37 @@
+import random
+from collections import Counter
+
+import bpe
+import data
+
+WORDS = 'the summarization of summaries summarize summarized long documents document tokens token a'.split()
+
+
+def _tokenizer(tmp_path, word_counts, num_merges=50, protected=()):
+  codes_file = str(tmp_path / 'codes')
+  bpe.write_merges(bpe.learn_bpe(word_counts, num_merges), codes_file)
+  return bpe.BPE(codes_file, protected)
+
+
+def test_segment_then_merge_returns_the_words(tmp_path):
+  rng = random.Random(0)
+  text = [rng.choice(WORDS) for _ in range(500)]
+  tokenizer = _tokenizer(tmp_path, Counter(text).items())
+  unseen = ['summarizations', 'tokenized', 'x', 'documentary']
+  for words in (text, unseen, WORDS):
+    subwords = tokenizer.segment(words)
+    assert bpe.merge_subwords(subwords) == words
+    assert all(s.endswith(bpe.CONTINUATION) for w in words for s in tokenizer.segment_word(w)[:-1])
+
+
+def test_merges_shrink_frequent_words(tmp_path):
+  tokenizer = _tokenizer(tmp_path, [('summarization', 100), ('summary', 50), ('zebra', 1)])
+  assert tokenizer.segment_word('summarization') == ['summarization']
+  assert len(tokenizer.segment_word('zebra')) == 5 # below min_count, no merge
+  assert bpe.learn_bpe([('aaab', 10)], num_merges=1) == [('a', 'a')] # the most frequent pair first
+
+
+def test_protected_words_are_not_split(tmp_path):
+  tokenizer = _tokenizer(tmp_path, [('unknown', 10)], protected=[data.UNKNOWN_TOKEN])
+  assert tokenizer.segment([data.UNKNOWN_TOKEN, 'unknown']) == [data.UNKNOWN_TOKEN, 'unknown']
+  assert tokenizer.fingerprint() == _tokenizer(tmp_path, [('unknown', 10)]).fingerprint()
@@ -0,0 +1,53 @@
+from itertools import chain
+
+import data
+
+
+def _kept(docs):
+  return [d for d in docs if data.keep_document(d['sections'])]
+
+
+def test_reader_returns_the_written_documents(dataset):
+  docs = _kept(dataset.docs)
+  reader = data.ColumnarReader(dataset.columnar)
+  assert len(reader) == len(docs)
+  for i, doc in enumerate(docs):
+    d = reader.document(i)
+    assert d.article_id == doc['article_id']
+    assert d.sections == doc['sections']
+    assert d.article_text == list(chain.from_iterable(doc['sections']))
+    assert d.abstract_sents == doc['abstract_text']
+    assert d.section_names == doc['section_names']
+    assert d.section_roles == data.section_roles(doc['section_names'], len(doc['sections']))
+    tokens = reader.document_tokens(i)
+    assert reader.lexicon[tokens].tolist() == ' '.join(d.article_text).split()
+    assert reader.lexicon[reader.section_tokens(i, 1)].tolist() == ' '.join(doc['sections'][1]).split()
+  reader.close()
+
+
+def test_columnar_and_bin_datafiles_hold_the_same_documents(dataset):
+  records = list(data._read_unit(dataset.columnar, [(0, None)]))
+  examples = list(data._read_unit(dataset.bin, [(0, None)]))
+  assert [d.article_id for d in records] == \
+         [e.features.feature['article_id'].bytes_list.value[0].decode() for e in examples]
+
+
+def test_ranges_of_a_columnar_dataset(dataset):
+  ranges = [(5, 9), (0, 2), (30, None)]
+  ids = [d.article_id for d in data._read_unit(dataset.columnar, ranges)]
+  docs = _kept(dataset.docs)
+  assert ids == [d['article_id'] for d in docs[5:9] + docs[0:2] + docs[30:]]
+
+
+def test_vocab_counts_the_documents_left_out(dataset, tmp_path):
+  import json_to_bin
+  counts = {}
+  for doc in dataset.docs:
+    text = ' '.join(list(chain.from_iterable(doc['sections'])) + doc['abstract_text']).split()
+    for t in text:
+      if t not in ('<S>', '</S>'):
+        counts[t] = counts.get(t, 0) + 1
+  json_to_bin.write_to_columnar(dataset.jsonl, str(tmp_path / 'col'), str(tmp_path / 'vocab'))
+  for vocab_file in (dataset.vocab, str(tmp_path / 'vocab')):
+    with open(vocab_file) as f:
+      assert dict((w, int(c)) for w, c in (l.split() for l in f)) == counts
@@ -0,0 +1,49 @@
+import os
+import random
+
+import pytest
+
+import compress_bin
+import data
+
+
+@pytest.fixture(scope='module')
+def shard(dataset, tmp_path_factory):
+  path = str(tmp_path_factory.mktemp('compressed') / 'train.binz')
+  compress_bin.compress(dataset.bin, path, block_size=4)
+  return path
+
+
+def test_shard_holds_the_records_of_the_datafile(dataset, shard):
+  assert data.is_compressed(shard) and not data.is_compressed(dataset.bin)
+  records = list(data.read_records(dataset.bin))
+  assert list(data.read_records(shard)) == records
+  assert data._num_indexed_records(shard) == len(records)
+
+
+def test_ranges_of_a_shard(dataset, shard):
+  records = list(data.read_records(dataset.bin))
+  rng = random.Random(0)
+  for _ in range(20):
+    ranges = []
+    for _ in range(rng.randint(1, 4)):
+      start = rng.randrange(len(records))
+      ranges.append((start, rng.choice([None, rng.randint(start, len(records))])))
+    expected = [r for start, stop in ranges for r in records[start:stop]]
+    assert list(data._read_compressed_records(shard, ranges)) == expected
+
+
+def test_decompress_round_trip(dataset, shard, tmp_path):
+  path = str(tmp_path / 'train.bin')
+  compress_bin.decompress(shard, path)
+  with open(path, 'rb') as f, open(dataset.bin, 'rb') as g:
+    assert f.read() == g.read()
+  assert data.load_record_index(path, build=False)[2].tolist() == data.load_record_index(dataset.bin)[2].tolist()
+
+
+def test_convert_all_writes_to_another_directory(dataset, tmp_path):
+  out_dir = str(tmp_path / 'compressed')
+  compress_bin.convert_all(dataset.bin, out_dir, block_size=4)
+  assert data.list_datafiles(os.path.join(out_dir, '*')) == [os.path.join(out_dir, 'train.binz')]
+  with pytest.raises(AssertionError):
+    compress_bin.convert_all(dataset.bin, os.path.dirname(dataset.bin))
@@ -0,0 +1,40 @@
+import numpy as np
+import pytest
+
+import batch_reader
+import data
+from conftest import BATCHER_KEYS, make_hps
+
+FIELDS = ['enc_input', 'enc_input_extend_vocab', 'article_oovs', 'abs_ids', 'abs_ids_extend_vocab',
+          'dec_input', 'target', 'enc_len', 'dec_len']
+
+
+@pytest.mark.parametrize('hier', [False, True])
+def test_cached_examples_equal_processed_examples(dataset, vocab, hier):
+  hps = make_hps(hier=hier, id_cache=True)
+  batcher = batch_reader.Batcher(dataset.bin, vocab, hps, True, *BATCHER_KEYS) # builds the cache
+  cache = batch_reader.IdCache(batch_reader.id_cache_path(dataset.bin, batch_reader.id_cache_key(vocab, hps)))
+  examples = list(batcher._example_generator(data.WorkUnits(dataset.bin, True), shuffle=False))
+  assert len(cache) == len(examples) > 0
+  for i, ex in enumerate(examples):
+    cached = cache.example(i, vocab, hps)
+    assert cached.article_id == ex.article_id
+    for k in FIELDS:
+      assert np.array_equal(getattr(cached, k), getattr(ex, k)), k
+    if hier:
+      assert len(cached.enc_sections) == len(ex.enc_sections)
+      assert all(np.array_equal(a, b) for a, b in zip(cached.enc_sections, ex.enc_sections))
+      assert all(np.array_equal(a, b) for a, b in zip(cached.enc_sections_extend_vocab, ex.enc_sections_extend_vocab))
+      assert list(cached.enc_sec_len) == list(ex.enc_sec_len)
+
+
+def test_ragged_writer_round_trip(tmp_path):
+  seqs = [np.arange(n, dtype=np.int32) for n in (3, 0, 5, 1)]
+  writer = batch_reader._RaggedWriter(str(tmp_path), 'ids', np.int32)
+  for seq in seqs:
+    writer.add(seq)
+  writer.close()
+  flat = np.load(str(tmp_path / 'ids.npy'))
+  offsets = np.load(str(tmp_path / 'ids_offsets.npy'))
+  assert [flat[a:b].tolist() for a, b in zip(offsets[:-1], offsets[1:])] == [s.tolist() for s in seqs]
+  assert not (tmp_path / 'ids.raw').exists()
@@ -0,0 +1,19 @@
+import numpy as np
+
+import data
+
+
+def test_shortlist_holds_the_frequent_and_article_words():
+  enc_ids = np.array([[3, 57, 100, 12, 57], [99, 101, 0, 1, 2]]) # vocab of 100 words, 100 and 101 are in-article OOVs
+  shortlist, positions = data.shortlist_ids(enc_ids, 100, 10)
+  assert shortlist.tolist() == sorted(set(range(10)) | {12, 57, 99})
+  # the decode graph maps positions back through the shortlist followed by the in-article OOVs
+  candidates = np.concatenate([shortlist, 100 + np.arange(2)])
+  assert (candidates[positions] == enc_ids).all()
+  assert (positions[enc_ids >= 100] == len(shortlist) + enc_ids[enc_ids >= 100] - 100).all()
+
+
+def test_shortlist_larger_than_the_vocab():
+  shortlist, positions = data.shortlist_ids(np.array([[4, 1, 4]]), 5, 10)
+  assert shortlist.tolist() == [0, 1, 2, 3, 4]
+  assert positions.tolist() == [[4, 1, 4]]
@@ -0,0 +1,113 @@
+import glob
+import shutil
+import threading
+
+from six.moves import queue
+
+import batch_reader
+import data
+
+
+def _datafiles(dataset, tmp_path, num_files):
+  """Copies the .bin datafile of the dataset num_files times, with its offset index"""
+  tmp_path = tmp_path / ('%d_files' % num_files)
+  tmp_path.mkdir()
+  for i in range(num_files):
+    shutil.copy(dataset.bin, str(tmp_path / ('train_%d.bin' % i)))
+    shutil.copy(data.index_path(dataset.bin), data.index_path(str(tmp_path / ('train_%d.bin' % i))))
+  return str(tmp_path / 'train_*.bin')
+
+
+def _positions(unit, num_records):
+  f, start, stop = unit
+  return set((f, i) for i in range(start, num_records if stop is None else stop))
+
+
+def _all_positions(data_path):
+  return set((f, i) for f in glob.glob(data_path) for i in range(len(data.load_record_index(f)[0])))
+
+
+def test_units_cover_each_epoch_once(dataset, tmp_path):
+  for num_files, num_readers in ((3, 2), (2, 5)): # whole datafiles, and datafiles split into ranges
+    data_path = _datafiles(dataset, tmp_path, num_files)
+    work_units = data.WorkUnits(data_path, single_pass=False, num_readers=num_readers, seed=1)
+    expected = _all_positions(data_path)
+    for epoch in range(2):
+      seen = set()
+      while len(seen) < len(expected):
+        unit = work_units.next()
+        positions = _positions(unit, len(data.load_record_index(unit[0])[0]))
+        assert not positions & seen
+        seen |= positions
+      assert seen == expected
+    if num_readers > num_files:
+      assert all(u[2] is not None for u in work_units._units)
+
+
+def test_unindexed_datafiles_are_split(dataset, tmp_path):
+  shutil.copy(dataset.bin, str(tmp_path / 'train.bin'))
+  data_path = str(tmp_path / 'train.bin')
+  work_units = data.WorkUnits(data_path, single_pass=True, num_readers=4)
+  units = [work_units.next() for _ in range(4)]
+  assert work_units.next() is None
+  assert len(set(units)) == 4
+  assert set().union(*[_positions(u, None) for u in units]) == _all_positions(data_path)
+
+
+def test_state_restores_the_unread_records(dataset, tmp_path):
+  data_path = _datafiles(dataset, tmp_path, 3)
+  work_units = data.WorkUnits(data_path, single_pass=True, num_readers=1)
+  read = set()
+  # a reader reads a unit in shuffled blocks, and stops in the middle of its third block
+  unit = work_units.next()
+  ranges = data.shuffled_ranges(*unit, block_size=7)
+  progress = work_units.track(unit, ranges)
+  records = [(unit[0], i) for start, stop in ranges for i in range(start, stop)]
+  for position in records[:17]:
+    read.add(position)
+    progress[0] += 1
+  state = work_units.state()
+
+  restored = data.WorkUnits(data_path, single_pass=True, num_readers=1)
+  restored.restore(state)
+  while True:
+    unit = restored.next()
+    if unit is None:
+      break
+    positions = _positions(unit, len(data.load_record_index(unit[0])[0]))
+    assert not positions & read
+    read |= positions
+  assert read == _all_positions(data_path)
+
+
+def test_process_cursor_holds_the_units_handed_out(dataset, tmp_path):
+  """The hand-out and report threads of a process-pool Batcher, with two readers standing in for its workers"""
+  data_path = _datafiles(dataset, tmp_path, 1)
+  num_records = len(data.load_record_index(dataset.bin)[0])
+  batcher = batch_reader.Batcher.__new__(batch_reader.Batcher)
+  batcher._num_processes = 2
+  batcher._data_path = data_path
+  batcher._id_cache_key = None
+  batcher._work_units = data.WorkUnits(data_path, single_pass=False, num_readers=4, seed=1)
+  batcher._units_lock = threading.Lock()
+  batcher._queued_units = []
+  batcher._unit_queue = queue.Queue(2)
+  batcher._unit_reports = queue.Queue()
+  batcher._unit_acks = [queue.Queue() for _ in range(2)]
+  batcher._unit_progress = [[0] for _ in range(2)]
+  for target in (batcher._hand_out_units, batcher._collect_unit_reports):
+    thread = threading.Thread(target=target)
+    thread.daemon = True
+    thread.start()
+
+  read = 0
+  for idx, num_read in enumerate((3, 15)): # the second reader finishes its first unit
+    work_units = batch_reader._HandedOutUnits(batcher._unit_queue, batcher._unit_reports, batcher._unit_acks[idx],
+                                              batcher._unit_progress[idx], idx)
+    reader = data.example_generator(data_path, False, work_units=work_units)
+    for _ in range(num_read):
+      next(reader)
+      read += 1
+  # every record handed out so far, in the queue or in a reader, is either read or left in the cursor
+  state = batcher.cursor()['work_units']
+  assert sum(stop - start for _, start, stop in state['units']) == (state['epoch'] + 1) * num_records - read
@@ -22,38 +22,70 @@ import tensorflow.compat.v1 as tfv1
 from tensorflow.contrib import learn
 import time
 import os
+import hashlib
 import numpy as np
+import data
 tfv1.disable_v2_behavior()
 FLAGS = tf.app.flags.FLAGS
 
 
-def load_embeddings(fpath, word_to_id, emd_init_var=0.25):
-  """ loads pretrained embeddings into a dictionary 
+def _embeddings_cache_path(fpath, vocab, emd_init_var):
+  """Path of the .npy matrix of the embeddings in fpath, aligned to the vocab"""
+  key = hashlib.sha1(('%s:%r' % (vocab.fingerprint(), emd_init_var)).encode('utf-8')).hexdigest()[:16]
+  return '%s.%s.npy' % (fpath, key)
+
+
+def _parse_embeddings(fpath, vocab, emd_init_var):
+  """Parses the text embedding file into a [vocab size, vector size] matrix, words not in the vocab are skipped
+  and the vectors of the vocab words without an embedding are initialized randomly"""
+  with open(fpath, encoding='utf-8', errors='replace') as f:
+    num_words, vector_size = list(map(int, next(f).strip().split(' ')))
+    np.random.seed(123)
+    embd = np.random.uniform(-emd_init_var, emd_init_var, (vocab.size(), vector_size)).astype(np.float32)
+    print('loading word embeddings')
+    ids = []
+    vecs = []
+    bad_lines = 0
+    unk_id = vocab.word2id(data.UNKNOWN_TOKEN)
+    for line in f:
+      word, _, vec = line.rstrip().partition(' ')
+      wid = vocab.word2id(word)
+      if wid == unk_id and word != data.UNKNOWN_TOKEN:
+        continue # not in the vocab
+      if vec.count(' ') != vector_size - 1:
+        bad_lines += 1
+        continue
+      ids.append(wid)
+      vecs.append(vec)
+  if vecs:
+    embd[ids] = np.array(' '.join(vecs).split(' '), dtype=np.float32).reshape(len(vecs), vector_size)
+  print('embeddings loaded, {:d} of {:d} words are in the vocab of size {:d} ({:d} bad lines)'.format(
+    len(ids), num_words, vocab.size(), bad_lines))
+  return embd
+
+
+def load_embeddings(fpath, vocab, emd_init_var=0.25):
+  """ loads pretrained embeddings into a matrix aligned to the vocab
+  The text file is parsed once and the matrix is saved next to it as .npy, which is memory-mapped on later runs.
   Args:
     fpath: file path to the text file of word embedddings
-    word_to_id: mapping of word to ids from Vocab
-    emd_init_var: initialization variance of embedding vectors
+    vocab: Vocab the rows of the matrix correspond to
+    emd_init_var: initialization variance of the embedding vectors of words without a pretrained embedding
   returns:
-    dictionary
+    [vocab size, vector size] float32 array
   """
-  f_iter = open(fpath)
-  num_words, vector_size = list(map( int,next(f_iter).strip().split(' ')))
-  np.random.seed(123)
-  embd = np.random.uniform(-emd_init_var,emd_init_var,(len(word_to_id), vector_size))
-  i = 0
-  print('loading word embeddings')
-  for line in f_iter:
-    i += 1
-    if i % 1000 == 0:
-      print('{}K lines processed'.format(i), '\r')
-    if i == 1:
-      continue
-    row = line.strip().split(' ')
-    word = row[0]
-    vec = list(map(float, row[1:]))
-    embd[word_to_id[word]] = np.array(vec)
-  print('embeddings loaded, vocab size: {}'.format(num_words))
-  f_iter.close()
+  cache_path = _embeddings_cache_path(fpath, vocab, emd_init_var)
+  if os.path.exists(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(fpath):
+    print('loading word embeddings from {}'.format(cache_path))
+    return np.load(cache_path, mmap_mode='r')
+  embd = _parse_embeddings(fpath, vocab, emd_init_var)
+  tmp_path = '%s.tmp%d' % (cache_path, os.getpid())
+  try:
+    with open(tmp_path, 'wb') as f:
+      np.save(f, embd)
+    os.rename(tmp_path, cache_path)
+  except (IOError, OSError) as e:
+    print('Warning: could not write embeddings cache {}: {}'.format(cache_path, e))
   return embd
 
 def get_config():